@@ -0,0 +1,162 @@
+import re
+import bisect
+import torch
+from transformers import StoppingCriteria, StoppingCriteriaList, LogitsProcessor, LogitsProcessorList
+from capture_util import ACTION_PARAMETERS, is_action_block_complete
+
+ACTION_INDENT = "  "
+PARAMETER_INDENT = "    "
+
+# Grammars already built in this process, keyed by tokenizer
+_grammars = {}
+
+class ActionGrammar:
+    """
+    Line-level grammar for a generated action block. Inside the block every line
+    must start one of the allowed targets: the function line (one of the known
+    functions), the parameters line, a parameter key of the predicted function,
+    a list item, or the end of the block. Closed targets must be matched
+    exactly, open targets only up to their end, after which the value is free.
+    """
+
+    def __init__(self, token_texts, eos_token_id):
+        self.eos_token_id = eos_token_id
+        self.token_ids = {}
+        for token_id, text in enumerate(token_texts):
+            if text:
+                self.token_ids.setdefault(text, []).append(token_id)
+        self.sorted_texts = sorted(self.token_ids)
+
+    def _targets(self, lines):
+        function_name = None
+        has_function = False
+        parameters = None
+        used_keys = set()
+
+        for line in lines:
+            match = re.match(r'^  function:\s*(\S+)', line)
+            if match:
+                has_function = True
+                function_name = match.group(1)
+            elif line.startswith(f"{ACTION_INDENT}parameters:"):
+                # `parameters: {}` is a complete, empty mapping
+                parameters = "empty" if line.split(":", 1)[1].strip() else "block"
+            else:
+                match = re.match(r'^    (\w+):', line)
+                if match:
+                    used_keys.add(match.group(1))
+
+        closed, open_ = [], []
+        if not has_function:
+            closed.extend(f"{ACTION_INDENT}function: {name}\n" for name in ACTION_PARAMETERS)
+        if parameters is None:
+            closed.extend([f"{ACTION_INDENT}parameters:\n", f"{ACTION_INDENT}parameters: {{}}\n"])
+        elif parameters == "block":
+            if function_name in ACTION_PARAMETERS:
+                keys = ACTION_PARAMETERS[function_name]
+            else:
+                keys = sorted({key for keys in ACTION_PARAMETERS.values() for key in keys})
+            open_.extend(f"{PARAMETER_INDENT}{key}:" for key in keys if key not in used_keys)
+            open_.append(f"{PARAMETER_INDENT}- ")
+        if has_function:
+            open_.append("```")
+            closed.append("\n")
+        return closed, open_, has_function
+
+    def _tokens_with_prefix(self, prefix):
+        start = bisect.bisect_left(self.sorted_texts, prefix)
+        for text in self.sorted_texts[start:]:
+            if not text.startswith(prefix):
+                break
+            yield from self.token_ids[text]
+
+    def allowed_tokens(self, generated_text):
+        """
+        Returns the token ids allowed after generated_text, or None when the
+        position is unconstrained (outside an action block or inside a value).
+        """
+        matches = list(re.finditer(r'^action:[^\n]*\n', generated_text, re.MULTILINE))
+        if not matches or is_action_block_complete(generated_text):
+            return None
+
+        lines = generated_text[matches[-1].end():].split('\n')
+        line = lines[-1]
+        closed, open_, has_function = self._targets(lines[:-1])
+
+        if any(line.startswith(target) for target in open_):
+            return None
+        closed = [target for target in closed if target.startswith(line)]
+        open_ = [target for target in open_ if target.startswith(line)]
+        if not closed and not open_:
+            # Already off the grammar; forcing tokens now would only produce garbage
+            return None
+
+        allowed = set()
+        for target in closed + open_:
+            rest = target[len(line):]
+            for end in range(1, len(rest) + 1):
+                allowed.update(self.token_ids.get(rest[:end], ()))
+        for target in open_:
+            allowed.update(self._tokens_with_prefix(target[len(line):]))
+        if has_function and not line:
+            allowed.add(self.eos_token_id)
+        return sorted(allowed)
+
+def get_action_grammar(tokenizer):
+    key = (tokenizer.name_or_path, len(tokenizer))
+    if key not in _grammars:
+        special_ids = set(tokenizer.all_special_ids)
+        token_texts = [
+            "" if token_id in special_ids else tokenizer.decode([token_id])
+            for token_id in range(len(tokenizer))
+        ]
+        _grammars[key] = ActionGrammar(token_texts, tokenizer.eos_token_id)
+    return _grammars[key]
+
+class ActionBlockStoppingCriteria(StoppingCriteria):
+    """Marks each sequence done once its action block is complete (or it hit EOS)."""
+
+    def __init__(self, tokenizer, prompt_length):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+
+    def __call__(self, input_ids, scores, **kwargs):
+        done = []
+        for sequence in input_ids:
+            generated = sequence[self.prompt_length:]
+            done.append(
+                self.tokenizer.eos_token_id in generated
+                or is_action_block_complete(self.tokenizer.decode(generated, skip_special_tokens=True))
+            )
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+class ActionGrammarLogitsProcessor(LogitsProcessor):
+    """Masks every token the action grammar does not allow at the current position."""
+
+    def __init__(self, tokenizer, prompt_length):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.grammar = get_action_grammar(tokenizer)
+
+    def __call__(self, input_ids, scores):
+        for row, sequence in enumerate(input_ids):
+            generated = sequence[self.prompt_length:]
+            if self.tokenizer.eos_token_id in generated:
+                continue
+            allowed = self.grammar.allowed_tokens(self.tokenizer.decode(generated, skip_special_tokens=True))
+            if allowed is None:
+                continue
+            mask = torch.full_like(scores[row], float("-inf"))
+            mask[allowed] = 0
+            scores[row] = scores[row] + mask
+        return scores
+
+def get_action_generation_kwargs(tokenizer, prompt_length, constrained=False):
+    """
+    Extra `model.generate` arguments that end generation once the action block
+    is complete and, when constrained, hold the block to the action schema.
+    """
+    kwargs = {"stopping_criteria": StoppingCriteriaList([ActionBlockStoppingCriteria(tokenizer, prompt_length)])}
+    if constrained:
+        kwargs["logits_processor"] = LogitsProcessorList([ActionGrammarLogitsProcessor(tokenizer, prompt_length)])
+    return kwargs
@@ -0,0 +1,446 @@
+import os
+import sys
+import json
+import time
+import platform
+import subprocess
+import random
+import argparse
+import tempfile
+from datetime import datetime, timedelta
+import sliding_window
+from capture_index import load_capture_index, get_sorted_files
+from capture_util import ACTION_PARAMETERS, extract_timestamp, get_action_labels
+from format_data_for_training import process_yaml_file
+from synthetic_captures import write_captures
+
+# Capture counts the pipeline benchmark runs at by default
+PIPELINE_SCALES = [10000, 100000, 1000000]
+
+# Chat template util.load_models installs, so template application can be timed without unsloth
+CHATML_TEMPLATE = (
+    "{% for message in messages %}"
+    "{{ '<|im_start|>' + ('user' if message['from'] == 'human' else 'assistant') + '\\n' + message['value'] + '<|im_end|>\\n' }}"
+    "{% endfor %}"
+)
+
+# Import cost budget (seconds) for each data-prep entry point; none of them may pull in unsloth/torch
+IMPORT_BUDGETS_S = {
+    "capture_index": 0.1,
+    "format_data_for_training": 0.25,
+    "sliding_window": 0.5,
+    "capture_store": 0.5,
+    "llama_data_pre_processing": 0.75,
+    "create_dataset": 1.0,
+}
+
+# create_dataset options the ingest check builds with, each compared against a full rebuild
+INGEST_CHECKS = {
+    "windows": {},
+    "dedup": {"dedup": True},
+    "dedup_compact": {"dedup": True, "compact": True},
+    "dedup_budget": {"dedup": True, "token_budget": 2048},
+}
+
+def write_synthetic_directory(output_dir, num_files, keyword_ratio=0.1, seed=0):
+    rng = random.Random(seed)
+    start = datetime(2024, 10, 1)
+    for i in range(num_files):
+        timestamp = (start + timedelta(milliseconds=50 * i)).strftime('%Y-%m-%dT%H-%M-%S.%f')
+        function = "use_item" if rng.random() < keyword_ratio else "move"
+        with open(os.path.join(output_dir, f"data_{timestamp}.yaml"), 'w') as f:
+            f.write(f"action:\n  function: {function}\n")
+
+def bench_successor_lookup(input_dir, keyword="use_item", sample_size=500):
+    results = {}
+
+    start = time.perf_counter()
+    load_capture_index(input_dir, rebuild=True)
+    results["index_cold_s"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    sorted_files = get_sorted_files(input_dir)
+    results["index_warm_s"] = time.perf_counter() - start
+
+    filtered_files = [c.filename for c in load_capture_index(input_dir) if c.function == keyword]
+    results["files"] = len(sorted_files)
+    results["filtered_files"] = len(filtered_files)
+
+    # list.index is quadratic over the whole pass, so time a spread sample and project
+    step = max(1, len(filtered_files) // sample_size)
+    sample = filtered_files[::step]
+    start = time.perf_counter()
+    for filename in sample:
+        position = sorted_files.index(filename)
+        if position + 1 < len(sorted_files):
+            sorted_files[position + 1]
+    elapsed = time.perf_counter() - start
+    results["list_index_projected_s"] = elapsed / max(1, len(sample)) * len(filtered_files)
+
+    start = time.perf_counter()
+    file_positions = {filename: i for i, filename in enumerate(sorted_files)}
+    for filename in filtered_files:
+        position = file_positions[filename]
+        if position + 1 < len(sorted_files):
+            sorted_files[position + 1]
+    results["position_map_s"] = time.perf_counter() - start
+    results["speedup"] = results["list_index_projected_s"] / max(results["position_map_s"], 1e-9)
+
+    return results
+
+def bench_sliding_window_io(input_dir, window_sizes=(3, 8, 16)):
+    results = {}
+    sorted_files = get_sorted_files(input_dir)
+    read_file_content = sliding_window.read_file_content
+    bytes_read = [0]
+
+    def counting_read_file_content(filepath):
+        content = read_file_content(filepath)
+        bytes_read[0] += len(content)
+        return content
+
+    sliding_window.read_file_content = counting_read_file_content
+    try:
+        for window_size in window_sizes:
+            # Baseline: every window re-reads all of its members
+            bytes_read[0] = 0
+            start = time.perf_counter()
+            for i in range(len(sorted_files) - (window_size-1)):
+                combined_content = ""
+                for file in sorted_files[i:i+window_size]:
+                    combined_content += sliding_window.read_file_content(os.path.join(input_dir, file)) + "\n"
+            reread_s = time.perf_counter() - start
+            reread_bytes = bytes_read[0]
+
+            bytes_read[0] = 0
+            start = time.perf_counter()
+            for _ in sliding_window.process_files(input_dir, window_size):
+                pass
+            rolling_s = time.perf_counter() - start
+            rolling_bytes = bytes_read[0]
+
+            results[f"window_{window_size}"] = {
+                "reread_s": reread_s,
+                "reread_bytes": reread_bytes,
+                "rolling_s": rolling_s,
+                "rolling_bytes": rolling_bytes,
+                "io_reduction": reread_bytes / max(1, rolling_bytes),
+            }
+    finally:
+        sliding_window.read_file_content = read_file_content
+
+    return results
+
+def bench_imports(budgets=IMPORT_BUDGETS_S):
+    results = {}
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    for module, budget in budgets.items():
+        completed = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            cwd=script_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+        )
+        cumulative_us = None
+        heavy = []
+        for line in completed.stderr.splitlines():
+            if not line.startswith("import time:") or "|" not in line:
+                continue
+            _, cumulative, name = [part.strip() for part in line[len("import time:"):].split("|")]
+            if name == module:
+                cumulative_us = int(cumulative)
+            if name.split(".")[0] in ("torch", "unsloth", "transformers", "trl"):
+                heavy.append(name)
+
+        import_s = cumulative_us / 1e6 if cumulative_us is not None else float("nan")
+        results[module] = {
+            "import_s": import_s,
+            "budget_s": budget,
+            "heavy_imports": len(heavy),
+            "within_budget": completed.returncode == 0 and not heavy and import_s <= budget,
+        }
+    return results
+
+def _timed(results, name, fn, items=None):
+    # Items default to the length of what fn returns
+    start = time.perf_counter()
+    value = fn()
+    seconds = time.perf_counter() - start
+    items = len(value) if items is None else items
+    results[name] = {"seconds": seconds, "items": items, "items_per_s": items / max(seconds, 1e-9)}
+    return value
+
+def bench_pipeline(input_dir, stage_limit=100000, tokenizer=None, sliding_window_size=3, seed=0):
+    """
+    Times each data-prep stage over a capture directory: timestamp sorting,
+    sliding windows, per-file YAML formatting, chat template application and
+    function filtering. Stages slower than a directory listing run on at most
+    stage_limit items; compare runs by items_per_s.
+    """
+    # Deferred so the import benchmark is not affected by datasets/numpy
+    from itertools import islice
+    from datasets import Dataset
+    from util import apply_template, get_unique_function, stratified_sample
+
+    results = {}
+    filenames = os.listdir(input_dir)
+    sorted_files = _timed(results, "extract_timestamp_sort", lambda: sorted(filenames, key=extract_timestamp))
+
+    windows = _timed(results, "sliding_window", lambda: list(islice(sliding_window.process_files(input_dir, sliding_window_size), stage_limit)))
+
+    sample = sorted_files[:stage_limit]
+    _timed(results, "process_yaml_file", lambda: [process_yaml_file(os.path.join(input_dir, f)) for f in sample])
+
+    conversations = []
+    for text in windows:
+        last_action_index = text.rfind('action:')
+        conversations.append([
+            {"from": "human", "value": text[:last_action_index].strip()},
+            {"from": "gpt", "value": text[last_action_index:].strip()},
+        ])
+
+    if tokenizer is not None:
+        def apply_templates():
+            rows = []
+            for start in range(0, len(conversations), 1000):
+                rows.extend(apply_template(tokenizer, [[c] for c in conversations[start:start+1000]]))
+            return rows
+        rows = _timed(results, "apply_template", apply_templates)
+    else:
+        # Same row shape as dataset_writer without the tokenizer, so filtering is still measured
+        rows = [{"text": f"{c[0]['value']}\n<|im_start|>assistant\n{c[1]['value']}"} for c in conversations]
+
+    for row, conversation in zip(rows, conversations):
+        row['function'], row['direction'] = get_action_labels(conversation[-1]['value'])
+    dataset = Dataset.from_list(rows)
+    _timed(results, "get_unique_function", lambda: get_unique_function(dataset), len(dataset))
+    _timed(results, "stratified_sample", lambda: stratified_sample(dataset, limit=len(dataset) * 0.05, seed=seed), len(dataset))
+    return results
+
+def load_benchmark_tokenizer(name):
+    from transformers import AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(name)
+    tokenizer.chat_template = CHATML_TEMPLATE
+    return tokenizer
+
+def run_pipeline_suite(scales, stage_limit, tokenizer_name=None, workers=None, report_path=None):
+    """Runs bench_pipeline at each scale on fresh synthetic captures and writes a JSON report."""
+    tokenizer = load_benchmark_tokenizer(tokenizer_name) if tokenizer_name else None
+    report = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "stage_limit": stage_limit,
+        "tokenizer": tokenizer_name,
+        "scales": {},
+    }
+    for scale in scales:
+        with tempfile.TemporaryDirectory() as input_dir:
+            print(f"Writing {scale} synthetic captures to {input_dir}...")
+            start = time.perf_counter()
+            write_captures(input_dir, scale, workers=workers or os.cpu_count())
+            print(f"  wrote in {time.perf_counter() - start:.1f}s")
+
+            results = bench_pipeline(input_dir, stage_limit, tokenizer)
+            report["scales"][str(scale)] = results
+            print(f"Pipeline at {scale} captures:")
+            print_results(results, "  ")
+
+        if report_path:
+            # Rewritten after every scale so a long run still leaves a partial report
+            with open(report_path, 'w') as f:
+                json.dump(report, f, indent=2)
+    return report
+
+def write_duplicate_runs(input_dir, every=5, run_length=3):
+    """Overwrites the captures after every `every`th one with its content, so dedup has runs to collapse."""
+    filenames = sorted(os.listdir(input_dir), key=extract_timestamp)
+    for i in range(0, len(filenames), every):
+        with open(os.path.join(input_dir, filenames[i]), 'r') as f:
+            content = f.read()
+        for filename in filenames[i + 1:i + run_length]:
+            with open(os.path.join(input_dir, filename), 'w') as f:
+                f.write(content)
+    return filenames
+
+def bench_ingest(tokenizer, num_captures=1000, batches=4, checks=INGEST_CHECKS, seed=0):
+    """
+    Checks that a dataset grown by ingest.py holds the same rows as a full
+    rebuild. For each set of create_dataset options, a base dataset is built
+    from the first batch of captures and the rest arrive in batches, each
+    followed by an ingest pass.
+    """
+    # Deferred so the other benchmarks run without datasets/transformers installed
+    import shutil
+    from create_dataset import create_dataset
+    from dataset_writer import load_dataset_with_deltas
+    from ingest import ingest_new_captures
+
+    results = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        source_dir = os.path.join(work_dir, "captures")
+        write_captures(source_dir, num_captures, seed)
+        filenames = write_duplicate_runs(source_dir)
+        # Offset so batches end at different points in (and outside) the runs of duplicates
+        bounds = [min(len(filenames), len(filenames) * i // batches + i) for i in range(batches)] + [len(filenames)]
+
+        for name, options in checks.items():
+            full = create_dataset(tokenizer, source_dir, os.path.join(work_dir, f"{name}-full"), **options)
+
+            input_dir = os.path.join(work_dir, f"{name}-captures")
+            dataset_dir = os.path.join(work_dir, f"{name}-grown")
+            os.makedirs(input_dir)
+            ingest_s = 0.0
+            for lo, hi in zip(bounds, bounds[1:]):
+                for filename in filenames[lo:hi]:
+                    # copy2 keeps the source mtime, so the captures are already settled
+                    shutil.copy2(os.path.join(source_dir, filename), input_dir)
+                if lo == 0:
+                    base_rows = len(create_dataset(tokenizer, input_dir, dataset_dir, **options))
+                    continue
+                start = time.perf_counter()
+                ingest_new_captures(tokenizer, input_dir, dataset_dir, None, settle_s=0)
+                ingest_s += time.perf_counter() - start
+
+            grown = load_dataset_with_deltas(dataset_dir)
+            results[name] = {
+                "rows": len(full),
+                "ingested_rows": len(grown) - base_rows,
+                "ingest_s": ingest_s,
+                "matches_rebuild": grown["text"] == full["text"],
+            }
+    return results
+
+def synthetic_prediction_prompt(rng, window_size=3):
+    captures = []
+    for _ in range(window_size):
+        function = rng.choice(sorted(ACTION_PARAMETERS))
+        parameters = "".join(f"    {key}: {rng.randint(0, 9)}\n" for key in ACTION_PARAMETERS[function])
+        captures.append(
+            "environment:\n  time_of_day: day\n  weather: clear\n  biome: plains\n"
+            f"player:\n  position: x={rng.randint(-100, 100)}, y=64, z={rng.randint(-100, 100)}\n  health: 20.0\n  hunger: 20\n"
+            f"action:\n  function: {function}\n  parameters:\n{parameters}"
+        )
+    human = f"{rng.choice(['Only return your prediction.', 'Just the prediction.'])} " + "\n".join(captures)
+    return f"<|im_start|>user\n{human}<|im_end|>\n<|im_start|>assistant\n"
+
+def bench_action_decoding(model_path, num_prompts=20, max_new_tokens=512, seed=0):
+    """
+    Single-prompt CPU latency of prediction-only generation: running to the
+    generation cap, stopping at the end of the action block, and stopping with
+    the action grammar applied.
+    """
+    # Deferred so the other benchmarks run without torch/transformers installed
+    import torch
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+    from action_decoding import get_action_generation_kwargs
+    from capture_util import parse_action
+
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    model = AutoModelForCausalLM.from_pretrained(model_path).to("cpu").eval()
+    rng = random.Random(seed)
+    prompts = [synthetic_prediction_prompt(rng) for _ in range(num_prompts)]
+
+    results = {}
+    for mode in ("cap", "stop", "constrained"):
+        latencies, tokens, parsed = [], 0, 0
+        for prompt in prompts:
+            inputs = tokenizer(prompt, return_tensors="pt", add_special_tokens=False)
+            prompt_length = inputs["input_ids"].shape[1]
+            kwargs = {} if mode == "cap" else get_action_generation_kwargs(tokenizer, prompt_length, mode == "constrained")
+
+            start = time.perf_counter()
+            with torch.no_grad():
+                outputs = model.generate(
+                    **inputs,
+                    max_new_tokens=max_new_tokens,
+                    do_sample=False,
+                    eos_token_id=tokenizer.eos_token_id,
+                    pad_token_id=tokenizer.pad_token_id or tokenizer.eos_token_id,
+                    **kwargs,
+                )
+            latencies.append(time.perf_counter() - start)
+
+            generated = outputs[0][prompt_length:]
+            tokens += len(generated)
+            parsed += parse_action(tokenizer.decode(generated, skip_special_tokens=True))[0] is not None
+
+        latencies.sort()
+        results[mode] = {
+            "mean_latency_s": sum(latencies) / len(latencies),
+            "p95_latency_s": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+            "mean_new_tokens": tokens / len(prompts),
+            "parse_rate": parsed / len(prompts),
+        }
+    return results
+
+def print_results(results, indent=""):
+    for key, value in results.items():
+        if isinstance(value, dict):
+            print(f"{indent}{key}:")
+            print_results(value, indent + "  ")
+        else:
+            print(f"{indent}{key}: {value:.4f}" if isinstance(value, float) else f"{indent}{key}: {value}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark capture processing on a synthetic capture directory.')
+    parser.add_argument('--num-files', type=int, default=200000, help='Number of synthetic captures to generate.')
+    parser.add_argument('--keyword-ratio', type=float, default=0.1, help='Fraction of captures matching the keyword filter.')
+    parser.add_argument('--benchmarks', type=str, nargs='+', default=["successor", "sliding-window", "imports"], help='Benchmarks to run (successor, sliding-window, imports, decoding, pipeline, ingest).')
+    parser.add_argument('--window-sizes', type=int, nargs='+', default=[3, 8, 16], help='Sliding window sizes to benchmark.')
+    parser.add_argument('--decode-model', type=str, default=None, help='Model directory for the decoding benchmark.')
+    parser.add_argument('--decode-prompts', type=int, default=20, help='Prompts generated per mode in the decoding benchmark.')
+    parser.add_argument('--max-new-tokens', type=int, default=512, help='Generation cap for the decoding benchmark.')
+    parser.add_argument('--scales', type=int, nargs='+', default=PIPELINE_SCALES, help='Capture counts for the pipeline benchmark.')
+    parser.add_argument('--stage-limit', type=int, default=100000, help='Most items a pipeline stage processes at any scale.')
+    parser.add_argument('--tokenizer', type=str, default=None, help='Tokenizer for timing template application in the pipeline benchmark (skipped when unset) and for the ingest check.')
+    parser.add_argument('--ingest-captures', type=int, default=1000, help='Synthetic captures the ingest check builds from.')
+    parser.add_argument('--workers', type=int, default=None, help='Processes writing synthetic captures for the pipeline benchmark.')
+    parser.add_argument('--report', type=str, default="benchmark_report.json", help='JSON report written by the pipeline benchmark.')
+    args = parser.parse_args()
+
+    if "pipeline" in args.benchmarks:
+        run_pipeline_suite(args.scales, args.stage_limit, args.tokenizer, args.workers, args.report)
+        print(f"Wrote pipeline report to {args.report}")
+
+    if "decoding" in args.benchmarks:
+        if args.decode_model:
+            print("Prediction decoding latency (CPU):")
+            print_results(bench_action_decoding(args.decode_model, args.decode_prompts, args.max_new_tokens), "  ")
+        else:
+            print("Skipping the decoding benchmark: --decode-model is required.")
+
+    if "ingest" in args.benchmarks:
+        if args.tokenizer:
+            print("Ingest vs full rebuild:")
+            results = bench_ingest(load_benchmark_tokenizer(args.tokenizer), args.ingest_captures)
+            print_results(results, "  ")
+            if not all(result["matches_rebuild"] for result in results.values()):
+                sys.exit("Ingested rows differ from a full rebuild.")
+        else:
+            print("Skipping the ingest check: --tokenizer is required.")
+
+    if "imports" in args.benchmarks:
+        print("Import time:")
+        results = bench_imports()
+        print_results(results, "  ")
+        if not all(result["within_budget"] for result in results.values()):
+            print("One or more entry points exceeded their import budget.")
+
+    if not {"successor", "sliding-window"} & set(args.benchmarks):
+        return
+
+    with tempfile.TemporaryDirectory() as input_dir:
+        print(f"Writing {args.num_files} synthetic captures to {input_dir}...")
+        write_synthetic_directory(input_dir, args.num_files, args.keyword_ratio)
+
+        if "successor" in args.benchmarks:
+            print("Successor lookup:")
+            print_results(bench_successor_lookup(input_dir), "  ")
+
+        if "sliding-window" in args.benchmarks:
+            print("Sliding window I/O:")
+            print_results(bench_sliding_window_io(input_dir, args.window_sizes), "  ")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+import os
+import re
+import argparse
+from collections import namedtuple
+import metrics
+from capture_util import extract_timestamp
+
+INDEX_FILENAME = ".capture_index.tsv"
+INDEX_HEADER = "# capture-index v1\ttimestamp\tfilename\tsize\tmtime\tfunction"
+
+Capture = namedtuple("Capture", ["timestamp", "filename", "size", "mtime", "function"])
+
+# In-process cache so repeated calls in one run (e.g. once per keyword in
+# create_dataset_llama) only pay for a directory listing, not a re-parse.
+_loaded_indexes = {}
+_function_indexes = {}
+
+def read_action_function(filepath):
+    with open(filepath, 'r') as file:
+        text = file.read()
+
+    # The action block is the last top-level `action:` key written by the collector
+    matches = list(re.finditer(r'^action:', text, re.MULTILINE))
+    if not matches:
+        return ""
+
+    match = re.search(r'^\s+function:\s*(\S+)', text[matches[-1].end():], re.MULTILINE)
+    return match.group(1) if match else ""
+
+def _index_path(input_dir):
+    return os.path.join(input_dir, INDEX_FILENAME)
+
+def _read_index_file(input_dir):
+    index_path = _index_path(input_dir)
+    captures = {}
+
+    if not os.path.exists(index_path):
+        return captures
+
+    with open(index_path, 'r') as index_file:
+        header = index_file.readline().rstrip("\n")
+        if header != INDEX_HEADER:
+            print(f"Capture index at {index_path} has an unknown format. Rebuilding...")
+            return captures
+
+        for line in index_file:
+            timestamp, filename, size, mtime, function = line.rstrip("\n").split("\t")
+            captures[filename] = Capture(timestamp, filename, int(size), float(mtime), function)
+
+    return captures
+
+def _write_index_file(input_dir, captures):
+    index_path = _index_path(input_dir)
+    tmp_path = f"{index_path}.tmp"
+    try:
+        with open(tmp_path, 'w') as index_file:
+            index_file.write(INDEX_HEADER + "\n")
+            for capture in captures:
+                index_file.write(f"{capture.timestamp}\t{capture.filename}\t{capture.size}\t{capture.mtime}\t{capture.function}\n")
+        os.replace(tmp_path, index_path)
+    except OSError as e:
+        print(f"Unable to save capture index to {index_path}: {e}")
+
+def _index_capture(input_dir, filename, stat):
+    timestamp = extract_timestamp(filename)
+    if timestamp is None:
+        return None
+
+    file_path = os.path.join(input_dir, filename)
+    return Capture(timestamp.isoformat(timespec='microseconds'), filename, stat.st_size, stat.st_mtime, read_action_function(file_path))
+
+def load_capture_index(input_dir, rebuild=False, check_changes=False):
+    """
+    Returns the captures in input_dir sorted by timestamp. The index is kept on
+    disk beside the captures and only files not seen before are stat'd and
+    parsed; within a process the loaded index is returned as is. With
+    check_changes (for long-running watchers) the directory is listed again and
+    every file is stat'd, re-indexing any whose size or mtime changed since it
+    was indexed (e.g. one still being written when first seen).
+    """
+    key = os.path.abspath(input_dir)
+
+    if key in _loaded_indexes and not rebuild and not check_changes:
+        return _loaded_indexes[key]
+
+    if rebuild:
+        known = {}
+    elif key in _loaded_indexes:
+        known = {capture.filename: capture for capture in _loaded_indexes[key]}
+    else:
+        known = _read_index_file(input_dir)
+
+    with os.scandir(input_dir) as entries:
+        yaml_entries = {entry.name: entry for entry in entries if entry.name.endswith('.yaml') and entry.is_file()}
+
+    removed = known.keys() - yaml_entries.keys()
+    added = yaml_entries.keys() - known.keys()
+    stats = {filename: yaml_entries[filename].stat() for filename in added}
+    if check_changes:
+        for filename in yaml_entries.keys() & known.keys():
+            stat = yaml_entries[filename].stat()
+            if known[filename].size != stat.st_size or known[filename].mtime != stat.st_mtime:
+                added.add(filename)
+                stats[filename] = stat
+
+    for filename in removed:
+        del known[filename]
+
+    for filename in added:
+        capture = _index_capture(input_dir, filename, stats[filename])
+        if capture is not None:
+            known[filename] = capture
+
+    # Files without a parseable timestamp are never indexed, so they show up as "added" every run
+    changed = bool(removed) or any(filename in known for filename in added)
+    if not changed and not rebuild and key in _loaded_indexes:
+        return _loaded_indexes[key]
+
+    captures = sorted(known.values(), key=lambda c: (c.timestamp, c.filename))
+
+    if changed:
+        _write_index_file(input_dir, captures)
+
+    _loaded_indexes[key] = captures
+    return captures
+
+def get_sorted_files(input_dir):
+    with metrics.timed("listing"):
+        files = [capture.filename for capture in load_capture_index(input_dir)]
+    metrics.set_gauge("captures_listed", len(files))
+    return files
+
+def get_captures_by_function(input_dir):
+    """
+    Returns an inverted index of action function -> timestamp sorted filenames,
+    derived from the function column of the on-disk capture index.
+    """
+    captures = load_capture_index(input_dir)
+    key = os.path.abspath(input_dir)
+
+    cached = _function_indexes.get(key)
+    if cached is None or cached[0] is not captures:
+        by_function = {}
+        for capture in captures:
+            by_function.setdefault(capture.function, []).append(capture.filename)
+        cached = (captures, by_function)
+        _function_indexes[key] = cached
+
+    return cached[1]
+
+def get_files_with_function(input_dir, function):
+    return get_captures_by_function(input_dir).get(function, [])
+
+def main():
+    parser = argparse.ArgumentParser(description='Build or refresh the capture index for a directory of YAML captures.')
+    parser.add_argument('--input-dir', type=str, default="./input", help='Path to the input directory containing YAML files.')
+    parser.add_argument('--rebuild', action='store_true', help='Ignore the existing index and re-scan every capture.')
+    parser.add_argument('--check-changes', action='store_true', help='Stat every capture and re-index those modified since they were indexed.')
+    args = parser.parse_args()
+
+    captures = load_capture_index(args.input_dir, args.rebuild, args.check_changes)
+    print(f"Indexed {len(captures)} captures in {args.input_dir}")
+    for function, filenames in sorted(get_captures_by_function(args.input_dir).items()):
+        print(f"  {function or '<no action>'}: {len(filenames)}")
+
+if __name__ == '__main__':
+    main()
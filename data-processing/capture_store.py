@@ -0,0 +1,232 @@
+import os
+import json
+import yaml
+import argparse
+import pyarrow as pa
+from capture_index import load_capture_index
+from format_data_for_training import YamlLoader
+
+MANIFEST_FILENAME = "manifest.json"
+DEFAULT_PART_ROWS = 50000
+
+CAPTURE_SCHEMA = pa.schema([
+    ("timestamp", pa.string()),
+    ("filename", pa.string()),
+    ("environment", pa.struct([
+        ("time_of_day", pa.string()),
+        ("weather", pa.string()),
+        ("biome", pa.string()),
+    ])),
+    ("player", pa.struct([
+        ("position", pa.string()),
+        ("orientation", pa.string()),
+        ("health", pa.float32()),
+        ("hunger", pa.int32()),
+        ("inventory", pa.list_(pa.string())),
+    ])),
+    ("nearby_entities", pa.list_(pa.struct([
+        ("type", pa.string()),
+        ("position", pa.string()),
+    ]))),
+    ("map_blocks", pa.list_(pa.string())),
+    ("action", pa.struct([
+        ("function", pa.string()),
+        # Parameters differ per function, so they are kept as a JSON object string
+        ("parameters", pa.string()),
+    ])),
+    # The capture exactly as written by the collector, so windows match the YAML path byte for byte
+    ("raw", pa.large_string()),
+])
+
+def is_capture_store(path):
+    return os.path.exists(os.path.join(path, MANIFEST_FILENAME))
+
+def load_manifest(store_dir):
+    manifest_path = os.path.join(store_dir, MANIFEST_FILENAME)
+    if not os.path.exists(manifest_path):
+        return {"high_water": "", "parts": []}
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+def save_manifest(store_dir, manifest):
+    manifest_path = os.path.join(store_dir, MANIFEST_FILENAME)
+    with open(f"{manifest_path}.tmp", 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(f"{manifest_path}.tmp", manifest_path)
+
+def capture_to_row(capture, raw):
+    data = yaml.load(raw, Loader=YamlLoader) or {}
+    environment = data.get("environment") or {}
+    player = data.get("player") or {}
+    action = data.get("action") or {}
+
+    return {
+        "timestamp": capture.timestamp,
+        "filename": capture.filename,
+        "environment": {
+            "time_of_day": environment.get("time_of_day"),
+            "weather": environment.get("weather"),
+            "biome": environment.get("biome"),
+        },
+        "player": {
+            "position": player.get("position"),
+            "orientation": player.get("orientation"),
+            "health": player.get("health"),
+            "hunger": player.get("hunger"),
+            "inventory": player.get("inventory") or [],
+        },
+        "nearby_entities": [
+            {"type": str(entity.get("type")), "position": entity.get("position")}
+            for entity in (data.get("nearby_entities") or [])
+        ],
+        "map_blocks": data.get("map_blocks") or [],
+        "action": {
+            "function": action.get("function"),
+            "parameters": json.dumps(action.get("parameters") or {}, sort_keys=True),
+        },
+        "raw": raw,
+    }
+
+def _new_part_name(store_dir, manifest):
+    # Numbers are never reused, so a new part cannot replace one a manifest still lists
+    number = manifest.get("next_part", len(manifest["parts"]))
+    while os.path.exists(os.path.join(store_dir, f"part-{number:05d}.arrow")):
+        number += 1
+    manifest["next_part"] = number + 1
+    return f"part-{number:05d}.arrow"
+
+def _write_table(part_path, table):
+    with pa.OSFile(f"{part_path}.tmp", 'wb') as sink:
+        with pa.ipc.new_file(sink, CAPTURE_SCHEMA) as writer:
+            writer.write_table(table)
+    os.replace(f"{part_path}.tmp", part_path)
+
+def _write_part(store_dir, manifest, rows):
+    part_name = _new_part_name(store_dir, manifest)
+    _write_table(os.path.join(store_dir, part_name), pa.Table.from_pylist(rows, schema=CAPTURE_SCHEMA))
+
+    manifest["parts"].append({"name": part_name, "rows": len(rows), "last_timestamp": rows[-1]["timestamp"]})
+    manifest["high_water"] = rows[-1]["timestamp"]
+    save_manifest(store_dir, manifest)
+    print(f"Wrote {part_name} ({len(rows)} captures)")
+
+def append_captures(input_dir, store_dir, part_rows=DEFAULT_PART_ROWS):
+    """
+    Appends captures in input_dir newer than the store's high-water timestamp
+    as new Arrow parts. Existing parts are never rewritten.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    manifest = load_manifest(store_dir)
+    high_water = manifest["high_water"]
+
+    captures = load_capture_index(input_dir)
+    new_captures = [capture for capture in captures if capture.timestamp > high_water]
+    print(f"Appending {len(new_captures)} new captures to {store_dir} (high water: {high_water or 'none'})")
+
+    rows = []
+    for capture in new_captures:
+        with open(os.path.join(input_dir, capture.filename), 'r') as f:
+            rows.append(capture_to_row(capture, f.read()))
+        if len(rows) >= part_rows:
+            _write_part(store_dir, manifest, rows)
+            rows = []
+    if rows:
+        _write_part(store_dir, manifest, rows)
+
+    return manifest
+
+def _read_part(store_dir, part):
+    source = pa.memory_map(os.path.join(store_dir, part["name"]), 'r')
+    return pa.ipc.open_file(source).read_all()
+
+def _merge_groups(parts, part_rows):
+    """Groups runs of adjacent parts smaller than part_rows so each group stays within part_rows."""
+    groups = []
+    for part in parts:
+        last = groups[-1] if groups else None
+        if part["rows"] < part_rows and last and last[-1]["rows"] < part_rows and sum(p["rows"] for p in last) + part["rows"] <= part_rows:
+            last.append(part)
+        else:
+            groups.append([part])
+    return groups
+
+def merge_parts(store_dir, part_rows=DEFAULT_PART_ROWS):
+    """
+    Rewrites runs of adjacent small parts into parts of up to part_rows
+    captures; full parts are left in place. The merged parts are written
+    under new names and the manifest is switched to them before any old part
+    is deleted, so an interrupted merge never loses captures.
+    """
+    manifest = load_manifest(store_dir)
+    groups = _merge_groups(manifest["parts"], part_rows)
+    if all(len(group) == 1 for group in groups):
+        print("No adjacent small parts to merge")
+        return
+
+    tmp_dir = os.path.join(store_dir, "merge.tmp")
+    os.makedirs(tmp_dir, exist_ok=True)
+    merged = dict(manifest, parts=[])
+    replaced = []
+    written = 0
+    for group in groups:
+        if len(group) == 1:
+            merged["parts"].append(group[0])
+            continue
+        # Parts are memory-mapped and concatenated as Arrow tables, never converted to Python rows
+        table = pa.concat_tables([_read_part(store_dir, part) for part in group])
+        part_name = _new_part_name(store_dir, merged)
+        _write_table(os.path.join(tmp_dir, part_name), table)
+        merged["parts"].append({"name": part_name, "rows": table.num_rows, "last_timestamp": group[-1]["last_timestamp"]})
+        replaced.extend(group)
+        written += 1
+
+    for part in merged["parts"]:
+        tmp_path = os.path.join(tmp_dir, part["name"])
+        if os.path.exists(tmp_path):
+            os.replace(tmp_path, os.path.join(store_dir, part["name"]))
+    save_manifest(store_dir, merged)
+
+    for part in replaced:
+        os.remove(os.path.join(store_dir, part["name"]))
+    os.rmdir(tmp_dir)
+
+    print(f"Merged {len(replaced)} parts into {written}")
+
+def iter_store_tables(store_dir, columns=None):
+    """Yields each part as a memory-mapped table, in timestamp order."""
+    for part in load_manifest(store_dir)["parts"]:
+        table = _read_part(store_dir, part)
+        yield table.select(columns) if columns else table
+
+def iter_store_captures(store_dir):
+    """Yields (filename, raw capture) pairs in timestamp order."""
+    for table in iter_store_tables(store_dir, ["filename", "raw"]):
+        for batch in table.to_batches():
+            yield from zip(batch.column(0).to_pylist(), batch.column(1).to_pylist())
+
+def load_store_table(store_dir, columns=None):
+    tables = list(iter_store_tables(store_dir, columns))
+    if not tables:
+        return CAPTURE_SCHEMA.empty_table().select(columns) if columns else CAPTURE_SCHEMA.empty_table()
+    return pa.concat_tables(tables)
+
+def get_store_functions(store_dir):
+    """Returns the store's filenames and action functions, both in timestamp order."""
+    import pyarrow.compute as pc
+    table = load_store_table(store_dir, ["filename", "action"])
+    return table.column("filename").to_pylist(), pc.struct_field(table.column("action"), "function").to_pylist()
+
+def main():
+    parser = argparse.ArgumentParser(description='Pack YAML captures into a columnar Arrow capture store.')
+    parser.add_argument('--input-dir', type=str, default="./input", help='Path to the input directory containing YAML files.')
+    parser.add_argument('--store-dir', type=str, default="./output/captures", help='Path to the capture store.')
+    parser.add_argument('--part-rows', type=int, default=DEFAULT_PART_ROWS, help='Maximum captures per store part.')
+    parser.add_argument('--merge', action='store_true', help='Merge small parts after appending.')
+    args = parser.parse_args()
+
+    append_captures(args.input_dir, args.store_dir, args.part_rows)
+    if args.merge:
+        merge_parts(args.store_dir, args.part_rows)
+
+if __name__ == '__main__':
+    main()
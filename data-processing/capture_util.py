@@ -0,0 +1,95 @@
+import re
+from datetime import datetime
+
+# Parameters written by the data collection mod for each function the model is trained to predict
+ACTION_PARAMETERS = {
+    "move":            ("direction", "distance", "jumping"),
+    "interact_block":  ("block", "interaction"),
+    "player_sleep":    ("bed_position",),
+    "use_item":        ("item",),
+    "pickup_item":     ("item", "count"),
+    "attack_entity":   ("entity_type", "weapon"),
+    "container_event": ("container",),
+    "player_wake":     ("wake_immediately",),
+    "destroy_item":    ("item",),
+    "craft_item":      ("item", "count", "ingredients"),
+}
+
+# Define a function to extract the timestamp from the filename
+def extract_timestamp(filename):
+    # Regex to match the timestamp in the filename. The collector writes LocalDateTime.toString(),
+    # which omits a zero fraction, and the seconds as well when both are zero
+    match = re.search(r'data_(\d{4}-\d{2}-\d{2}T\d{2}-\d{2})(?:-(\d{2}))?(?:\.(\d+))?\.yaml', filename)
+    if match:
+        minutes_part, seconds, fraction = match.groups()
+        # Truncate the fraction to microseconds if it's longer
+        microseconds = (fraction or "0")[:6].ljust(6, "0")
+        # Convert the string to a datetime object
+        return datetime.strptime(f"{minutes_part}-{seconds or '00'}.{microseconds}", '%Y-%m-%dT%H-%M-%S.%f')
+    return None
+
+def get_action_labels(text):
+    """
+    Returns (function, direction) for the last action in text. Either is an
+    empty string when not present.
+    """
+    function_name = ""
+    if "function: " in text:
+        _, _, rest = text.rpartition("function: ")
+        function_name = rest.split('\n')[0].split('.')[0].strip()
+
+    direction = ""
+    action_index = text.rfind('action:')
+    match = re.search(r'direction:\s*(\w+)', text[action_index:] if action_index >= 0 else text)
+    if match:
+        direction = match.group(1)
+
+    return function_name, direction
+
+def extract_action_block(text):
+    """
+    Returns the YAML of the last top-level `action:` block in text, without any
+    surrounding ``` fence, or None when there is no action.
+    """
+    matches = list(re.finditer(r'^action:', text, re.MULTILINE))
+    if not matches:
+        return None
+
+    lines = text[matches[-1].start():].split('\n')
+    block = [lines[0]]
+    for line in lines[1:]:
+        # The block ends at a closing fence or the next top-level key
+        if line.startswith('```') or (line and not line[0].isspace()):
+            break
+        block.append(line)
+    return '\n'.join(block).rstrip()
+
+def is_action_block_complete(text):
+    """True once an action block has been followed by a fence, a new top-level key or a blank line."""
+    matches = list(re.finditer(r'^action:', text, re.MULTILINE))
+    if not matches:
+        return False
+
+    lines = text[matches[-1].start():].split('\n')
+    # The last line may still be in progress, so only judge complete lines
+    for line in lines[1:-1]:
+        if line.startswith('```') or not line.strip() or not line[0].isspace():
+            return True
+    return False
+
+def parse_action(text):
+    """Returns (function, parameters) for the last action block in text, or (None, {})."""
+    import yaml
+
+    block = extract_action_block(text)
+    if block is None:
+        return None, {}
+    try:
+        action = (yaml.safe_load(block) or {}).get('action') or {}
+    except yaml.YAMLError:
+        return None, {}
+    if not isinstance(action, dict):
+        return None, {}
+
+    parameters = action.get('parameters')
+    return action.get('function'), parameters if isinstance(parameters, dict) else {}
@@ -0,0 +1,280 @@
+import re
+import json
+import yaml
+import argparse
+import itertools
+from collections import deque
+from format_data_for_training import parse_capture, imap_ordered
+
+# Short, stable names for the eight map_blocks neighbours, in collector order
+BLOCK_DIRECTIONS = {
+    "north": "N", "south": "S", "east": "E", "west": "W",
+    "northeast": "NE", "southeast": "SE", "southwest": "SW", "northwest": "NW",
+}
+
+def short_id(value):
+    """Drops the namespace from Minecraft ids: block.minecraft.stone, minecraft:stone -> stone."""
+    value = str(value)
+    value = re.sub(r'^(?:block|item|entity)\.minecraft\.', '', value)
+    value = re.sub(r'^minecraft:', '', value)
+    match = re.search(r"entity\.minecraft\.(\w+)", value)
+    if match:
+        # Entity names are written as Component.toString(), e.g. translation{key='entity.minecraft.cow', ...}
+        return match.group(1)
+    match = re.fullmatch(r'literal\{(.*)\}', value)
+    return match.group(1) if match else value
+
+def format_number(value):
+    text = f"{float(value):.2f}".rstrip('0').rstrip('.')
+    return "0" if text == "-0" else text
+
+def parse_vector(text):
+    """Parses "x=1.00, y=64.00, z=-3.25" (or dx=/dy=/dz=) into a tuple of floats."""
+    values = re.findall(r'-?\d+(?:\.\d+)?', str(text or ""))
+    return tuple(float(value) for value in values[:3]) if len(values) >= 3 else None
+
+def parse_inventory(inventory):
+    slots = {}
+    for entry in inventory or []:
+        match = re.match(r'Slot (\d+): (\S+) x(\d+)', str(entry))
+        if match:
+            slots[int(match.group(1))] = f"{short_id(match.group(2))}*{match.group(3)}"
+    return slots
+
+def parse_map_blocks(map_blocks):
+    blocks = {}
+    for entry in map_blocks or []:
+        match = re.match(r'(\S+) (\w+) of player', str(entry))
+        if match and match.group(2) in BLOCK_DIRECTIONS:
+            blocks[BLOCK_DIRECTIONS[match.group(2)]] = short_id(match.group(1))
+    return blocks
+
+def capture_state(capture):
+    """Reduces a parsed capture to the fields the compact encoding tracks."""
+    environment = capture.get("environment") or {}
+    player = capture.get("player") or {}
+    return {
+        "env": " ".join(short_id(environment.get(key)) for key in ("time_of_day", "weather", "biome")),
+        "pos": parse_vector(player.get("position")),
+        "look": parse_vector(player.get("orientation")),
+        "vitals": f"hp {format_number(player.get('health') or 0)} food {player.get('hunger')}",
+        "inv": parse_inventory(player.get("inventory")),
+        "ent": " ".join(
+            f"{short_id(entity.get('type'))}({','.join(format_number(v) for v in parse_vector(entity.get('position')) or ())})"
+            for entity in capture.get("nearby_entities") or []
+        ),
+        "blk": parse_map_blocks(capture.get("map_blocks")),
+    }
+
+def _format_value(value):
+    # Plain scalars stay bare; anything YAML would read back differently is written as JSON
+    if isinstance(value, str) and re.fullmatch(r'[\w.:-]+', value) and yaml.safe_load(value) == value:
+        return value
+    return json.dumps(value)
+
+def encode_action(function_name, parameters):
+    """Encodes an action as `act <function> key=value ...`; decode_action reverses it."""
+    parts = ["act", str(function_name)]
+    parts.extend(f"{key}={_format_value(value)}" for key, value in (parameters or {}).items())
+    return " ".join(parts)
+
+def decode_action(line):
+    """Returns (function, parameters) for an `act` line, or (None, {}) when line is not one."""
+    match = re.match(r'^act (\S+)(.*)$', line.strip())
+    if not match:
+        return None, {}
+    parameters = {}
+    rest = match.group(2).strip()
+    decoder = json.JSONDecoder()
+    while rest:
+        key = re.match(r'(\w+)=', rest)
+        if not key:
+            break
+        rest = rest[key.end():]
+        try:
+            if rest[:1] in ('"', '[', '{'):
+                value, end = decoder.raw_decode(rest)
+            else:
+                # Bare scalars read back as YAML, the way _format_value checked them
+                end = len(rest.split(' ', 1)[0])
+                value = yaml.safe_load(rest[:end])
+        except (ValueError, yaml.YAMLError):
+            # A truncated or malformed value, e.g. from a generation cut short
+            return None, {}
+        parameters[key.group(1)] = value
+        rest = rest[end:].lstrip()
+    return match.group(1), parameters
+
+def action_to_yaml(function_name, parameters):
+    """Renders a decoded action as the `action:` YAML block the model and player mod use."""
+    return yaml.dump({"action": {"function": function_name, "parameters": parameters}}, default_flow_style=False, sort_keys=False)
+
+def expand_action(text):
+    """
+    Rewrites the last `act` line in text (such as the output of a model trained
+    on compact samples) as its `action:` YAML block. Text without one is
+    returned unchanged.
+    """
+    matches = list(re.finditer(r'^act \S+.*$', text, re.MULTILINE))
+    if not matches:
+        return text
+    function_name, parameters = decode_action(matches[-1].group(0))
+    if function_name is None:
+        return text
+    return text[:matches[-1].start()] + action_to_yaml(function_name, parameters).rstrip('\n') + text[matches[-1].end():]
+
+def encode_window(captures, include_last_action=True):
+    """
+    Encodes parsed captures (oldest first) as compact text. The first capture is
+    written in full; later captures only list what changed, with positions as
+    deltas. Each capture ends with its `act` line, except the last one when
+    include_last_action is False (the action the model is asked to predict).
+    """
+    lines = []
+    previous = None
+    for i, capture in enumerate(captures):
+        state = capture_state(capture)
+        lines.append(f"#{i}")
+
+        if previous is None or state["env"] != previous["env"]:
+            lines.append(f"env {state['env']}")
+        if state["pos"] is not None:
+            if previous is None or previous["pos"] is None:
+                lines.append("pos " + " ".join(format_number(v) for v in state["pos"]))
+            elif state["pos"] != previous["pos"]:
+                lines.append("dpos " + " ".join(format_number(a - b) for a, b in zip(state["pos"], previous["pos"])))
+        if state["look"] is not None and (previous is None or state["look"] != previous["look"]):
+            lines.append("look " + " ".join(format_number(v) for v in state["look"]))
+        if previous is None or state["vitals"] != previous["vitals"]:
+            lines.append(state["vitals"])
+
+        if previous is None:
+            if state["inv"]:
+                lines.append("inv " + " ".join(f"{slot}:{item}" for slot, item in sorted(state["inv"].items())))
+        else:
+            changes = [f"{slot}:{state['inv'].get(slot, '-')}" for slot in sorted(set(state["inv"]) | set(previous["inv"])) if state["inv"].get(slot) != previous["inv"].get(slot)]
+            if changes:
+                lines.append("inv " + " ".join(changes))
+
+        if previous is None or state["ent"] != previous["ent"]:
+            if state["ent"] or previous is not None:
+                lines.append(f"ent {state['ent'] or '-'}")
+
+        blocks = state["blk"] if previous is None else {d: b for d, b in state["blk"].items() if previous["blk"].get(d) != b}
+        if blocks:
+            lines.append("blk " + " ".join(f"{direction}:{block}" for direction, block in blocks.items()))
+
+        action = capture.get("action")
+        if isinstance(action, dict) and (include_last_action or i < len(captures) - 1):
+            lines.append(encode_action(action.get("function"), action.get("parameters")))
+        previous = state
+
+    return "\n".join(lines) + "\n"
+
+def parse_captures(contents):
+    return [parse_capture(content) for content in contents]
+
+def split_prompt_captures(text):
+    """
+    Splits a prompt into the instruction text before the first capture and the
+    parsed captures, where each capture starts at a top-level `environment:`
+    line. Returns (text, []) when the prompt holds no parseable captures.
+    """
+    starts = [match.start() for match in re.finditer(r'^environment:', text, re.MULTILINE)]
+    if not starts:
+        return text, []
+    try:
+        captures = parse_captures(text[start:end] for start, end in zip(starts, starts[1:] + [len(text)]))
+    except yaml.YAMLError:
+        return text, []
+    return text[:starts[0]], captures
+
+def compact_prompt(text):
+    """Rewrites the captures in a prompt with encode_window, keeping the instruction text."""
+    pre, captures = split_prompt_captures(text)
+    if not captures:
+        return text
+    return pre + encode_window(captures)
+
+def iter_compact_samples(input_directory, sliding_window_size=3, return_intermediates=False, dedup=False, dedup_log=None):
+    """
+    Yields (human, gpt) pairs for the same windows as sliding_window.process_files:
+    the human side is the compact window without its final action, the gpt side
+    the final action's `act` line (expand_action turns it back into YAML). Each
+    capture is parsed only once.
+    """
+    from sliding_window import iter_captures
+    from dedup import dedup_captures
+
+    captures = iter_captures(input_directory)
+    if dedup:
+        captures = dedup_captures(captures, log_path=dedup_log)
+
+    yield from compact_window_samples(captures, sliding_window_size, return_intermediates)
+
+def compact_window_samples(captures, sliding_window_size=3, return_intermediates=False, workers=1):
+    """
+    The pairs iter_compact_samples yields, for (filename, content) pairs from
+    any source. With workers > 1 the captures are parsed in a process pool.
+    """
+    window = deque(maxlen=sliding_window_size)
+    captures, contents = itertools.tee(captures)
+    parsed = imap_ordered(parse_capture, (content for _, content in contents), workers)
+    for (_, content), capture in zip(captures, parsed):
+        window.append((content, capture))
+        if len(window) < sliding_window_size:
+            continue
+
+        samples = [[item] for item in window] if return_intermediates else []
+        samples.append(list(window))
+        for sample in samples:
+            action = sample[-1][1].get("action")
+            if not isinstance(action, dict):
+                continue
+            human = encode_window([capture for _, capture in sample], include_last_action=False)
+            yield human, encode_action(action.get("function"), action.get("parameters"))
+
+def token_report(tokenizer, windows):
+    """Mean and p95 token counts of the raw and compact encodings of each window's prompt."""
+    counts = {"raw": [], "compact": []}
+    for contents in windows:
+        raw = "\n".join(contents)
+        counts["raw"].append(len(tokenizer(raw[:raw.rfind('action:')], add_special_tokens=False)["input_ids"]))
+        compact = encode_window(parse_captures(contents), include_last_action=False)
+        counts["compact"].append(len(tokenizer(compact, add_special_tokens=False)["input_ids"]))
+
+    report = {}
+    for name, values in counts.items():
+        values.sort()
+        report[name] = {
+            "windows": len(values),
+            "mean_tokens": sum(values) / max(1, len(values)),
+            "p95_tokens": values[min(len(values) - 1, int(len(values) * 0.95))] if values else 0,
+        }
+    report["reduction"] = report["raw"]["mean_tokens"] / max(1e-9, report["compact"]["mean_tokens"])
+    return report
+
+def main():
+    # Deferred so the encoder itself does not depend on transformers
+    from itertools import islice
+    from transformers import AutoTokenizer
+    from sliding_window import iter_captures, iter_windows
+
+    parser = argparse.ArgumentParser(description='Compare prompt token counts of the raw and compact capture encodings.')
+    parser.add_argument('--input-dir', type=str, default="./input", help='Path to the capture directory or capture store.')
+    parser.add_argument('--sliding-window-size', type=int, default=3, help='Size of the sliding window.')
+    parser.add_argument('--tokenizer', type=str, default="unsloth/Llama-3.2-1B-Instruct", help='Tokenizer used to count tokens.')
+    parser.add_argument('--limit', type=int, default=10000, help='Maximum number of windows to measure.')
+    parser.add_argument('--show', action='store_true', help='Print the first window in both encodings.')
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    windows = [contents for _, contents in islice(iter_windows(iter_captures(args.input_dir), args.sliding_window_size), args.limit)]
+    if args.show and windows:
+        print("\n".join(windows[0]))
+        print(encode_window(parse_captures(windows[0])))
+
+    print(json.dumps(token_report(tokenizer, windows), indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,19 @@
 import argparse
 import os
-import torch
 import json
-from datasets import Dataset
-from util import load_models, apply_template
-from sliding_window import process_files as process_files_sw
+import functools
+import metrics
+from util import load_models, apply_template, max_seq_length
+from dataset_writer import write_dataset, reset_deltas, build_signature, DEFAULT_SHARD_SIZE
+from sliding_window import iter_captures, iter_window_texts
+from capture_store import is_capture_store
+from dedup import dedup_captures
 from llama_data_pre_processing import process_files as process_files_llama
 from llama_data_pre_processing import generate_story_data
+from response_cache import ResponseCache
 from llama_prompts import be_brief, only_return_prediction
+from compact_state import compact_window_samples
+from token_budget import TokenBudget, iter_budget_window_texts, get_token_counts_dir, DEFAULT_MAX_WINDOW_SIZE
 
 DEFAULT_PRE="Below I have provided a short history of minecraft game data and player actions, act as an expert minecraft player and suggest the next appropriate action to be taken next based on the game data provided.\n\n"
 
@@ -24,23 +30,72 @@ functions = [
                 ("function: craft_item",      1000),
              ]
 
-def create_dataset_llama(tokenizer, input_dir, output_dir, dataset_dir, model="llama3.1"):
+def print_first_messages(conversations, count=5):
+    for idx, conversation in enumerate(conversations):
+        if idx < count:
+            print(f"Message {idx}: Content={metrics.preview(conversation)}")
+        metrics.increment("conversations")
+        yield conversation
+
+def create_dataset_llama(tokenizer, input_dir, output_dir, dataset_dir, model="llama3.1", concurrency=1, shard_size=DEFAULT_SHARD_SIZE, dedup=False, dedup_log=None, workers=1):
     if not os.path.isdir(input_dir):
         print(f"Error: The directory '{input_dir}' does not exist.")
         return
     
-    messages = []
+    def get_conversations():
+        for f, max in functions:
+            i = 0
+            for human, gpt, gpt_summary, action in process_files_llama(model, input_dir, output_dir, f, concurrency, max, dedup, dedup_log, workers):        
+                ##
+                ## It is important to note that all non-human responses here include the predection at the end
+                ## This is intended to provide better flexibility in steering the LLM to be more flexible in its 
+                ## response lengths for speed and performance.
+                ##
+                data = [
+                    {
+                        "from": "human",
+                        "value": human.strip()
+                    },
+                    {
+                        "from": "gpt",
+                        "value": gpt.strip()
+                    }
+                ]
+                data_sm = [
+                    {
+                        "from": "human",
+                        "value": be_brief() + " " + human.strip()
+                    },
+                    {
+                        "from": "gpt",
+                        "value": gpt_summary.strip()
+                    }
+                ]
+                data_prediction = [
+                    {
+                        "from": "human",
+                        "value": only_return_prediction() + " " + human.strip()
+                    },
+                    {
+                        "from": "gpt",
+                        "value": action.strip()
+                    }
+                ]
+                yield data
+                yield data_sm
+                yield data_prediction
+                i += 1
+                if i >= max:
+                    break
 
     print(f"Processing Data via Ollama w/ {model}...")
 
-    for f, max in functions:
-        i = 0
-        for human, gpt, gpt_summary, action in process_files_llama(model, input_dir, output_dir, f):        
-            ##
-            ## It is important to note that all non-human responses here include the predection at the end
-            ## This is intended to provide better flexibility in steering the LLM to be more flexible in its 
-            ## response lengths for speed and performance.
-            ##
+    signature = build_signature("llama", input_dir, {"model": model, "functions": functions, "dedup": dedup})
+    return write_dataset(tokenizer, print_first_messages(get_conversations()), dataset_dir, shard_size, signature=signature)
+
+def create_dataset_story(tokenizer, output_dir, dataset_dir, model="llama3.1", concurrency=1, shard_size=DEFAULT_SHARD_SIZE):
+    def get_conversations():
+        for human, gpt in generate_story_data(model, output_dir, concurrency):
             data = [
                 {
                     "from": "human",
@@ -51,126 +106,99 @@ def create_dataset_llama(tokenizer, input_dir, output_dir, dataset_dir, model="l
                     "value": gpt.strip()
                 }
             ]
-            data_sm = [
-                {
-                    "from": "human",
-                    "value": be_brief() + " " + human.strip()
-                },
-                {
-                    "from": "gpt",
-                    "value": gpt_summary.strip()
-                }
-            ]
-            data_prediction = [
-                {
-                    "from": "human",
-                    "value": only_return_prediction() + " " + human.strip()
-                },
-                {
-                    "from": "gpt",
-                    "value": action.strip()
-                }
-            ]
-            messages.append([data])
-            messages.append([data_sm])
-            messages.append([data_prediction])
-            i += 1
-            if i >= max:
-                break
-
-    print(f"Number of messages loaded: {len(messages)}")
-    for idx, message in enumerate(messages[:5]):
-        print(f"Message {idx}: Type={type(message)}, Content={message}")
-
-
-    print(f"Applying Template...")
-
-    dataset_list = apply_template(tokenizer, messages)
-    dataset = Dataset.from_list(dataset_list)
-
-    dataset.save_to_disk(dataset_dir)
-
-    print(f"Data saved to {dataset_dir}")
-
-    return dataset
-
-def create_dataset_story(tokenizer, output_dir, dataset_dir, model="llama3.1"):
-    messages = []
+            yield data
 
     print(f"Processing Data via Ollama w/ {model}...")
 
-    for human, gpt in generate_story_data(model, output_dir):
+    signature = build_signature("story", output_dir, {"model": model})
+    return write_dataset(tokenizer, print_first_messages(get_conversations()), dataset_dir, shard_size, signature=signature)
+
+def split_window_samples(texts):
+    for text in texts:
+        last_action_index = text.rfind('action:')
+        yield text[:last_action_index], text[last_action_index:]
+
+def window_samples(captures, sliding_window_size=3, compact=False, budget=None, workers=1):
+    """
+    (human, gpt) pairs for every window over (filename, content) capture pairs,
+    as create_dataset builds them. With a TokenBudget, windows are sized to the
+    budget instead of holding sliding_window_size captures.
+    """
+    if budget is not None:
+        return split_window_samples(iter_budget_window_texts(captures, budget, True))
+    if compact:
+        return compact_window_samples(captures, sliding_window_size, True, workers)
+    return split_window_samples(iter_window_texts(captures, sliding_window_size, True))
+
+def window_conversations(samples, pre=DEFAULT_PRE):
+    for human_value, gpt_value in samples:
         data = [
             {
                 "from": "human",
-                "value": human.strip()
+                "value": pre + human_value.strip()
             },
             {
                 "from": "gpt",
-                "value": gpt.strip()
+                "value": gpt_value.strip()
             }
         ]
-        messages.append([data])
+        yield data
 
-    print(f"Number of messages loaded: {len(messages)}")
-    for idx, message in enumerate(messages[:5]):
-        print(f"Message {idx}: Type={type(message)}, Content={message}")
-
-
-    print(f"Applying Template...")
-
-    dataset_list = apply_template(tokenizer, messages)
-    dataset = Dataset.from_list(dataset_list)
-
-    dataset.save_to_disk(dataset_dir)
+def window_conversation(text, pre=DEFAULT_PRE):
+    """The conversation create_dataset makes from one window's text."""
+    return next(window_conversations(split_window_samples([text]), pre))
 
-    print(f"Data saved to {dataset_dir}")
+def get_token_budget(tokenizer, input_dir, dataset_dir, settings):
+    """The TokenBudget for a dataset's settings, or None for fixed-size windows."""
+    if not settings.get("token_budget"):
+        return None
+    return TokenBudget(tokenizer, input_dir, get_token_counts_dir(dataset_dir), functools.partial(window_conversation, pre=settings["pre"]),
+                       settings["token_budget"], settings.get("max_window_size", DEFAULT_MAX_WINDOW_SIZE), settings["pre"])
 
-    return dataset
-
-def create_dataset(tokenizer, input_dir, dataset_dir, sliding_window_size=3, pre=DEFAULT_PRE):
+def create_dataset(tokenizer, input_dir, dataset_dir, sliding_window_size=3, pre=DEFAULT_PRE, shard_size=DEFAULT_SHARD_SIZE, compact=False, dedup=False, dedup_log=None,
+                   token_budget=None, max_window_size=DEFAULT_MAX_WINDOW_SIZE, workers=1):
     if not os.path.isdir(input_dir):
         print(f"Error: The directory '{input_dir}' does not exist.")
         return
-    
-    messages = []
+    if token_budget and compact:
+        raise Exception("token_budget sizes windows of YAML captures and cannot be combined with compact")
 
-    print(f"Loading Data...")
+    settings = {"sliding_window_size": sliding_window_size, "pre": pre, "compact": compact, "dedup": dedup}
+    if token_budget:
+        settings.update(token_budget=token_budget, max_window_size=max_window_size)
+    budget = get_token_budget(tokenizer, input_dir, dataset_dir, settings)
 
-    for text in process_files_sw(input_dir, sliding_window_size, True):        
-        last_action_index = text.rfind('action:')
-        human_value = text[:last_action_index]
-        gpt_value = text[last_action_index:]
-        data = [
-            {
-                "from": "human",
-                "value": pre + human_value.strip()
-            },
-            {
-                "from": "gpt",
-                "value": gpt_value.strip()
-            }
-        ]
-        messages.append([data])
-
-    print(f"Number of messages loaded: {len(messages)}")
-    for idx, message in enumerate(messages[:5]):
-        print(f"Message {idx}: Type={type(message)}, Content={message}")
+    last_capture = [None]
 
+    def get_captures():
+        for filename, content in iter_captures(input_dir):
+            last_capture[0] = filename
+            yield filename, content
 
-    print(f"Applying Template...")
+    captures = get_captures()
+    if dedup:
+        # Collapse runs of near-identical captures before they are windowed
+        captures = dedup_captures(captures, log_path=dedup_log, workers=workers)
 
-    dataset_list = apply_template(tokenizer, messages)
-    dataset = Dataset.from_list(dataset_list)
+    print(f"Loading Data...")
 
-    dataset.save_to_disk(dataset_dir)
+    signature = build_signature("window", input_dir, settings)
+    dataset = write_dataset(tokenizer, print_first_messages(window_conversations(window_samples(captures, sliding_window_size, compact, budget, workers), pre)), dataset_dir, shard_size,
+                            signature=signature)
 
-    print(f"Data saved to {dataset_dir}")
+    if budget is not None:
+        report = budget.print_report(f"{dataset_dir}_lengths.json")
+        metrics.set_gauge("budget_p95_tokens", report["p95_tokens"])
 
+    if not is_capture_store(input_dir):
+        # ingest.py appends the captures that arrive after this one as delta shards
+        reset_deltas(dataset_dir, last_capture[0], settings)
     return dataset
 
 
 def create_dataset_old(tokenizer, input_dir, dataset_dir):
+    from datasets import Dataset
+
     if not os.path.isdir(input_dir):
         print(f"Error: The directory '{input_dir}' does not exist.")
         return
@@ -220,8 +248,21 @@ def main():
     parser.add_argument('--use-llama', action='store_true', help='Process data with llama via ollama')
     parser.add_argument('--story-dataset', action='store_true', help='Process story data with llama via ollama')
     parser.add_argument('--dataset-name', type=str, default="dataset", help='Name of the dataset.')
+    parser.add_argument('--concurrency', type=int, default=1, help='Number of concurrent Ollama requests.')
+    parser.add_argument('--shard-size', type=int, default=DEFAULT_SHARD_SIZE, help='Rows per dataset shard written while building.')
+    parser.add_argument('--cache-compress', action='store_true', help='Compress cached Ollama responses.')
+    parser.add_argument('--cache-max-bytes', type=int, default=None, help='Evict least recently used cached responses beyond this size.')
+    parser.add_argument('--compact', action='store_true', help='Encode sliding window game state with the compact delta encoding.')
+    parser.add_argument('--dedup', action='store_true', help='Drop near-duplicate captures before building windows (logged to <output-dir>/dedup_log.jsonl).')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes used to parse captures for --dedup and --compact.')
+    parser.add_argument('--token-budget', type=int, nargs='?', const=max_seq_length, default=None,
+                        help=f'Size each window to fit this many tokens (default when given without a value: {max_seq_length}) instead of --sliding-window-size captures.')
+    parser.add_argument('--max-window-size', type=int, default=DEFAULT_MAX_WINDOW_SIZE, help='Most captures in a window sized by --token-budget.')
+    metrics.add_arguments(parser)
 
     args = parser.parse_args()
+    if args.token_budget and args.compact:
+        parser.error("--token-budget cannot be combined with --compact")
 
     input_dir = args.input_dir
     output_dir = args.output_dir
@@ -231,17 +272,28 @@ def main():
     pre = args.pre_prompt
     use_llama = args.use_llama
     story_dataset = args.story_dataset
+    concurrency = args.concurrency
+    shard_size = args.shard_size
+    dedup_log = os.path.join(output_dir, "dedup_log.jsonl") if args.dedup else None
+    metrics_report = args.metrics_report or os.path.join(output_dir, f"{dataset_name}_metrics.json")
 
     model, tokenizer = load_models()
 
-    if use_llama:
-        create_dataset_llama(tokenizer, input_dir, './output/llama', dataset_dir)
-    elif story_dataset:
-        create_dataset_story(tokenizer, './output/llama', dataset_dir)
-    elif pre == None:
-        create_dataset(tokenizer, input_dir, dataset_dir, sliding_window_size)
-    else:
-        create_dataset(tokenizer, input_dir, dataset_dir, sliding_window_size, pre)
+    if use_llama or story_dataset:
+        ResponseCache.open('./output/llama', args.cache_compress, args.cache_max_bytes)
+
+    with metrics.run_metrics(metrics_report, args.progress_interval, {"run": "create_dataset", "dataset": dataset_name}):
+        if use_llama:
+            create_dataset_llama(tokenizer, input_dir, './output/llama', dataset_dir, concurrency=concurrency, shard_size=shard_size, dedup=args.dedup, dedup_log=dedup_log,
+                                 workers=args.workers)
+        elif story_dataset:
+            create_dataset_story(tokenizer, './output/llama', dataset_dir, concurrency=concurrency, shard_size=shard_size)
+        elif pre == None:
+            create_dataset(tokenizer, input_dir, dataset_dir, sliding_window_size, shard_size=shard_size, compact=args.compact, dedup=args.dedup, dedup_log=dedup_log,
+                           token_budget=args.token_budget, max_window_size=args.max_window_size, workers=args.workers)
+        else:
+            create_dataset(tokenizer, input_dir, dataset_dir, sliding_window_size, pre, shard_size, args.compact, args.dedup, dedup_log,
+                           args.token_budget, args.max_window_size, args.workers)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,164 @@
+import os
+import json
+import shutil
+import hashlib
+import itertools
+import metrics
+from util import apply_template, get_function_index
+from capture_util import get_action_labels
+from compact_state import expand_action
+
+DEFAULT_SHARD_SIZE = 10000
+DEFAULT_BATCH_SIZE = 1000
+
+def get_shards_dir(dataset_dir):
+    return f"{dataset_dir.rstrip(os.sep)}.shards"
+
+def build_signature(builder, input_dir, settings):
+    """
+    Identifies what a build's conversations are made from: the builder, the
+    input directory and every setting that changes which windows are produced
+    or how they are formatted. Shards are only resumed under the same signature.
+    """
+    data = {"builder": builder, "input_dir": os.path.abspath(input_dir) if input_dir else None, "settings": settings}
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode("UTF-8")).hexdigest()
+
+def _load_progress(shards_dir, shard_size, signature):
+    progress_path = os.path.join(shards_dir, "progress.json")
+    if os.path.exists(progress_path):
+        with open(progress_path, 'r') as f:
+            progress = json.load(f)
+        if progress.get("shard_size") == shard_size and progress.get("signature") == signature:
+            return progress
+        if progress.get("shard_size") != shard_size:
+            print(f"Shard size changed ({progress.get('shard_size')} -> {shard_size}). Discarding shards in {shards_dir}...")
+        else:
+            print(f"Build inputs or settings changed since the shards in {shards_dir} were written. Discarding them...")
+        shutil.rmtree(shards_dir)
+    return {"shard_size": shard_size, "signature": signature, "shards": []}
+
+def _save_progress(shards_dir, progress):
+    progress_path = os.path.join(shards_dir, "progress.json")
+    with open(f"{progress_path}.tmp", 'w') as f:
+        json.dump(progress, f, indent=2)
+    os.replace(f"{progress_path}.tmp", progress_path)
+
+def template_rows(tokenizer, conversations, batch_size=DEFAULT_BATCH_SIZE):
+    """Dataset rows for conversations: the templated text plus the function/direction label columns."""
+    rows = []
+    with metrics.timed("template"):
+        for start in range(0, len(conversations), batch_size):
+            rows.extend(apply_template(tokenizer, [[c] for c in conversations[start:start+batch_size]]))
+
+    # Store structured labels so filtering and eval never have to re-parse the text
+    for row, conversation in zip(rows, conversations):
+        row['function'], row['direction'] = get_action_labels(expand_action(conversation[-1]['value']))
+    return rows
+
+def _write_shard(tokenizer, shards_dir, progress, conversations, batch_size):
+    from datasets import Dataset
+
+    rows = template_rows(tokenizer, conversations, batch_size)
+
+    shard_name = f"shard-{len(progress['shards']):05d}"
+    shard_path = os.path.join(shards_dir, shard_name)
+    if os.path.exists(shard_path):
+        shutil.rmtree(shard_path)
+    with metrics.timed("shard_write"):
+        Dataset.from_list(rows).save_to_disk(shard_path)
+    metrics.increment("dataset_rows", len(rows))
+
+    progress["shards"].append({"name": shard_name, "rows": len(rows)})
+    _save_progress(shards_dir, progress)
+    print(f"Wrote {shard_name} ({len(rows)} rows)")
+
+def write_dataset(tokenizer, conversations, dataset_dir, shard_size=DEFAULT_SHARD_SIZE, batch_size=DEFAULT_BATCH_SIZE, signature=None):
+    """
+    Applies the chat template to `conversations` in batches and writes the rows
+    as Arrow shards next to dataset_dir, so memory is bounded by one shard. An
+    interrupted build resumes after the last completed shard when it has the
+    same `signature` (see build_signature) and tokenizer, and so produces the
+    same conversations in the same order. The finished shards are combined into
+    a single dataset saved at dataset_dir.
+    """
+    # Imported here so callers that never write a dataset do not pay for loading `datasets`
+    from datasets import Dataset, concatenate_datasets
+
+    shards_dir = get_shards_dir(dataset_dir)
+    progress = _load_progress(shards_dir, shard_size, f"{signature}:{tokenizer.name_or_path}")
+    os.makedirs(shards_dir, exist_ok=True)
+
+    completed = sum(shard["rows"] for shard in progress["shards"])
+    if completed:
+        print(f"Resuming after {len(progress['shards'])} completed shards ({completed} rows)...")
+
+    conversations = itertools.islice(conversations, completed, None)
+    while True:
+        shard = list(itertools.islice(conversations, shard_size))
+        if shard:
+            _write_shard(tokenizer, shards_dir, progress, shard, batch_size)
+        if len(shard) < shard_size:
+            break
+
+    print(f"Number of messages loaded: {sum(shard['rows'] for shard in progress['shards'])}")
+
+    if progress["shards"]:
+        # Shards are memory-mapped, so combining them does not load the corpus into memory
+        dataset = concatenate_datasets([
+            Dataset.load_from_disk(os.path.join(shards_dir, shard["name"])) for shard in progress["shards"]
+        ])
+    else:
+        dataset = Dataset.from_dict({"text": [], "function": [], "direction": []})
+
+    dataset.save_to_disk(dataset_dir)
+    shutil.rmtree(shards_dir)
+
+    print(f"Data saved to {dataset_dir}")
+
+    dataset = Dataset.load_from_disk(dataset_dir)
+    get_function_index(dataset)
+    return dataset
+
+def get_deltas_dir(dataset_dir):
+    return f"{dataset_dir.rstrip(os.sep)}.deltas"
+
+def load_ingest_state(dataset_dir):
+    """
+    Returns the incremental ingest state kept beside dataset_dir: the last
+    capture already in the dataset (`high_water`), the settings its rows were
+    built with and the delta shards appended since the base was written.
+    """
+    state_path = os.path.join(get_deltas_dir(dataset_dir), "state.json")
+    if os.path.exists(state_path):
+        with open(state_path, 'r') as f:
+            return json.load(f)
+    return {"high_water": None, "settings": None, "shards": []}
+
+def save_ingest_state(dataset_dir, state):
+    deltas_dir = get_deltas_dir(dataset_dir)
+    os.makedirs(deltas_dir, exist_ok=True)
+    state_path = os.path.join(deltas_dir, "state.json")
+    with open(f"{state_path}.tmp", 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(f"{state_path}.tmp", state_path)
+
+def reset_deltas(dataset_dir, high_water, settings):
+    """Drops the delta shards of a dataset whose base was just rebuilt up to and including high_water."""
+    deltas_dir = get_deltas_dir(dataset_dir)
+    if os.path.exists(deltas_dir):
+        shutil.rmtree(deltas_dir)
+    save_ingest_state(dataset_dir, {"high_water": high_water, "settings": settings, "shards": []})
+
+def has_dataset(dataset_dir):
+    return os.path.exists(dataset_dir) or bool(load_ingest_state(dataset_dir)["shards"])
+
+def load_dataset_with_deltas(dataset_dir):
+    """Loads the base dataset at dataset_dir followed by any delta shards ingested since it was built."""
+    from datasets import Dataset, concatenate_datasets
+
+    datasets = [Dataset.load_from_disk(dataset_dir)] if os.path.exists(dataset_dir) else []
+    shards = load_ingest_state(dataset_dir)["shards"]
+    datasets.extend(Dataset.load_from_disk(os.path.join(get_deltas_dir(dataset_dir), shard["name"])) for shard in shards)
+    if shards:
+        print(f"Loaded {len(shards)} delta shards ({sum(shard['rows'] for shard in shards)} rows) for {dataset_dir}")
+    return datasets[0] if len(datasets) == 1 else concatenate_datasets(datasets)
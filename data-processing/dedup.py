@@ -0,0 +1,106 @@
+import json
+import itertools
+import math
+import yaml
+import hashlib
+import argparse
+import metrics
+from compact_state import capture_state
+from format_data_for_training import YamlLoader, imap_ordered
+
+# Kept filenames already computed in this process, keyed by (input dir, max run)
+_kept_files = {}
+
+def normalize_capture(capture):
+    """
+    The parts of a capture that distinguish one situation from another: the
+    compact state with the position snapped to its block and the look vector
+    and float action parameters rounded to one decimal.
+    """
+    state = capture_state(capture)
+    if state["pos"] is not None:
+        state["pos"] = tuple(math.floor(value) for value in state["pos"])
+    if state["look"] is not None:
+        state["look"] = tuple(round(value, 1) for value in state["look"])
+
+    action = capture.get("action") or {}
+    parameters = action.get("parameters") or {}
+    state["action"] = {
+        "function": action.get("function"),
+        "parameters": {key: round(value, 1) if isinstance(value, float) else value for key, value in parameters.items()},
+    }
+    return state
+
+def capture_signature(content):
+    with metrics.timed("parse"):
+        capture = yaml.load(content, Loader=YamlLoader) or {}
+    normalized = json.dumps(normalize_capture(capture), sort_keys=True, default=str)
+    return hashlib.sha1(normalized.encode("UTF-8")).hexdigest()
+
+def dedup_captures(captures, max_run=1, log_path=None, stats=None, workers=1):
+    """
+    Streaming filter over (filename, content) pairs in capture order. A capture
+    whose normalized state and action match the previous capture's extends a
+    run; only the first max_run captures of each run are passed through. Each
+    dropped capture is written to log_path as a JSON line naming the capture
+    that kept its run, and kept/dropped counts are recorded in `stats`. With
+    workers > 1 the captures are parsed in a process pool.
+    """
+    stats = stats if stats is not None else {}
+    stats.update(kept=0, dropped=0)
+    log = open(log_path, 'w') if log_path else None
+
+    previous_signature = None
+    run_length = 0
+    run_head = None
+    captures, contents = itertools.tee(captures)
+    signatures = imap_ordered(capture_signature, (content for _, content in contents), workers)
+    try:
+        for (filename, content), signature in zip(captures, signatures):
+            if signature == previous_signature:
+                run_length += 1
+            else:
+                previous_signature, run_length, run_head = signature, 1, filename
+
+            if run_length > max_run:
+                stats["dropped"] += 1
+                metrics.increment("dedup_dropped")
+                if log:
+                    log.write(json.dumps({"filename": filename, "duplicate_of": run_head, "signature": signature}) + "\n")
+                continue
+
+            stats["kept"] += 1
+            yield filename, content
+    finally:
+        if log:
+            log.close()
+        if stats["kept"] + stats["dropped"]:
+            print(f"Dedup kept {stats['kept']} captures and dropped {stats['dropped']} near-duplicates")
+
+def get_deduplicated_files(input_directory, max_run=1, log_path=None, workers=1):
+    """Returns the set of capture filenames dedup_captures keeps for input_directory."""
+    # Deferred so sliding_window can import this module
+    from sliding_window import iter_captures
+
+    key = (input_directory, max_run)
+    if key not in _kept_files:
+        _kept_files[key] = {filename for filename, _ in dedup_captures(iter_captures(input_directory), max_run, log_path, workers=workers)}
+    return _kept_files[key]
+
+def main():
+    from sliding_window import iter_captures
+
+    parser = argparse.ArgumentParser(description='Report (and log) near-duplicate captures that dedup would drop.')
+    parser.add_argument('--input-dir', type=str, default="./input", help='Path to the capture directory or capture store.')
+    parser.add_argument('--max-run', type=int, default=1, help='Captures kept from each run of near-duplicates.')
+    parser.add_argument('--log', type=str, default=None, help='Write dropped captures to this JSON lines file.')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes used to parse captures.')
+    args = parser.parse_args()
+
+    stats = {}
+    for _ in dedup_captures(iter_captures(args.input_dir), args.max_run, args.log, stats, args.workers):
+        pass
+    print(json.dumps(stats))
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,15 @@
 import argparse
-import os
+import json
+import time
 import random
 import torch
 from datasets import Dataset
 from unsloth import FastLanguageModel
 from unsloth.chat_templates import get_chat_template
-from util import get_unique_function
+from util import get_unique_function, split_assistant_text, sample_eval_indices, parameters_match
+from capture_util import extract_action_block, parse_action
+from compact_state import expand_action
+from action_decoding import get_action_generation_kwargs
 
 def run_eval(model, tokenizer, dataset):
     unique_functions = get_unique_function(dataset)
@@ -40,6 +44,7 @@ def run_eval(model, tokenizer, dataset):
                 top_p=0.95,
                 temperature=0.8,
                 eos_token_id=tokenizer.eos_token_id,
+                **get_action_generation_kwargs(tokenizer, inputs['input_ids'].shape[1]),
             )
         FastLanguageModel.for_training(model)
 
@@ -58,24 +63,122 @@ def run_eval(model, tokenizer, dataset):
         print("\n" + "="*50 + "\n")
 
 
-def main():
-    parser = argparse.ArgumentParser(description='LLM Eval')
-    parser.add_argument('--model-dir', type=str, default="./output/model", help='Path to the directory containing the model.')
-    parser.add_argument('--dataset-dir', type=str, default="./output/dataset", help='Path to the dataset directory.')
-
-    args = parser.parse_args()
+def generate_batch(model, tokenizer, prompts, max_new_tokens, constrained=False):
+    inputs = tokenizer(prompts, return_tensors="pt", padding=True, add_special_tokens=False).to(model.device)
+    prompt_length = inputs['input_ids'].shape[1]
 
-    model_dir = args.model_dir
-    dataset_dir = args.dataset_dir
+    with torch.no_grad():
+        outputs = model.generate(
+            input_ids=inputs['input_ids'],
+            attention_mask=inputs['attention_mask'],
+            max_new_tokens=max_new_tokens,
+            do_sample=False,
+            eos_token_id=tokenizer.eos_token_id,
+            pad_token_id=tokenizer.pad_token_id,
+            **get_action_generation_kwargs(tokenizer, prompt_length, constrained),
+        )
 
-    # Load the model and tokenizer
+    generated = outputs[:, prompt_length:]
+    texts = tokenizer.batch_decode(generated, skip_special_tokens=True)
+    token_counts = [int((sequence != tokenizer.pad_token_id).sum()) for sequence in generated]
+    return texts, token_counts
+
+def run_batched_eval(model, tokenizer, dataset, num_samples=1000, batch_size=16, max_new_tokens=512, seed=0, output_path=None, constrained=False):
+    """
+    Generates predictions for a held-out sample in padded batches, stopping each
+    batch as soon as its action blocks are complete, and reports per-function
+    accuracy, latency and throughput. With `constrained`, the action block is
+    decoded under the action grammar.
+    """
+    indices = sample_eval_indices(dataset, num_samples, seed)
+    print(f"Evaluating {len(indices)} samples in batches of {batch_size}...")
+
+    padding_side = tokenizer.padding_side
+    tokenizer.padding_side = "left"
+    if tokenizer.pad_token_id is None:
+        tokenizer.pad_token = tokenizer.eos_token
+
+    per_function = {}
+    predictions = []
+
+    FastLanguageModel.for_inference(model)
+    try:
+        for start in range(0, len(indices), batch_size):
+            batch_indices = indices[start:start+batch_size]
+            prompts, expected = [], []
+            for idx in batch_indices:
+                prompt_text, assistant_text = split_assistant_text(dataset[idx]['text'])
+                prompts.append(prompt_text)
+                expected.append(parse_action(expand_action(assistant_text)))
+
+            batch_start = time.perf_counter()
+            texts, token_counts = generate_batch(model, tokenizer, prompts, max_new_tokens, constrained)
+            latency = time.perf_counter() - batch_start
+
+            for idx, (expected_function, expected_parameters), text, tokens in zip(batch_indices, expected, texts, token_counts):
+                predicted_function, predicted_parameters = parse_action(expand_action(text))
+                function_correct = predicted_function == expected_function
+                exact = function_correct and parameters_match(expected_parameters, predicted_parameters)
+
+                stats = per_function.setdefault(expected_function, {"samples": 0, "function_correct": 0, "exact_match": 0, "parse_errors": 0, "tokens": 0, "latency_s": 0.0})
+                stats["samples"] += 1
+                stats["function_correct"] += int(function_correct)
+                stats["exact_match"] += int(exact)
+                stats["parse_errors"] += int(predicted_function is None)
+                stats["tokens"] += tokens
+                # Batch latency is shared by every sample generated in that batch
+                stats["latency_s"] += latency / len(batch_indices)
+
+                predictions.append({
+                    "index": idx,
+                    "expected": {"function": expected_function, "parameters": expected_parameters},
+                    "predicted": {"function": predicted_function, "parameters": predicted_parameters},
+                    "action_block": extract_action_block(expand_action(text)),
+                })
+
+            print(f"Evaluated {min(start + batch_size, len(indices))}/{len(indices)} ({latency:.2f}s for batch)")
+    finally:
+        FastLanguageModel.for_training(model)
+        tokenizer.padding_side = padding_side
+
+    def summarize(stats):
+        return {
+            "samples": stats["samples"],
+            "function_accuracy": stats["function_correct"] / max(1, stats["samples"]),
+            "exact_match": stats["exact_match"] / max(1, stats["samples"]),
+            "parse_errors": stats["parse_errors"],
+            "mean_latency_s": stats["latency_s"] / max(1, stats["samples"]),
+            "tokens_per_second": stats["tokens"] / max(1e-9, stats["latency_s"]),
+        }
+
+    totals = {"samples": 0, "function_correct": 0, "exact_match": 0, "parse_errors": 0, "tokens": 0, "latency_s": 0.0}
+    for stats in per_function.values():
+        for key in totals:
+            totals[key] += stats[key]
+
+    report = {
+        "constrained": constrained,
+        "overall": summarize(totals),
+        "per_function": {str(function): summarize(stats) for function, stats in sorted(per_function.items(), key=lambda item: str(item[0]))},
+        "predictions": predictions,
+    }
+
+    print(json.dumps({"overall": report["overall"], "per_function": report["per_function"]}, indent=2))
+    if output_path:
+        with open(output_path, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Eval report saved to {output_path}")
+
+    return report
+
+def load_eval_model(model_dir):
+    """Loads a merged model, adapter or trainer checkpoint for inference with the training chat template."""
     model, tokenizer = FastLanguageModel.from_pretrained(
         model_dir,
         max_seq_length=2048,
         load_in_4bit=True,
         dtype=None,
     )
-    
 
     # Re-apply the chat template to the tokenizer
     tokenizer = get_chat_template(
@@ -83,6 +186,26 @@ def main():
         mapping={"role": "from", "content": "value", "user": "human", "assistant": "gpt"},
         chat_template="chatml",
     )
+    return model, tokenizer
+
+def main():
+    parser = argparse.ArgumentParser(description='LLM Eval')
+    parser.add_argument('--model-dir', type=str, default="./output/model", help='Path to the directory containing the model.')
+    parser.add_argument('--dataset-dir', type=str, default="./output/dataset", help='Path to the dataset directory.')
+    parser.add_argument('--batched', action='store_true', help='Run the batched, metric-producing evaluation.')
+    parser.add_argument('--num-samples', type=int, default=1000, help='Number of samples for batched evaluation.')
+    parser.add_argument('--batch-size', type=int, default=16, help='Prompts generated together in batched evaluation.')
+    parser.add_argument('--max-new-tokens', type=int, default=512, help='Generation cap for batched evaluation.')
+    parser.add_argument('--constrained', action='store_true', help='Constrain generated action blocks to the action schema.')
+    parser.add_argument('--output-json', type=str, default=None, help='Path to write the batched evaluation report.')
+
+    args = parser.parse_args()
+
+    model_dir = args.model_dir
+    dataset_dir = args.dataset_dir
+
+    # Load the model and tokenizer
+    model, tokenizer = load_eval_model(model_dir)
 
     # Load the dataset
     dataset = Dataset.load_from_disk(dataset_dir)
@@ -92,7 +215,10 @@ def main():
         print("The dataset is empty. Cannot proceed with evaluation.")
         return
 
-    run_eval(model, tokenizer, dataset)
+    if args.batched:
+        run_batched_eval(model, tokenizer, dataset, args.num_samples, args.batch_size, args.max_new_tokens, output_path=args.output_json, constrained=args.constrained)
+    else:
+        run_eval(model, tokenizer, dataset)
     
 
 if __name__ == "__main__":
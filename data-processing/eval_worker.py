@@ -0,0 +1,166 @@
+import os
+import glob
+import json
+import time
+import argparse
+from collections import Counter
+
+EVAL_LOG_FILENAME = "eval_metrics.jsonl"
+DEFAULT_MAX_ATTEMPTS = 3
+
+# Directories train.py writes adapters to: per-epoch adapters and the trainer's own checkpoints
+CHECKPOINT_PATTERNS = ["adapter-*", "checkpoints-*/checkpoint-*"]
+
+def is_checkpoint_complete(path, settle_s):
+    """
+    True once a checkpoint has its adapter and the file written after it: the
+    trainer state for trainer checkpoints, the tokenizer for saved adapters.
+    """
+    if not os.path.exists(os.path.join(path, "adapter_config.json")):
+        return False
+    if not any(os.path.exists(os.path.join(path, name)) for name in ("adapter_model.safetensors", "adapter_model.bin")):
+        return False
+    if not any(os.path.exists(os.path.join(path, name)) for name in ("trainer_state.json", "tokenizer_config.json")):
+        return False
+    return time.time() - max(os.path.getmtime(entry.path) for entry in os.scandir(path)) >= settle_s
+
+def find_checkpoints(output_dir, settle_s=10.0):
+    """Complete checkpoints under output_dir, oldest first."""
+    paths = {path for pattern in CHECKPOINT_PATTERNS for path in glob.glob(os.path.join(output_dir, pattern)) if os.path.isdir(path)}
+    return sorted((path for path in paths if is_checkpoint_complete(path, settle_s)), key=os.path.getmtime)
+
+def get_checkpoint_key(checkpoint, output_dir):
+    """A checkpoint's path relative to output_dir, the same however or wherever output_dir is mounted."""
+    return os.path.relpath(os.path.abspath(checkpoint), os.path.abspath(output_dir))
+
+def is_transient_error(e):
+    """Errors worth retrying later: running out of (GPU) memory, and I/O or connection hiccups."""
+    return isinstance(e, (MemoryError, ConnectionError, TimeoutError)) or "out of memory" in str(e).lower()
+
+def load_evaluated(log_path, output_dir, retry_failed=False, max_attempts=DEFAULT_MAX_ATTEMPTS):
+    """
+    Keys of the checkpoints the log says not to evaluate again: those with
+    metrics, and failures that are not retried. Transient failures (or every
+    failure, with retry_failed) are retried until max_attempts have failed.
+    """
+    evaluated = set()
+    failures = Counter()
+    retryable = {}
+    if os.path.exists(log_path):
+        with open(log_path, 'r') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                key = entry["checkpoint"]
+                if os.path.isabs(key) or (not os.path.exists(os.path.join(output_dir, key)) and os.path.exists(key)):
+                    # Entries written before the log was keyed relative to output_dir
+                    key = get_checkpoint_key(key, output_dir)
+                if "error" in entry:
+                    failures[key] += 1
+                    retryable[key] = retry_failed or entry.get("transient", False)
+                else:
+                    evaluated.add(key)
+
+    for key, count in failures.items():
+        if not retryable[key] or count >= max_attempts:
+            evaluated.add(key)
+    return evaluated
+
+def get_global_step(checkpoint):
+    state_path = os.path.join(checkpoint, "trainer_state.json")
+    if not os.path.exists(state_path):
+        return None
+    with open(state_path, 'r') as f:
+        return json.load(f).get("global_step")
+
+def evaluate_checkpoint(checkpoint, dataset, num_samples, batch_size, max_new_tokens, seed, constrained=False, predictions_dir=None):
+    """Loads the checkpoint on its own, runs the batched eval and returns the log entry."""
+    # Deferred so the watcher can be started (and --help shown) without a GPU stack
+    import gc
+    import torch
+    from eval import load_eval_model, run_batched_eval
+
+    start = time.perf_counter()
+    model, tokenizer = load_eval_model(checkpoint)
+    output_path = None
+    if predictions_dir:
+        os.makedirs(predictions_dir, exist_ok=True)
+        output_path = os.path.join(predictions_dir, f"{os.path.basename(os.path.dirname(checkpoint))}-{os.path.basename(checkpoint)}.json")
+    try:
+        report = run_batched_eval(model, tokenizer, dataset, num_samples, batch_size, max_new_tokens, seed, output_path, constrained)
+    finally:
+        del model
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    return {
+        "checkpoint": checkpoint,
+        "global_step": get_global_step(checkpoint),
+        "checkpoint_mtime": os.path.getmtime(checkpoint),
+        "evaluated_at": time.time(),
+        "eval_seconds": time.perf_counter() - start,
+        "num_samples": num_samples,
+        "seed": seed,
+        "constrained": constrained,
+        "overall": report["overall"],
+        "per_function": report["per_function"],
+    }
+
+def watch(output_dir, dataset_dir, log_path, num_samples=200, batch_size=16, max_new_tokens=512, seed=0, constrained=False,
+          poll_interval=60.0, settle_s=10.0, predictions_dir=None, once=False, retry_failed=False, max_attempts=DEFAULT_MAX_ATTEMPTS):
+    """
+    Evaluates every complete checkpoint under output_dir that is not yet in the
+    log, oldest first, and appends one JSON line per checkpoint, keyed by its
+    path relative to output_dir. The same seed is used for every checkpoint so
+    results are comparable across them.
+    """
+    from dataset_writer import load_dataset_with_deltas
+
+    dataset = load_dataset_with_deltas(dataset_dir)
+    print(f"Watching {output_dir} for checkpoints; logging to {log_path}...")
+    while True:
+        evaluated = load_evaluated(log_path, output_dir, retry_failed, max_attempts)
+        for checkpoint in find_checkpoints(output_dir, settle_s):
+            key = get_checkpoint_key(checkpoint, output_dir)
+            if key in evaluated:
+                continue
+            print(f"Evaluating {checkpoint}...")
+            try:
+                entry = evaluate_checkpoint(checkpoint, dataset, num_samples, batch_size, max_new_tokens, seed, constrained, predictions_dir)
+            except Exception as e:
+                # Logged so a broken checkpoint is not retried forever; transient failures are retried on a later scan
+                entry = {"evaluated_at": time.time(), "error": f"{type(e).__name__}: {e}", "transient": is_transient_error(e)}
+                print(f"Eval failed for {checkpoint}: {entry['error']}")
+            entry["checkpoint"] = key
+            with open(log_path, 'a') as f:
+                f.write(json.dumps(entry) + "\n")
+        if once:
+            return
+        time.sleep(poll_interval)
+
+def main():
+    parser = argparse.ArgumentParser(description='Evaluate the checkpoints train.py writes as they appear, outside the training process.')
+    parser.add_argument('--output-dir', type=str, default="./output", help='Directory train.py writes checkpoints and adapters to.')
+    parser.add_argument('--dataset-dir', type=str, default="./output/dataset", help='Path to the dataset directory.')
+    parser.add_argument('--log', type=str, default=None, help=f'JSON lines metrics log (default: <output-dir>/{EVAL_LOG_FILENAME}).')
+    parser.add_argument('--num-samples', type=int, default=200, help='Samples evaluated per checkpoint.')
+    parser.add_argument('--batch-size', type=int, default=16, help='Prompts generated together.')
+    parser.add_argument('--max-new-tokens', type=int, default=512, help='Generation cap per sample.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the eval sample, shared by every checkpoint.')
+    parser.add_argument('--constrained', action='store_true', help='Constrain generated action blocks to the action schema.')
+    parser.add_argument('--poll-interval', type=float, default=60.0, help='Seconds between scans for new checkpoints.')
+    parser.add_argument('--settle', type=float, default=10.0, help='Seconds a checkpoint must be unmodified before it is evaluated.')
+    parser.add_argument('--predictions-dir', type=str, default=None, help='Also write each full eval report (with predictions) here.')
+    parser.add_argument('--once', action='store_true', help='Evaluate the checkpoints present now and exit.')
+    parser.add_argument('--retry-failed', action='store_true', help='Also retry checkpoints whose eval failed with a non-transient error.')
+    parser.add_argument('--max-attempts', type=int, default=DEFAULT_MAX_ATTEMPTS, help='Failed evals of one checkpoint before it is no longer retried.')
+    args = parser.parse_args()
+
+    log_path = args.log or os.path.join(args.output_dir, EVAL_LOG_FILENAME)
+    watch(args.output_dir, args.dataset_dir, log_path, args.num_samples, args.batch_size, args.max_new_tokens, args.seed,
+          args.constrained, args.poll_interval, args.settle, args.predictions_dir, args.once, args.retry_failed, args.max_attempts)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,264 @@
+import os
+import json
+import time
+import socket
+import argparse
+import subprocess
+import requests
+from capture_util import parse_action
+from compact_state import expand_action
+from util import find_latest_model, split_assistant_text, sample_eval_indices, parameters_match
+
+# Longest a single held-out generation may take before it is counted as a timeout
+DEFAULT_REQUEST_TIMEOUT_S = 300
+
+# Quantizations exported by default, from largest to smallest
+QUANTIZATIONS = ["q8_0", "q6_k", "q5_k_m", "q4_k_m"]
+
+# The chatml layout the model is trained on (see util.load_models); Ollama fills in .System and .Prompt
+MODELFILE_TEMPLATE = '''FROM ./{gguf_filename}
+TEMPLATE """{{{{ if .System }}}}<|im_start|>system
+{{{{ .System }}}}<|im_end|>
+{{{{ end }}}}<|im_start|>user
+{{{{ .Prompt }}}}<|im_end|>
+<|im_start|>assistant
+"""
+PARAMETER stop "<|im_end|>"
+PARAMETER stop "<|im_start|>"
+PARAMETER temperature 0
+PARAMETER num_predict {num_predict}
+PARAMETER num_ctx {num_ctx}
+'''
+
+def find_llama_cpp_binary(llama_cpp_dir, name):
+    # Makefile builds put the tools at the top of the checkout, CMake builds under build/bin
+    for path in (os.path.join(llama_cpp_dir, name), os.path.join(llama_cpp_dir, "build", "bin", name)):
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    raise Exception(f"{name} not found in {llama_cpp_dir}; build llama.cpp first.")
+
+def gguf_path(gguf_dir, model_name, quantization):
+    # Same naming as save_gguf.sh, so both write to (and skip) the same files
+    return os.path.join(gguf_dir, f"{model_name}-gguf.{quantization}.gguf")
+
+def convert_to_gguf(model_dir, gguf_dir, llama_cpp_dir):
+    """Converts the merged HF model to an f16 GGUF, the input for every quantization."""
+    model_name = os.path.basename(model_dir.rstrip(os.sep))
+    outfile = gguf_path(gguf_dir, model_name, "f16")
+    if not os.path.exists(outfile):
+        print(f"Converting {model_dir} to {outfile}...")
+        subprocess.run(
+            ["python3", os.path.join(llama_cpp_dir, "convert_hf_to_gguf.py"), f"{model_dir}/", "--outtype", "f16", "--outfile", outfile],
+            check=True,
+        )
+    return outfile
+
+def quantize(f16_path, quantization, llama_cpp_dir):
+    outfile = f16_path.replace(".f16.gguf", f".{quantization}.gguf")
+    if not os.path.exists(outfile):
+        print(f"Quantizing {f16_path} to {quantization}...")
+        subprocess.run([find_llama_cpp_binary(llama_cpp_dir, "llama-quantize"), f16_path, outfile, quantization.upper()], check=True)
+    return outfile
+
+def write_modelfile(path, gguf_file, num_predict=256, num_ctx=4096):
+    with open(path, 'w') as f:
+        f.write(MODELFILE_TEMPLATE.format(gguf_filename=os.path.basename(gguf_file), num_predict=num_predict, num_ctx=num_ctx))
+    return path
+
+def run_llama_bench(gguf_file, llama_cpp_dir, threads, n_prompt=512, n_gen=128):
+    """Prompt processing and generation tokens per second from llama-bench on the CPU."""
+    completed = subprocess.run(
+        [find_llama_cpp_binary(llama_cpp_dir, "llama-bench"), "-m", gguf_file, "-p", str(n_prompt), "-n", str(n_gen), "-t", str(threads), "-ngl", "0", "-o", "json"],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=True,
+    )
+    results = {}
+    for test in json.loads(completed.stdout):
+        # llama-bench reports prompt processing (n_gen == 0) and generation (n_prompt == 0) as separate tests
+        name = "prompt_tokens_per_s" if test["n_gen"] == 0 else "generation_tokens_per_s"
+        results[name] = test["avg_ts"]
+    return results
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+class LlamaServer:
+    """A llama-server process for one GGUF file, serving /completion on a free local port."""
+
+    def __init__(self, gguf_file, llama_cpp_dir, threads, num_ctx=4096, startup_timeout=300):
+        self.port = _free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.process = subprocess.Popen(
+            [find_llama_cpp_binary(llama_cpp_dir, "llama-server"), "-m", gguf_file, "--host", "127.0.0.1", "--port", str(self.port),
+             "-c", str(num_ctx), "-t", str(threads), "-ngl", "0"],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        deadline = time.time() + startup_timeout
+        while True:
+            try:
+                if requests.get(f"{self.url}/health", timeout=5).status_code == 200:
+                    break
+            except requests.exceptions.RequestException:
+                pass
+            if self.process.poll() is not None or time.time() > deadline:
+                self.close()
+                raise Exception(f"llama-server failed to start for {gguf_file}")
+            time.sleep(0.5)
+
+    def complete(self, prompt, max_new_tokens, timeout=DEFAULT_REQUEST_TIMEOUT_S):
+        response = requests.post(f"{self.url}/completion", json={
+            "prompt": prompt,
+            "n_predict": max_new_tokens,
+            "temperature": 0,
+            "stop": ["<|im_end|>", "<|im_start|>"],
+            "cache_prompt": True,
+        }, timeout=timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def close(self):
+        self.process.terminate()
+        self.process.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def evaluate_gguf(gguf_file, samples, llama_cpp_dir, threads, max_new_tokens=256, request_timeout=DEFAULT_REQUEST_TIMEOUT_S):
+    """
+    Greedy predictions for (prompt, expected_function, expected_parameters)
+    samples served by llama-server; returns function accuracy, exact match,
+    parse errors, timeouts and mean latency. A timed out sample counts as wrong.
+    """
+    function_correct = exact = parse_errors = timeouts = 0
+    latencies = []
+    with LlamaServer(gguf_file, llama_cpp_dir, threads) as server:
+        for prompt, expected_function, expected_parameters in samples:
+            start = time.perf_counter()
+            try:
+                text = server.complete(prompt, max_new_tokens, request_timeout)["content"]
+            except requests.exceptions.Timeout:
+                timeouts += 1
+                continue
+            finally:
+                latencies.append(time.perf_counter() - start)
+
+            predicted_function, predicted_parameters = parse_action(expand_action(text))
+            if predicted_function is None:
+                parse_errors += 1
+            if predicted_function == expected_function:
+                function_correct += 1
+                exact += parameters_match(expected_parameters, predicted_parameters)
+
+    count = max(1, len(samples))
+    return {
+        "samples": len(samples),
+        "function_accuracy": function_correct / count,
+        "exact_match": exact / count,
+        "parse_errors": parse_errors,
+        "timeouts": timeouts,
+        "mean_latency_s": sum(latencies) / count,
+    }
+
+def load_held_out_samples(input_dir, dataset_dir, model_dir, num_samples, seed=0):
+    """
+    (prompt, expected_function, expected_parameters) for windows ending at
+    captures newer than the dataset's high-water mark, which training never saw.
+    The windows are built with the dataset's recorded settings and templated
+    with the model's tokenizer, then sampled evenly across functions.
+    """
+    from datasets import Dataset
+    from transformers import AutoTokenizer
+    from capture_index import load_capture_index
+    from dataset_writer import load_ingest_state, template_rows
+    from ingest import find_after_high_water, window_conversations_between
+
+    state = load_ingest_state(dataset_dir)
+    if state["high_water"] is None:
+        raise Exception(f"{dataset_dir} has no recorded high-water mark, so held-out captures cannot be told apart from training ones.")
+
+    captures = load_capture_index(input_dir)
+    start = find_after_high_water(captures, state["high_water"])
+    print(f"{len(captures) - start} held-out captures in {input_dir} after {state['high_water']}")
+    if start == len(captures):
+        return []
+
+    tokenizer = AutoTokenizer.from_pretrained(model_dir)
+    conversations = window_conversations_between(tokenizer, input_dir, captures, start, len(captures), state["settings"])
+    held_out = Dataset.from_list(template_rows(tokenizer, conversations))
+
+    samples = []
+    for idx in sample_eval_indices(held_out, num_samples, seed):
+        prompt_text, assistant_text = split_assistant_text(held_out[idx]['text'])
+        samples.append((prompt_text, *parse_action(expand_action(assistant_text))))
+    return samples
+
+def pick_quantization(results, max_accuracy_drop):
+    """The quantization with the fastest generation whose function accuracy is within max_accuracy_drop of f16."""
+    baseline = results.get("f16", {}).get("eval", {}).get("function_accuracy")
+    candidates = [
+        quantization for quantization, result in results.items()
+        if baseline is None or "eval" not in result or result["eval"]["function_accuracy"] >= baseline - max_accuracy_drop
+    ]
+    return max(candidates, key=lambda q: results[q].get("bench", {}).get("generation_tokens_per_s", 0), default=None)
+
+def main():
+    parser = argparse.ArgumentParser(description='Export a merged model to quantized GGUF files with Modelfiles, and benchmark each quantization on the CPU.')
+    parser.add_argument('--model-dir', type=str, default=None, help='Merged model directory (default: the latest model in --output-dir).')
+    parser.add_argument('--output-dir', type=str, default="./output", help='Directory train.py writes merged models to.')
+    parser.add_argument('--llama-cpp-dir', type=str, default="llama.cpp", help='llama.cpp checkout with its tools built.')
+    parser.add_argument('--quantizations', type=str, nargs='+', default=QUANTIZATIONS, help='llama-quantize types to export besides f16.')
+    parser.add_argument('--dataset-dir', type=str, default=None, help='Dataset the model was trained on; captures after its high-water mark are held out for action accuracy (skipped when unset).')
+    parser.add_argument('--input-dir', type=str, default="./input", help='Capture directory the dataset was built from.')
+    parser.add_argument('--num-samples', type=int, default=200, help='Held-out windows evaluated per quantization.')
+    parser.add_argument('--request-timeout', type=float, default=DEFAULT_REQUEST_TIMEOUT_S, help='Seconds one held-out generation may take before it counts as a timeout.')
+    parser.add_argument('--max-new-tokens', type=int, default=256, help='Generation cap for evaluation and the Modelfile num_predict.')
+    parser.add_argument('--max-accuracy-drop', type=float, default=0.02, help='Largest function accuracy drop from f16 allowed for the recommended quantization.')
+    parser.add_argument('--threads', type=int, default=os.cpu_count(), help='CPU threads for benchmarking and evaluation.')
+    parser.add_argument('--skip-bench', action='store_true', help='Only export; do not run llama-bench.')
+    args = parser.parse_args()
+
+    model_dir = args.model_dir or find_latest_model(args.output_dir)
+    if model_dir is None:
+        raise Exception(f"No merged model found in {args.output_dir}")
+    model_dir = model_dir.rstrip(os.sep)
+    gguf_dir = f"{model_dir}-gguf"
+    os.makedirs(gguf_dir, exist_ok=True)
+
+    f16_path = convert_to_gguf(model_dir, gguf_dir, args.llama_cpp_dir)
+    files = {"f16": f16_path}
+    for quantization in args.quantizations:
+        files[quantization] = quantize(f16_path, quantization, args.llama_cpp_dir)
+
+    samples = load_held_out_samples(args.input_dir, args.dataset_dir, model_dir, args.num_samples) if args.dataset_dir else []
+    if args.dataset_dir and not samples:
+        print("No held-out captures after the dataset's high-water mark; skipping accuracy evaluation.")
+
+    results = {}
+    for quantization, gguf_file in files.items():
+        result = {"file": gguf_file, "size_bytes": os.path.getsize(gguf_file)}
+        result["modelfile"] = write_modelfile(os.path.join(gguf_dir, f"Modelfile.{quantization}"), gguf_file, args.max_new_tokens)
+        if not args.skip_bench:
+            print(f"Benchmarking {quantization}...")
+            result["bench"] = run_llama_bench(gguf_file, args.llama_cpp_dir, args.threads)
+            if samples:
+                result["eval"] = evaluate_gguf(gguf_file, samples, args.llama_cpp_dir, args.threads, args.max_new_tokens, args.request_timeout)
+        results[quantization] = result
+        print(json.dumps({quantization: result}, indent=2))
+
+    recommended = pick_quantization(results, args.max_accuracy_drop) if not args.skip_bench else None
+    if recommended:
+        write_modelfile(os.path.join(gguf_dir, "Modelfile"), files[recommended], args.max_new_tokens)
+
+    report_path = os.path.join(gguf_dir, "export_report.json")
+    with open(report_path, 'w') as f:
+        json.dump({"model_dir": model_dir, "threads": args.threads, "held_out_samples": len(samples), "recommended": recommended, "quantizations": results}, f, indent=2)
+    print(f"Wrote {report_path}")
+    if recommended:
+        print(f"Recommended quantization: {recommended}. Load it with: ollama create minecraft-ai -f {os.path.join(gguf_dir, 'Modelfile')}")
+
+if __name__ == '__main__':
+    main()
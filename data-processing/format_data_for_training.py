@@ -2,6 +2,45 @@ import argparse
 import os
 import yaml
 import json
+import itertools
+import metrics
+from datetime import datetime
+from multiprocessing import Pool
+from capture_util import extract_timestamp
+
+# Prefer the LibYAML-backed loader when PyYAML was built with it
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# Items handed to the pool at a time by imap_ordered, which bounds how much of a stream is held in memory
+POOL_BATCH_SIZE = 4096
+
+def parse_capture(content):
+    # Timings recorded in pool workers stay in the worker; only serial parses reach the report
+    with metrics.timed("parse"):
+        return yaml.load(content, Loader=YamlLoader) or {}
+
+def imap_ordered(func, items, workers=1, batch_size=POOL_BATCH_SIZE):
+    """
+    Yields func(item) for each item in order. With workers > 1 the items are
+    read in batches and each batch is mapped in a process pool, so a stream of
+    captures is parsed in parallel without being read into memory whole.
+    """
+    if workers <= 1:
+        yield from map(func, items)
+        return
+
+    items = iter(items)
+    with Pool(workers) as pool:
+        while True:
+            batch = list(itertools.islice(items, batch_size))
+            if not batch:
+                return
+            yield from pool.map(func, batch, max(1, len(batch) // (workers * 4)))
+
+def _capture_order(filename):
+    # Timestamp order, as in the capture index; names without a timestamp go last, by name
+    timestamp = extract_timestamp(os.path.basename(filename))
+    return (timestamp is None, timestamp or datetime.min, filename)
 
 def find_action_paths(data, path=[]):
     paths = []
@@ -31,8 +70,9 @@ def process_yaml_file(file_path):
     with open(file_path, 'r') as f:
         data = f.read()
 
-    # Parse the data using yaml.safe_load
-    parsed_data = yaml.safe_load(data)
+    # Parse the data using the safe loader (C accelerated when available)
+    with metrics.timed("parse"):
+        parsed_data = yaml.load(data, Loader=YamlLoader)
 
     # Find all action paths
     action_paths = find_action_paths(parsed_data)
@@ -65,35 +105,58 @@ def process_yaml_file(file_path):
 
     return output
 
+def _process_yaml_file_safe(file_path):
+    try:
+        return file_path, process_yaml_file(file_path), None
+    except Exception as e:
+        return file_path, None, e
+
+def process_yaml_files(file_paths, workers=1):
+    """
+    Yields (file_path, output, error) for each file in the order given. With
+    workers > 1 the files are split into chunks and parsed in a process pool.
+    """
+    if workers <= 1:
+        yield from map(_process_yaml_file_safe, file_paths)
+        return
+
+    chunksize = max(1, len(file_paths) // (workers * 4))
+    with Pool(workers) as pool:
+        yield from pool.imap(_process_yaml_file_safe, file_paths, chunksize)
+
 def main():
     parser = argparse.ArgumentParser(description='Process YAML files to prepare them for LLM training.')
     parser.add_argument('--input-dir', type=str, default="./input", help='Path to the input directory containing YAML files.')
     parser.add_argument('--output-dir', type=str, default="./output", help='Path to the output directory to save combined files.')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes used to parse YAML files.')
     args = parser.parse_args()
 
     input_dir = args.input_dir
     output_dir = args.input_dir
+    workers = args.workers
 
     # Ensure the input directory exists
     if not os.path.isdir(input_dir):
         print(f"Error: The directory '{input_dir}' does not exist.")
         return
 
-    # Collect all YAML files in the input directory
-    yaml_files = [
-        os.path.join(input_dir, f)
-        for f in os.listdir(input_dir)
-        if f.endswith(('.yaml', '.yml'))
-    ]
+    # Collect all YAML files in the input directory, in timestamp order (a whole second's
+    # name, without a fraction, sorts after its fractional seconds by name alone)
+    yaml_files = sorted(
+        (os.path.join(input_dir, f) for f in os.listdir(input_dir) if f.endswith(('.yaml', '.yml'))),
+        key=_capture_order,
+    )
 
     if not yaml_files:
         print(f"No YAML files found in directory '{input_dir}'.")
         return
 
-    for file_path in yaml_files:
+    for file_path, output, error in process_yaml_files(yaml_files, workers):
+        if error is not None:
+            print(f"Error processing file '{file_path}': {error}")
+            continue
         try:
             output_filename, ext = os.path.splitext(os.path.basename(file_path))
-            output = process_yaml_file(file_path)
             output_filename = f'{output_filename}.json'
             output_filepath = os.path.join(output_dir, output_filename)
             with open(output_filepath, 'w') as output_file:
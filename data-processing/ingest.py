@@ -0,0 +1,233 @@
+import os
+import time
+import bisect
+import shutil
+import argparse
+import itertools
+from collections import deque
+import metrics
+from capture_index import load_capture_index
+from capture_util import extract_timestamp
+from sliding_window import iter_captures, read_file_content
+from dedup import dedup_captures, capture_signature
+from dataset_writer import template_rows, load_ingest_state, save_ingest_state, get_deltas_dir
+from token_budget import iter_budget_window_texts
+from create_dataset import window_samples, split_window_samples, window_conversations, get_token_budget, DEFAULT_PRE
+
+# Captures modified more recently than this may still be being written by the mod
+DEFAULT_SETTLE_S = 2.0
+DEFAULT_POLL_INTERVAL_S = 30.0
+
+def _capture_key(filename):
+    # Same ordering as the capture index: (timestamp, filename)
+    return (extract_timestamp(filename).isoformat(timespec='microseconds'), filename)
+
+def find_after_high_water(captures, high_water):
+    """Index of the first capture in the sorted capture index newer than high_water."""
+    if not high_water:
+        return 0
+    keys = [(capture.timestamp, capture.filename) for capture in captures]
+    return bisect.bisect_right(keys, _capture_key(high_water))
+
+def find_dedup_start(input_dir, captures, start, context, max_run=1):
+    """
+    Index of a capture a dedup pass can start from and keep the same captures
+    after it as a pass over every capture: the start of a run of near-duplicates
+    with at least `context` kept captures between it and captures[start]. The
+    captures before start are read back one at a time until one is found.
+    """
+    first = start
+    kept = 0
+    run_signature, run_length = None, 0
+    while first > 0:
+        with metrics.timed("read"):
+            content = read_file_content(os.path.join(input_dir, captures[first - 1].filename))
+        signature = capture_signature(content)
+        if run_length and signature != run_signature:
+            # captures[first] starts a run, so a pass starting there has the same state as a full one
+            kept += min(run_length, max_run)
+            if kept >= context:
+                break
+            run_length = 0
+        run_signature = signature
+        run_length += 1
+        first -= 1
+    return first
+
+def split_context(captures, before, context):
+    """
+    Reads the (filename, content) pairs whose filename is in `before` and
+    returns the last `context` of them with an iterator over the pairs after.
+    """
+    recent = deque(maxlen=context)
+    captures = iter(captures)
+    for filename, content in captures:
+        if filename not in before:
+            return list(recent), itertools.chain([(filename, content)], captures)
+        recent.append((filename, content))
+    return list(recent), iter(())
+
+def window_conversations_between(tokenizer, input_dir, dataset_dir, captures, start, end, settings):
+    """
+    The conversations a full build with `settings` has for the windows ending at
+    captures[start:end]. Windows reach back over the captures before start, which
+    only provide context. With dedup, the captures are filtered as the full build
+    filters them and the context is made of kept captures.
+    """
+    window_size = settings["sliding_window_size"]
+    budget = get_token_budget(tokenizer, input_dir, dataset_dir, settings)
+    context = (budget.max_window_size if budget is not None else window_size) - 1
+    if settings.get("dedup"):
+        first = find_dedup_start(input_dir, captures, start, context)
+    else:
+        first = max(0, start - context)
+
+    pairs = iter_captures(input_dir, [capture.filename for capture in captures[first:end]])
+    if settings.get("dedup"):
+        pairs = dedup_captures(pairs)
+    # The captures before start only fill the first windows; their own windows are already in the dataset
+    recent, pairs = split_context(pairs, {capture.filename for capture in captures[first:start]}, context)
+
+    pairs = itertools.chain(recent, pairs)
+    if budget is not None:
+        samples = split_window_samples(iter_budget_window_texts(pairs, budget, True, len(recent)))
+    else:
+        samples = window_samples(pairs, window_size, settings["compact"])
+    return list(window_conversations(samples, settings["pre"]))
+
+def _is_settled(input_dir, capture, settled_before):
+    try:
+        stat = os.stat(os.path.join(input_dir, capture.filename))
+    except FileNotFoundError:
+        return False
+    # A size that differs from the index means the capture was indexed mid-write
+    return stat.st_mtime <= settled_before and stat.st_size == capture.size
+
+def _remove_orphaned_shards(dataset_dir, state):
+    # A shard written before a crash but never recorded in the state would be ingested twice
+    deltas_dir = get_deltas_dir(dataset_dir)
+    known = {shard["name"] for shard in state["shards"]}
+    for name in os.listdir(deltas_dir) if os.path.isdir(deltas_dir) else []:
+        if name.startswith("delta-") and name not in known:
+            shutil.rmtree(os.path.join(deltas_dir, name))
+
+def ingest_new_captures(tokenizer, input_dir, dataset_dir, settings, settle_s=DEFAULT_SETTLE_S):
+    """
+    Appends the windows ending at captures newer than the high-water mark as a
+    new delta shard beside dataset_dir and advances the mark. Windows reach back
+    over the sliding_window_size - 1 (kept, with dedup) captures before the mark,
+    so the rows are exactly those a full rebuild would add (max_window_size - 1
+    for datasets built with a token budget). Returns the number of rows written.
+    """
+    from datasets import Dataset
+
+    state = load_ingest_state(dataset_dir)
+    if state["high_water"] is None and os.path.exists(dataset_dir):
+        raise Exception(f"{dataset_dir} has no recorded high-water mark; rebuild it with create_dataset or pass --high-water.")
+    settings = state["settings"] or settings
+    _remove_orphaned_shards(dataset_dir, state)
+
+    with metrics.timed("listing"):
+        # Listed and stat'd on every pass, since captures arrive (and grow) while the watcher runs
+        captures = load_capture_index(input_dir, check_changes=True)
+    start = find_after_high_water(captures, state["high_water"])
+
+    # Stop at the first capture that may still be being written so the mark never skips one. The
+    # files are stat'd now rather than trusting the index, which was last refreshed when listed
+    settled_before = time.time() - settle_s
+    end = start
+    while end < len(captures) and _is_settled(input_dir, captures[end], settled_before):
+        end += 1
+    if end == start:
+        return 0
+
+    conversations = window_conversations_between(tokenizer, input_dir, dataset_dir, captures, start, end, settings)
+    metrics.increment("captures_ingested", end - start)
+
+    shard = None
+    if conversations:
+        rows = template_rows(tokenizer, conversations)
+        shard = {"name": f"delta-{len(state['shards']):05d}", "rows": len(rows), "first": captures[start].filename, "last": captures[end - 1].filename}
+        shard_path = os.path.join(get_deltas_dir(dataset_dir), shard["name"])
+        with metrics.timed("shard_write"):
+            Dataset.from_list(rows).save_to_disk(shard_path)
+        state["shards"].append(shard)
+        metrics.increment("dataset_rows", len(rows))
+
+    state["high_water"] = captures[end - 1].filename
+    state["settings"] = settings
+    save_ingest_state(dataset_dir, state)
+
+    print(f"Ingested {end - start} captures up to {state['high_water']} ({shard['rows'] if shard else 0} rows)")
+    return shard["rows"] if shard else 0
+
+def _open_inotify(input_dir):
+    # inotify_simple is optional; without it (or off Linux) the watcher polls
+    try:
+        from inotify_simple import INotify, flags
+    except ImportError:
+        return None
+    try:
+        inotify = INotify()
+        inotify.add_watch(input_dir, flags.CLOSE_WRITE | flags.MOVED_TO)
+    except OSError as e:
+        print(f"Unable to watch {input_dir} with inotify ({e}); polling instead.")
+        return None
+    return inotify
+
+def wait_for_captures(inotify, poll_interval, settle_s):
+    if inotify is None:
+        time.sleep(poll_interval)
+        return
+    if inotify.read(timeout=int(poll_interval * 1000)):
+        # Let a burst of writes finish so it lands in one shard
+        time.sleep(settle_s)
+        inotify.read(timeout=0)
+
+def watch(tokenizer, input_dir, dataset_dir, settings, poll_interval=DEFAULT_POLL_INTERVAL_S, settle_s=DEFAULT_SETTLE_S, once=False):
+    """Ingests new captures whenever they arrive (inotify, or polling every poll_interval seconds)."""
+    inotify = None if once else _open_inotify(input_dir)
+    print(f"Watching {input_dir} for new captures ({'inotify' if inotify else f'polling every {poll_interval}s'})...")
+    try:
+        while True:
+            ingest_new_captures(tokenizer, input_dir, dataset_dir, settings, settle_s)
+            if once:
+                return
+            wait_for_captures(inotify, poll_interval, settle_s)
+    finally:
+        if inotify is not None:
+            inotify.close()
+
+def main():
+    from util import load_models
+
+    parser = argparse.ArgumentParser(description='Watch a capture directory and append new windows to a dataset as delta shards.')
+    parser.add_argument('--input-dir', type=str, default="./input", help='Path to the capture directory.')
+    parser.add_argument('--output-dir', type=str, default="./output", help='Directory containing the dataset.')
+    parser.add_argument('--dataset-name', type=str, default="dataset", help='Name of the dataset.')
+    parser.add_argument('--sliding-window-size', type=int, default=3, help='Size of the sliding window (when the dataset has no recorded settings).')
+    parser.add_argument('--pre-prompt', type=str, default=DEFAULT_PRE, help='Prefix to LLM training prompt (when the dataset has no recorded settings).')
+    parser.add_argument('--compact', action='store_true', help='Use the compact delta encoding (when the dataset has no recorded settings).')
+    parser.add_argument('--dedup', action='store_true', help='Drop near-duplicate captures (when the dataset has no recorded settings).')
+    parser.add_argument('--poll-interval', type=float, default=DEFAULT_POLL_INTERVAL_S, help='Seconds between checks without inotify, and the longest wait with it.')
+    parser.add_argument('--settle', type=float, default=DEFAULT_SETTLE_S, help='Seconds a capture must be unmodified before it is ingested.')
+    parser.add_argument('--once', action='store_true', help='Ingest what is there now and exit.')
+    parser.add_argument('--high-water', type=str, default=None, help='Last capture already in the dataset, for datasets built before ingest tracked it.')
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    dataset_dir = os.path.join(args.output_dir, args.dataset_name)
+    settings = {"sliding_window_size": args.sliding_window_size, "pre": args.pre_prompt, "compact": args.compact, "dedup": args.dedup}
+    if args.high_water:
+        state = load_ingest_state(dataset_dir)
+        save_ingest_state(dataset_dir, dict(state, high_water=args.high_water, settings=state["settings"] or settings))
+    _, tokenizer = load_models()
+
+    with metrics.run_metrics(args.metrics_report, args.progress_interval, {"run": "ingest", "dataset": args.dataset_name}):
+        try:
+            watch(tokenizer, args.input_dir, dataset_dir, settings, args.poll_interval, args.settle, args.once)
+        except KeyboardInterrupt:
+            print("Stopped watching.")
+
+if __name__ == '__main__':
+    main()
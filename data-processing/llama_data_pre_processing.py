@@ -1,51 +1,112 @@
 import requests
 import os
+import time
 import argparse
-from util import extract_timestamp
+import itertools
+import threading
+import metrics
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from capture_util import extract_timestamp
+from capture_index import get_sorted_files, get_files_with_function
+from capture_store import is_capture_store, load_store_table, get_store_functions
+from dedup import get_deduplicated_files
 import subprocess
 import re
+import random
 import hashlib
+from response_cache import ResponseCache, make_cache_key
 from llama_prompts import get_random_prompt, get_story_prompts, next_action_preprompt
 
+OLLAMA_RETRIES = 3
+OLLAMA_BACKOFF = 2.0
+
+_session = None
+_session_pool_size = 0
+_session_lock = threading.Lock()
+
+def get_session(pool_size=16):
+    """
+    A single pooled session keeps connections to Ollama alive across requests
+    and threads. The pool only grows: asking for more connections than it holds
+    mounts a larger adapter, so higher concurrency is not capped by an earlier call.
+    """
+    global _session, _session_pool_size
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+        if pool_size > _session_pool_size:
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+            _session_pool_size = pool_size
+        return _session
+
 # Define the function to call Ollama
-def call_ollama(model, prompt):
+def call_ollama(model, prompt, retries=OLLAMA_RETRIES, backoff=OLLAMA_BACKOFF):
     url = f"{os.getenv('OLLAMA_URL')}api/generate"
     payload = {
         "stream": False,
         "model": model,
         "prompt": prompt
     }
+    for attempt in range(retries + 1):
+        if attempt > 0:
+            delay = backoff * (2 ** (attempt - 1))
+            print(f"Retrying Ollama request in {delay:.1f}s (attempt {attempt + 1}/{retries + 1})...")
+            metrics.increment("ollama_retries")
+            time.sleep(delay)
+        try:
+            with metrics.timed("ollama_request"):
+                response = get_session().post(url, json=payload)
+            if response.status_code == 200:
+                response_data = response.json()
+                metrics.increment("ollama_responses")
+                print(f"Generated response for model '{model}':", metrics.preview(response_data.get("response", "No text generated")))
+                return response_data.get("response", "ERROR")
+            else:
+                print(f"Failed to generate response. Status code: {response.status_code}, Response: {response.text}")
+                # Client errors other than rate limiting will not succeed on retry
+                if response.status_code < 500 and response.status_code != 429:
+                    return "ERROR"
+        except requests.exceptions.RequestException as e:
+            print(f"An error occurred: {e}")
+    metrics.increment("ollama_errors")
+    return "ERROR"
+
+def ordered_map(func, items, concurrency=1):
+    """
+    Applies func to each item on a thread pool of `concurrency` workers and yields
+    the results in input order. At most 2 * concurrency items are in flight, so
+    a consumer that stops early does not trigger work it never reads.
+    """
+    if concurrency <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    pending = deque()
     try:
-        response = requests.post(url, json=payload)
-        if response.status_code == 200:
-            response_data = response.json()
-            print(f"Generated response for model '{model}':", response_data.get("response", "No text generated"))
-            return response_data.get("response", "ERROR")
-        else:
-            print(f"Failed to generate response. Status code: {response.status_code}, Response: {response.text}")
-            return "ERROR"
-    except requests.exceptions.RequestException as e:
-        print(f"An error occurred: {e}")
-        return "ERROR"
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= concurrency * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
 
-def generate_story_data(model, output_dir):
+def generate_story_data(model, output_dir, concurrency=1):
     prompts = get_story_prompts()
-    for prompt in prompts:
-        hash = hashlib.sha1(prompt.encode("UTF-8")).hexdigest()
-        file_path = os.path.join(output_dir, f"{hash}.txt")
-        
-        if os.path.exists(file_path):
-            print(f"File {file_path} already exists. Reading data.")
-            with open(file_path, "r") as f:
-                existing_story_data = f.read()
-                yield (prompt, existing_story_data)
-        else:
-            print(f"Generating story data for `{prompt}`")
-            response = call_ollama(model, prompt)
-            with open(file_path, "w") as f:
-                f.write(response)
-            print(f"Saved to {file_path}.")
-            yield (prompt, response)
+
+    cache = ResponseCache.open(output_dir)
+
+    def generate_story(prompt):
+        return (prompt, call_ollama_cached(cache, "story", model, prompt, ""))
+
+    get_session(max(concurrency, 16))
+    yield from ordered_map(generate_story, prompts, concurrency)
 
 
 def get_action_yaml(text):
@@ -63,6 +124,25 @@ def get_action_yaml(text):
         raise Exception("action section not found")
 
 def get_files_with_keyword(input_dir, keyword):
+    # `function: <name>` keywords are answered from the capture index without touching the captures
+    match = re.fullmatch(r'function:\s*(\S+)', keyword.strip())
+    if is_capture_store(input_dir):
+        print(f"Using capture store to filter input files based on keyword: `{keyword}`")
+        if match:
+            filenames, functions = get_store_functions(input_dir)
+            return [filename for filename, function in zip(filenames, functions) if function == match.group(1)]
+        import pyarrow.compute as pc
+        table = load_store_table(input_dir, ["filename", "raw"])
+        mask = pc.match_substring(table.column("raw"), keyword)
+        return table.column("filename").filter(mask).to_pylist()
+
+    if match:
+        print(f"Using capture index to filter input files based on keyword: `{keyword}`")
+        files = [os.path.join(input_dir, f) for f in get_files_with_function(input_dir, match.group(1))]
+        if not files:
+            print(f"No files found containing the keyword '{keyword}'.")
+        return files
+
     print(f"Using `grep` to filter input files based on keyword: `{keyword}`")
     try:
         # Use grep to search for files containing the keyword and list only file names
@@ -86,34 +166,48 @@ def get_files_with_keyword(input_dir, keyword):
         print(f"An error occurred during grep execution: {e}")
         return []
 
-def get_summary(model, base_filename, output_dir, full_text):
-    output_filename = f"{base_filename}-llama-sm.txt"
-    output_path = os.path.join(output_dir, output_filename)
-
-    if os.path.exists(output_path):
-        print(f"Output file {output_filename} already exists. Skipping...")
-        with open(output_path, 'r') as output_file:
-            return output_file.read()
-    else:
-        response = "summary"
-        while "summary" in response.lower() or "250 words" in response.lower():
-            response = call_ollama(
-                model, 
-                "I'm a software engineer using large language models for summarization. Summarize the following text in under 250 words while maintaining the perspective of an minecraft expert analyst. Never mention that you are summarizing only provide the sumarized analysis:\n\n" + full_text
-            )
-                
-        # Save the response to the output file
-        with open(output_path, 'w') as output_file:
-            output_file.write(response)
-            print(f"Response saved to {output_path}")
+SUMMARY_PROMPT = "I'm a software engineer using large language models for summarization. Summarize the following text in under 250 words while maintaining the perspective of an minecraft expert analyst. Never mention that you are summarizing only provide the sumarized analysis:\n\n"
 
+def call_ollama_cached(cache, kind, model, template, content, accept=None):
+    """
+    Returns the cached response for (model, template, content) or calls Ollama
+    with template + content, retrying until `accept` approves the response.
+    Failed calls are never cached.
+    """
+    key = make_cache_key(kind, model, template, content)
+    response = cache.get(key)
+    if response is not None:
         return response
 
-def process_files(model, input_dir, output_dir, keyword=None):    
-    # Get all the .yaml files in the input directory
-    files = [f for f in os.listdir(input_dir) if f.endswith('.yaml')]
-    # Sort the files based on their extracted timestamp
-    sorted_files = sorted(files, key=lambda f: extract_timestamp(f))
+    response = call_ollama(model, template + content)
+    while response != "ERROR" and accept is not None and not accept(response):
+        response = call_ollama(model, template + content)
+
+    if response != "ERROR":
+        cache.put(key, response, kind, model)
+    return response
+
+def get_summary(model, cache, full_text):
+    return call_ollama_cached(
+        cache, "summary", model, SUMMARY_PROMPT, full_text,
+        accept=lambda response: "summary" not in response.lower() and "250 words" not in response.lower()
+    )
+
+def process_files(model, input_dir, output_dir, keyword=None, concurrency=1, limit=None, dedup=False, dedup_log=None, workers=1):
+    """
+    Yields (human, gpt, gpt_summary, action) tuples in capture order. Up to
+    `concurrency` captures are labeled by Ollama at once and at most `limit`
+    captures are labeled in total. With `dedup`, near-duplicate captures are
+    never sent for labeling; the action to predict is still the true next capture.
+    """
+    if is_capture_store(input_dir):
+        # Captures were packed into a columnar store; read them from its memory-mapped raw column
+        store = load_store_table(input_dir, ["filename", "raw"])
+        sorted_files = store.column("filename").to_pylist()
+    else:
+        store = None
+        # Get all the .yaml files in the input directory, sorted by their extracted timestamp
+        sorted_files = get_sorted_files(input_dir)
 
     if len(sorted_files) < 2:
         raise Exception("You must have at least 2 files to process in this way.")
@@ -125,50 +219,54 @@ def process_files(model, input_dir, output_dir, keyword=None):
             raise Exception(f"You must have at least 2 files to process in this way. (keyword:{keyword})")
 
     files_to_process = sorted_filtered_files if keyword else sorted_files
+    if dedup:
+        kept_files = get_deduplicated_files(input_dir, log_path=dedup_log, workers=workers)
+        files_to_process = [f for f in files_to_process if os.path.basename(f) in kept_files]
+    get_session(max(concurrency, 16))
+
+    # Map each capture to its position so the successor lookup is O(1)
+    file_positions = {filename: i for i, filename in enumerate(sorted_files)}
+
+    def get_work_items():
+        for i in range(len(files_to_process)-1):
+            filename = os.path.basename(files_to_process[i])
+            position = file_positions.get(filename)
+            if position is None or position + 1 >= len(sorted_files):
+                continue
+            yield filename, sorted_files[position + 1]
+
+    work_items = get_work_items()
+    if limit is not None:
+        work_items = itertools.islice(work_items, limit)
+
+    cache = ResponseCache.open(output_dir)
 
-    for i in range(len(files_to_process)-1):
-        filename = os.path.basename(files_to_process[i])
-        next_filename = sorted_files[sorted_files.index(filename) + 1]
-        file_path = os.path.join(input_dir, filename)
-        next_file_path = os.path.join(input_dir, next_filename)
-        with open(file_path, 'r') as file:
-            with open(next_file_path, 'r') as next_file:
-                data = file.read()
-                next_data = next_file.read()
-                action_yaml = get_action_yaml(next_data)
-                # Create output file name based on input file name
-                base_filename = os.path.splitext(filename)[0]
-                output_filename = f"{base_filename}-llama.txt"
-                output_path = os.path.join(output_dir, output_filename)
-
-                prompt = get_random_prompt() + f"{data}"
-
-                if os.path.exists(output_path):
-                    print(f"Output file {output_filename} already exists. Skipping...")
-                    with open(output_path, 'r') as output_file:
-                        existing_response = output_file.read()
-                        yield (
-                                prompt, 
-                                existing_response + "\n\n" + action_yaml,
-                                get_summary(model, base_filename, output_dir, existing_response) + "\n\n" + action_yaml,
-                                action_yaml
-                            )
-
-                    continue
-
-                response = call_ollama(model, prompt)
-                
-                # Save the response to the output file
-                with open(output_path, 'w') as output_file:
-                    output_file.write(response)
-                    print(f"Response saved to {output_path}")
-
-                yield (
-                        prompt, 
-                        response + "\n\n" + action_yaml,
-                        get_summary(model, base_filename, output_dir, response) + "\n\n" + action_yaml,
-                        action_yaml
-                    )
+    def read_capture(filename):
+        if store is not None:
+            return store.column("raw")[file_positions[filename]].as_py()
+        with open(os.path.join(input_dir, filename), 'r') as file:
+            return file.read()
+
+    def label_capture(work_item):
+        filename, next_filename = work_item
+        data = read_capture(filename)
+        next_data = read_capture(next_filename)
+        action_yaml = get_action_yaml(next_data)
+
+        # Pick the prompt template from the capture contents so re-runs hit the cache
+        template = get_random_prompt(random.Random(hashlib.sha256(data.encode("UTF-8")).hexdigest()))
+        prompt = template + f"{data}"
+
+        response = call_ollama_cached(cache, "analysis", model, template, data)
+
+        return (
+                prompt, 
+                response + "\n\n" + action_yaml,
+                get_summary(model, cache, response) + "\n\n" + action_yaml,
+                action_yaml
+            )
+
+    yield from ordered_map(label_capture, work_items, concurrency)
 
 def main():
     parser = argparse.ArgumentParser(description='LLM training')
@@ -176,18 +274,32 @@ def main():
     parser.add_argument('--output-dir', type=str, default="./output/llama", help='Path to the output directory to save the generated responses.')
     parser.add_argument('--model', type=str, default="llama3.1", help='Ollama model name')
     parser.add_argument('--keyword', type=str, default=None, help='Keyword to filter files by content')
+    parser.add_argument('--concurrency', type=int, default=1, help='Number of concurrent Ollama requests.')
+    parser.add_argument('--cache-compress', action='store_true', help='Compress cached Ollama responses.')
+    parser.add_argument('--cache-max-bytes', type=int, default=None, help='Evict least recently used cached responses beyond this size.')
+    parser.add_argument('--dedup', action='store_true', help='Skip near-duplicate captures instead of labeling them.')
+    parser.add_argument('--dedup-log', type=str, default=None, help='Write dropped near-duplicate captures to this JSON lines file.')
+    metrics.add_arguments(parser)
    
     args = parser.parse_args()
     input_dir = args.input_dir
     output_dir = args.output_dir
     model = args.model
     keyword = args.keyword
+    concurrency = args.concurrency
 
     # Ensure output directory exists
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    process_files(model, input_dir, output_dir, keyword)
+    cache = ResponseCache.open(output_dir, args.cache_compress, args.cache_max_bytes)
+
+    metrics_report = args.metrics_report or os.path.join(output_dir, "llama_data_pre_processing_metrics.json")
+    with metrics.run_metrics(metrics_report, args.progress_interval, {"run": "llama_data_pre_processing", "model": model}):
+        for _ in process_files(model, input_dir, output_dir, keyword, concurrency, dedup=args.dedup, dedup_log=args.dedup_log):
+            metrics.increment("captures_labeled")
+
+    print(f"Response cache: {cache.stats()}")
 
 if __name__ == "__main__":
     main()
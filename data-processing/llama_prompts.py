@@ -51,7 +51,7 @@ def only_return_prediction():
     return random.choice(options)
 
 
-def get_random_prompt():
+def get_random_prompt(rng=random):
     prompts = [
         f"Act as an expert Minecraft player who can understand a player's actions by viewing the game state at the time the action was given. I will provide you with the game state and the action taken in YAML form, and you will tell me why a player may have taken the given action using your knowledge of Minecraft and the game state, be highly detailed and provide your reasoning step by step for the sample data below.\n\n",
         f"As a seasoned Minecraft player, you have the ability to interpret a player's decisions based on the game's current state. I'll supply the game state and the corresponding action in YAML format, and I'd like you to explain, step by step, why a player might have taken that action, drawing on your Minecraft expertise.\n\n",
@@ -76,7 +76,7 @@ def get_random_prompt():
         f"Based on the YAML game state and player action, use your Minecraft expertise to explain why a player may have taken the action. Provide a highly detailed, step-by-step explanation of the decision-making process.\n\n"
     ]
 
-    return random.choice(prompts)
+    return rng.choice(prompts)
 
 def get_story_prompts():
     return [
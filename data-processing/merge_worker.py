@@ -0,0 +1,174 @@
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import argparse
+import subprocess
+
+MANIFEST_FILENAME = "merge_manifest.jsonl"
+
+# llama.cpp conversion script used for the optional GGUF exports (see save_gguf.sh)
+CONVERT_SCRIPT = "llama.cpp/convert_hf_to_gguf.py"
+
+def get_base_model_name(adapter_dir):
+    """The 16-bit base model of a LoRA adapter trained on a bnb-4bit checkpoint."""
+    with open(os.path.join(adapter_dir, "adapter_config.json"), 'r') as f:
+        base_model = json.load(f)["base_model_name_or_path"]
+    # unsloth publishes every -bnb-4bit checkpoint next to its 16-bit original
+    return base_model[:-len("-bnb-4bit")] if base_model.endswith("-bnb-4bit") else base_model
+
+def merge_adapter(adapter_dir, model_dir, device="cpu"):
+    """
+    Merges the adapter into its 16-bit base and saves the result with the
+    adapter's tokenizer. The model is written beside model_dir and moved into
+    place when complete, so readers never see a partial model.
+    """
+    # Deferred so train.py can import this module without loading peft in the training process
+    import torch
+    from peft import PeftModel
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    model = AutoModelForCausalLM.from_pretrained(get_base_model_name(adapter_dir), torch_dtype=torch.float16, device_map=device)
+    model = PeftModel.from_pretrained(model, adapter_dir).merge_and_unload()
+    tokenizer = AutoTokenizer.from_pretrained(adapter_dir)
+
+    tmp_dir = os.path.join(os.path.dirname(model_dir), f".merging-{os.path.basename(model_dir)}")
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    model.save_pretrained(tmp_dir, safe_serialization=True)
+    tokenizer.save_pretrained(tmp_dir)
+    os.replace(tmp_dir, model_dir)
+
+def export_gguf(model_dir, outtype):
+    gguf_dir = f"{model_dir}-gguf"
+    os.makedirs(gguf_dir, exist_ok=True)
+    outfile = os.path.join(gguf_dir, f"{os.path.basename(model_dir)}-gguf.{outtype}.gguf")
+    subprocess.run(["python3", CONVERT_SCRIPT, f"{model_dir}/", "--outtype", outtype, "--outfile", outfile], check=True)
+    return outfile
+
+def run_job(job):
+    """Runs one merge job and returns its manifest entry."""
+    entry = dict(job, status="done", started=time.time(), outputs=[])
+    try:
+        merge_adapter(job["adapter_dir"], job["model_dir"], job.get("device", "cpu"))
+        entry["outputs"].append(job["model_dir"])
+        for outtype in job.get("exports", []):
+            entry["outputs"].append(export_gguf(job["model_dir"], outtype))
+    except Exception as e:
+        entry["status"] = "failed"
+        entry["error"] = f"{type(e).__name__}: {e}"
+    entry["finished"] = time.time()
+    entry["seconds"] = entry["finished"] - entry["started"]
+    return entry
+
+def append_manifest(manifest_path, entry):
+    with open(manifest_path, 'a') as f:
+        f.write(json.dumps(entry) + "\n")
+
+def load_manifest_entries(manifest_path):
+    entries = []
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            for line in f:
+                if line.strip():
+                    entries.append(json.loads(line))
+    return entries
+
+def serve(manifest_path, jobs=sys.stdin):
+    """Runs the JSON jobs read one per line from `jobs`, in order, until it is closed."""
+    for line in jobs:
+        if not line.strip():
+            continue
+        job = json.loads(line)
+        print(f"Merging {job['adapter_dir']} into {job['model_dir']}...", flush=True)
+        entry = run_job(job)
+        append_manifest(manifest_path, entry)
+        print(f"Merge {entry['status']} for {job['model_dir']} ({entry['seconds']:.1f}s)", flush=True)
+
+class MergeQueue:
+    """
+    Merges saved LoRA adapters in a separate `python merge_worker.py --serve`
+    process, one job at a time in submission order. Each finished (or failed)
+    job is appended to the JSON lines manifest in output_dir.
+    """
+
+    def __init__(self, output_dir, device="cpu", exports=()):
+        self.manifest_path = os.path.join(output_dir, MANIFEST_FILENAME)
+        self.device = device
+        self.exports = list(exports)
+        self.job_ids = []
+        # A fresh interpreter, so the worker neither re-imports the training script nor inherits its CUDA state
+        self._process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "--serve", "--manifest", self.manifest_path],
+            stdin=subprocess.PIPE, text=True,
+        )
+
+    def submit(self, adapter_dir, model_dir, **extra):
+        job = dict(extra, job_id=uuid.uuid4().hex, adapter_dir=adapter_dir, model_dir=model_dir, device=self.device, exports=self.exports, submitted=time.time())
+        self.job_ids.append(job["job_id"])
+        try:
+            self._process.stdin.write(json.dumps(job) + "\n")
+            self._process.stdin.flush()
+        except BrokenPipeError:
+            # The worker has died; close() reports the job as missing from the manifest
+            pass
+
+    def close(self, wait=True):
+        """
+        Stops the worker after the queued jobs. With wait, blocks until they are
+        done and raises if the worker exited abnormally (e.g. was OOM-killed) or
+        any submitted job failed or has no manifest entry.
+        """
+        try:
+            self._process.stdin.close()
+        except BrokenPipeError:
+            pass
+        if not wait:
+            return
+        print(f"Waiting for {len(self.job_ids)} merge jobs to finish (see {self.manifest_path})...")
+        returncode = self._process.wait()
+
+        entries = {entry.get("job_id"): entry for entry in load_manifest_entries(self.manifest_path)}
+        problems = []
+        if returncode != 0:
+            problems.append(f"merge worker exited with code {returncode}")
+        for job_id in self.job_ids:
+            entry = entries.get(job_id)
+            if entry is None:
+                problems.append(f"job {job_id} has no manifest entry")
+            elif entry["status"] != "done":
+                problems.append(f"job {job_id} for {entry['model_dir']} failed: {entry.get('error')}")
+        if problems:
+            raise Exception("Merging did not complete; the adapters are kept for merge_worker.py: " + "; ".join(problems))
+
+def save_adapter(model, tokenizer, adapter_dir):
+    """Saves only the LoRA adapter weights and the tokenizer, which takes seconds rather than minutes."""
+    model.save_pretrained(adapter_dir)
+    tokenizer.save_pretrained(adapter_dir)
+
+def main():
+    parser = argparse.ArgumentParser(description='Merge a saved LoRA adapter into its 16-bit base model.')
+    parser.add_argument('--adapter-dir', type=str, default=None, help='Directory written by save_adapter.')
+    parser.add_argument('--model-dir', type=str, default=None, help='Where to write the merged model.')
+    parser.add_argument('--device', type=str, default="cpu", help='Device used for merging.')
+    parser.add_argument('--exports', type=str, nargs='*', default=[], help='GGUF outtypes to export after merging (e.g. f16 q8_0).')
+    parser.add_argument('--serve', action='store_true', help='Run JSON jobs read one per line from stdin (as MergeQueue does).')
+    parser.add_argument('--manifest', type=str, default=None, help='Manifest the jobs are appended to in --serve mode.')
+    args = parser.parse_args()
+
+    if args.serve:
+        if not args.manifest:
+            parser.error("--serve requires --manifest")
+        serve(args.manifest)
+        return
+    if not args.adapter_dir or not args.model_dir:
+        parser.error("--adapter-dir and --model-dir are required")
+
+    entry = run_job({"adapter_dir": args.adapter_dir, "model_dir": args.model_dir, "device": args.device, "exports": args.exports})
+    append_manifest(os.path.join(os.path.dirname(os.path.abspath(args.model_dir)), MANIFEST_FILENAME), entry)
+    print(json.dumps(entry, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+import os
+import re
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+# Prefix of every metric name in the Prometheus textfile report
+PROMETHEUS_PREFIX = "minecraft_ai"
+
+# Characters of an example shown in progress output before it is cut off
+PREVIEW_CHARS = 300
+
+_lock = threading.Lock()
+_started = time.time()
+_counters = {}
+_gauges = {}
+# name -> [count, total seconds, max seconds]
+_timers = {}
+
+def increment(name, value=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+def set_gauge(name, value):
+    with _lock:
+        _gauges[name] = value
+
+def record_time(name, seconds):
+    with _lock:
+        timer = _timers.get(name)
+        if timer is None:
+            _timers[name] = [1, seconds, seconds]
+        else:
+            timer[0] += 1
+            timer[1] += seconds
+            if seconds > timer[2]:
+                timer[2] = seconds
+
+@contextmanager
+def timed(name):
+    """Adds the time spent in the block to the `name` timer."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_time(name, time.perf_counter() - start)
+
+def reset():
+    global _started
+    with _lock:
+        _started = time.time()
+        _counters.clear()
+        _gauges.clear()
+        _timers.clear()
+
+def get_report():
+    """Counters, gauges and timers recorded so far, with per-second rates over the run."""
+    with _lock:
+        elapsed = time.time() - _started
+        return {
+            "started": _started,
+            "elapsed_s": elapsed,
+            "counters": {name: {"total": value, "per_s": value / max(elapsed, 1e-9)} for name, value in sorted(_counters.items())},
+            "gauges": dict(sorted(_gauges.items())),
+            "timers": {
+                name: {"count": count, "total_s": total, "mean_s": total / count, "max_s": maximum}
+                for name, (count, total, maximum) in sorted(_timers.items())
+            },
+        }
+
+def _prometheus_name(name):
+    return f"{PROMETHEUS_PREFIX}_{re.sub(r'[^a-zA-Z0-9_]', '_', name)}"
+
+def format_prometheus(report, labels=None):
+    label_text = ",".join(f'{key}="{value}"' for key, value in sorted((labels or {}).items()))
+    label_text = f"{{{label_text}}}" if label_text else ""
+
+    lines = [f"{_prometheus_name('elapsed_seconds')}{label_text} {report['elapsed_s']}"]
+    for name, counter in report["counters"].items():
+        lines.append(f"# TYPE {_prometheus_name(name)}_total counter")
+        lines.append(f"{_prometheus_name(name)}_total{label_text} {counter['total']}")
+    for name, value in report["gauges"].items():
+        lines.append(f"# TYPE {_prometheus_name(name)} gauge")
+        lines.append(f"{_prometheus_name(name)}{label_text} {value}")
+    for name, timer in report["timers"].items():
+        metric = f"{_prometheus_name(name)}_seconds"
+        lines.append(f"# TYPE {metric} summary")
+        lines.append(f"{metric}_count{label_text} {timer['count']}")
+        lines.append(f"{metric}_sum{label_text} {timer['total_s']}")
+    return "\n".join(lines) + "\n"
+
+def write_report(path, labels=None):
+    """
+    Writes the report to path: a Prometheus textfile when path ends in .prom,
+    JSON otherwise. The file is replaced atomically so a collector never reads
+    a partial report.
+    """
+    report = get_report()
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(f"{path}.tmp", 'w') as f:
+        if path.endswith(".prom"):
+            f.write(format_prometheus(report, labels))
+        else:
+            json.dump(dict(report, labels=labels or {}), f, indent=2)
+    os.replace(f"{path}.tmp", path)
+    print(f"Wrote metrics report to {path}")
+    return report
+
+def format_progress():
+    report = get_report()
+    parts = [f"{report['elapsed_s']:.0f}s"]
+    parts.extend(f"{name} {counter['total']} ({counter['per_s']:.1f}/s)" for name, counter in report["counters"].items())
+    parts.extend(f"{name} {timer['mean_s'] * 1000:.2f}ms avg" for name, timer in report["timers"].items())
+    return "[progress] " + " | ".join(parts)
+
+class ProgressReporter:
+    """Prints format_progress() every `interval` seconds from a daemon thread."""
+
+    def __init__(self, interval, stream=None):
+        self.interval = interval
+        self.stream = stream or sys.stdout
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.interval and self.interval > 0:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            print(format_progress(), file=self.stream, flush=True)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+@contextmanager
+def run_metrics(report_path=None, progress_interval=0, labels=None):
+    """Resets the metrics for a run, prints progress while it runs and writes the report when it ends."""
+    reset()
+    reporter = ProgressReporter(progress_interval).start()
+    try:
+        yield
+    finally:
+        reporter.stop()
+        if report_path:
+            write_report(report_path, labels)
+
+def preview(value, limit=PREVIEW_CHARS):
+    """str(value) cut to `limit` characters, for logging examples without dumping them whole."""
+    text = str(value)
+    return text if len(text) <= limit else f"{text[:limit]}... ({len(text)} chars)"
+
+def add_arguments(parser, default_report=None):
+    parser.add_argument('--metrics-report', type=str, default=default_report, help='Write run metrics here at exit (Prometheus textfile if it ends in .prom, JSON otherwise).')
+    parser.add_argument('--progress-interval', type=float, default=0, help='Print a progress line every N seconds (0 disables).')
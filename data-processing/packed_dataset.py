@@ -0,0 +1,96 @@
+import os
+import json
+import shutil
+import hashlib
+import metrics
+from datasets import Dataset
+
+PACK_BATCH_SIZE = 1000
+
+# Bumped when the packed layout changes so older caches are not reused
+PACK_LAYOUT_VERSION = "2"
+
+def get_packed_cache_key(dataset, tokenizer, max_seq_length, settings=None, seed=0):
+    """
+    Key for a packed dataset: the source dataset fingerprint, the tokenizer
+    (name, vocabulary size, chat template and EOS token), the sequence length,
+    the shuffle seed and any settings that changed which rows were selected.
+    """
+    digest = hashlib.sha256()
+    for part in (
+        PACK_LAYOUT_VERSION,
+        dataset._fingerprint,
+        tokenizer.name_or_path,
+        str(len(tokenizer)),
+        getattr(tokenizer, "chat_template", None) or "",
+        str(tokenizer.eos_token_id),
+        str(max_seq_length),
+        json.dumps(settings or {}, sort_keys=True),
+        str(seed),
+    ):
+        digest.update(part.encode("UTF-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+def _tokenize(batch, tokenizer):
+    return {"input_ids": tokenizer(batch["text"], add_special_tokens=True, truncation=False)["input_ids"]}
+
+def _iter_blocks(tokenized, eos_token_id, max_seq_length):
+    # Examples joined by EOS and cut into max_seq_length blocks in one pass over
+    # the whole dataset, so an example that straddles a block boundary continues
+    # in the next block and only the final partial block is dropped
+    buffer = []
+    for batch in tokenized.iter(batch_size=PACK_BATCH_SIZE):
+        for input_ids in batch["input_ids"]:
+            buffer.extend(input_ids)
+            buffer.append(eos_token_id)
+
+        blocks = len(buffer) // max_seq_length
+        for i in range(blocks):
+            yield {"input_ids": buffer[i*max_seq_length:(i+1)*max_seq_length], "attention_mask": [1] * max_seq_length}
+        buffer = buffer[blocks*max_seq_length:]
+
+def get_packed_dataset(dataset, tokenizer, max_seq_length, cache_root, settings=None, num_proc=None, seed=0):
+    """
+    Returns `dataset` tokenized, shuffled with `seed` and packed into
+    max_seq_length blocks. Shuffling first mixes functions within blocks rather
+    than packing the stratified sample's per-function runs together. The result
+    is saved under cache_root the first time and memory-mapped from there by
+    every later epoch and run with the same key.
+    """
+    cache_dir = os.path.join(cache_root, get_packed_cache_key(dataset, tokenizer, max_seq_length, settings, seed))
+
+    if os.path.exists(cache_dir):
+        print(f"Loading packed dataset from {cache_dir}...")
+        return Dataset.load_from_disk(cache_dir)
+
+    num_proc = num_proc or os.cpu_count()
+    print(f"Tokenizing {len(dataset)} rows with {num_proc} processes and packing them...")
+
+    with metrics.timed("tokenize"):
+        tokenized = dataset.map(
+            _tokenize,
+            batched=True,
+            num_proc=num_proc,
+            remove_columns=dataset.column_names,
+            fn_kwargs={"tokenizer": tokenizer},
+            desc="Tokenizing",
+        )
+    with metrics.timed("pack"):
+        # Packing is a single sequential pass so the remainder of each batch carries into the next;
+        # the generator's Arrow cache lives beside cache_dir, whose key already identifies the input
+        packed = Dataset.from_generator(
+            _iter_blocks,
+            gen_kwargs={"tokenized": tokenized.shuffle(seed=seed), "eos_token_id": tokenizer.eos_token_id, "max_seq_length": max_seq_length},
+            cache_dir=f"{cache_dir}.generator",
+        )
+
+    tmp_dir = f"{cache_dir}.tmp"
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    packed.save_to_disk(tmp_dir)
+    os.replace(tmp_dir, cache_dir)
+    shutil.rmtree(f"{cache_dir}.generator", ignore_errors=True)
+
+    print(f"Packed {len(dataset)} rows into {len(packed)} sequences at {cache_dir}")
+    return Dataset.load_from_disk(cache_dir)
@@ -0,0 +1,140 @@
+import os
+import time
+import zlib
+import sqlite3
+import hashlib
+import argparse
+import threading
+import metrics
+
+CACHE_FILENAME = "responses.sqlite"
+
+# Responses shorter than this are stored as-is even when compression is enabled
+MIN_COMPRESS_SIZE = 256
+
+def make_cache_key(kind, model, template, content):
+    """
+    Content-addressed key: changing the model, the prompt template or the input
+    itself produces a different key, so stale responses are never reused.
+    """
+    digest = hashlib.sha256()
+    for part in (kind, model, template, content):
+        digest.update(part.encode("UTF-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+class ResponseCache:
+    _open_caches = {}
+    _open_lock = threading.Lock()
+
+    def __init__(self, cache_dir, compress=False, max_bytes=None):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, CACHE_FILENAME)
+        self.compress = compress
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                model TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                compressed INTEGER NOT NULL,
+                created REAL NOT NULL,
+                last_access REAL NOT NULL,
+                value BLOB NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+        self._conn.commit()
+        self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @classmethod
+    def open(cls, cache_dir, compress=None, max_bytes=None):
+        """Returns the shared cache for cache_dir, updating its settings when given."""
+        key = os.path.abspath(cache_dir)
+        with cls._open_lock:
+            cache = cls._open_caches.get(key)
+            if cache is None:
+                cache = cls(cache_dir, bool(compress), max_bytes)
+                cls._open_caches[key] = cache
+            else:
+                if compress is not None:
+                    cache.compress = compress
+                if max_bytes is not None:
+                    cache.max_bytes = max_bytes
+            return cache
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT value, compressed FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                metrics.increment("response_cache_misses")
+                return None
+            self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            self.hits += 1
+            metrics.increment("response_cache_hits")
+
+        value, compressed = row
+        if compressed:
+            value = zlib.decompress(value)
+        return value.decode("UTF-8")
+
+    def put(self, key, value, kind="", model=""):
+        data = value.encode("UTF-8")
+        compressed = self.compress and len(data) >= MIN_COMPRESS_SIZE
+        if compressed:
+            data = zlib.compress(data)
+
+        now = time.time()
+        with self._lock:
+            previous = self._conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, kind, model, size, compressed, created, last_access, value) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, kind, model, len(data), int(compressed), now, now, sqlite3.Binary(data))
+            )
+            self._total_bytes += len(data) - (previous[0] if previous else 0)
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        # Least recently used entries go first until the cache fits in max_bytes
+        while self.max_bytes and self._total_bytes > self.max_bytes:
+            rows = self._conn.execute("SELECT key, size FROM responses ORDER BY last_access LIMIT 100").fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                if self._total_bytes <= self.max_bytes:
+                    break
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._total_bytes -= size
+
+    def trim(self):
+        with self._lock:
+            self._evict()
+            self._conn.commit()
+
+    def stats(self):
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return {"entries": entries, "bytes": self._total_bytes, "hits": self.hits, "misses": self.misses}
+
+def main():
+    parser = argparse.ArgumentParser(description='Inspect or trim the Ollama response cache.')
+    parser.add_argument('--cache-dir', type=str, default="./output/llama", help='Directory containing the response cache.')
+    parser.add_argument('--max-bytes', type=int, default=None, help='Evict least recently used responses until the cache fits.')
+    args = parser.parse_args()
+
+    cache = ResponseCache.open(args.cache_dir, max_bytes=args.max_bytes)
+    if args.max_bytes:
+        cache.trim()
+    print(cache.stats())
+
+if __name__ == '__main__':
+    main()
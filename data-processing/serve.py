@@ -0,0 +1,328 @@
+import os
+import copy
+import glob
+import json
+import time
+import queue
+import argparse
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+from action_decoding import get_action_generation_kwargs
+from compact_state import compact_prompt, expand_action
+from create_dataset import DEFAULT_PRE
+from util import ASSISTANT_TOKEN, find_latest_model
+
+DEFAULT_PORT = 5555
+DEFAULT_MODEL_NAME = "minecraft-ai"
+
+USER_TOKEN = '<|im_start|>user'
+SYSTEM_TOKEN = '<|im_start|>system'
+END_TOKEN = '<|im_end|>'
+
+def format_prompt(prompt, system=None):
+    """Wraps a raw prompt in the chatml template the model was trained with."""
+    text = f"{SYSTEM_TOKEN}\n{system}{END_TOKEN}\n" if system else ""
+    return f"{text}{USER_TOKEN}\n{prompt}{END_TOKEN}\n{ASSISTANT_TOKEN}\n"
+
+class PrefixCache:
+    """
+    KV cache of shared prompt prefixes. Prompts that start with a cached prefix
+    only run the model over the rest of the prompt. The instruction prefix is
+    seeded up front, and any prefix shared by consecutive prompts (such as the
+    preamble the player mod sends with every request) is learned as it is seen.
+    """
+
+    def __init__(self, model, max_entries=4, min_tokens=16, history=8):
+        self.model = model
+        self.max_entries = max_entries
+        self.min_tokens = min_tokens
+        self.entries = OrderedDict()
+        self.pinned = set()
+        self.recent = deque(maxlen=history)
+        self.hits = 0
+        self.misses = 0
+
+    def add(self, prefix_ids, pinned=False):
+        """Computes and stores the KV for prefix_ids. Pinned prefixes are never evicted."""
+        prefix_ids = tuple(prefix_ids)
+        if len(prefix_ids) < self.min_tokens or prefix_ids in self.entries:
+            return
+        with torch.no_grad():
+            input_ids = torch.tensor([prefix_ids], device=self.model.device)
+            self.entries[prefix_ids] = self.model(input_ids=input_ids, use_cache=True).past_key_values
+        if pinned:
+            self.pinned.add(prefix_ids)
+        for evict_ids in list(self.entries):
+            if len(self.entries) <= self.max_entries + len(self.pinned):
+                break
+            if evict_ids not in self.pinned:
+                del self.entries[evict_ids]
+        print(f"Cached KV for a {len(prefix_ids)} token prefix ({len(self.entries)} cached)")
+
+    def _longest_prefix(self, input_ids):
+        best = None
+        for prefix_ids in self.entries:
+            if len(prefix_ids) < len(input_ids) and input_ids[:len(prefix_ids)] == prefix_ids:
+                if best is None or len(prefix_ids) > len(best):
+                    best = prefix_ids
+        return best
+
+    def lookup(self, input_ids):
+        """Returns the longest cached prefix of input_ids (leaving at least one token to run) and its KV."""
+        best = self._longest_prefix(tuple(input_ids))
+        if best is None:
+            self.misses += 1
+            return (), None
+        self.hits += 1
+        self.entries.move_to_end(best)
+        return best, self.entries[best]
+
+    def observe(self, input_ids):
+        input_ids = tuple(input_ids)
+        shared = 0
+        for previous_ids in self.recent:
+            length = 0
+            for a, b in zip(previous_ids, input_ids):
+                if a != b:
+                    break
+                length += 1
+            shared = max(shared, length)
+        self.recent.append(input_ids)
+        # Stop one token short: the boundary token may merge differently in the next prompt
+        if shared - 1 >= self.min_tokens and len(self._longest_prefix(input_ids) or ()) < shared - 1:
+            self.add(input_ids[:shared - 1])
+
+class BatchGenerator:
+    """
+    Collects concurrent requests for up to max_wait_ms (or max_batch_size
+    requests) and generates each group that shares a cached prefix and
+    generation options as one padded batch on a single worker thread.
+    """
+
+    def __init__(self, model, tokenizer, prefix_cache, max_batch_size=8, max_wait_ms=20, constrained=False):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.prefix_cache = prefix_cache
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.constrained = constrained
+        self.requests = queue.Queue()
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def submit(self, prompt_text, options):
+        future = Future()
+        input_ids = self.tokenizer(prompt_text, add_special_tokens=False)["input_ids"]
+        self.requests.put((input_ids, options, future))
+        return future
+
+    def _collect(self):
+        batch = [self.requests.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+
+            groups = {}
+            for input_ids, options, future in batch:
+                prefix_ids, prefix_kv = self.prefix_cache.lookup(input_ids)
+                key = (prefix_ids, tuple(sorted(options.items())))
+                groups.setdefault(key, (prefix_kv, []))[1].append((input_ids, future))
+
+            for (prefix_ids, options), (prefix_kv, requests) in groups.items():
+                try:
+                    results = self._generate(prefix_ids, prefix_kv, dict(options), [input_ids for input_ids, _ in requests])
+                    for (_, future), result in zip(requests, results):
+                        future.set_result(result)
+                except Exception as e:
+                    for _, future in requests:
+                        future.set_exception(e)
+
+            for input_ids, _, _ in batch:
+                self.prefix_cache.observe(input_ids)
+
+    def _generate(self, prefix_ids, prefix_kv, options, batch_ids):
+        start = time.perf_counter()
+        pad_token_id = self.tokenizer.pad_token_id if self.tokenizer.pad_token_id is not None else self.tokenizer.eos_token_id
+
+        # Padding goes between the shared prefix and each suffix so the cached prefix
+        # stays aligned; position ids follow the attention mask, so the gap is skipped
+        suffixes = [input_ids[len(prefix_ids):] for input_ids in batch_ids]
+        width = max(len(suffix) for suffix in suffixes)
+        input_ids = [list(prefix_ids) + [pad_token_id] * (width - len(suffix)) + suffix for suffix in suffixes]
+        attention_mask = [[1] * len(prefix_ids) + [0] * (width - len(suffix)) + [1] * len(suffix) for suffix in suffixes]
+        input_ids = torch.tensor(input_ids, device=self.model.device)
+        attention_mask = torch.tensor(attention_mask, device=self.model.device)
+        prompt_length = input_ids.shape[1]
+
+        kwargs = get_action_generation_kwargs(self.tokenizer, prompt_length, self.constrained)
+        if prefix_kv is not None:
+            # generate() extends the cache in place, so each batch works on its own copy
+            past_key_values = copy.deepcopy(prefix_kv)
+            past_key_values.batch_repeat_interleave(len(batch_ids))
+            kwargs["past_key_values"] = past_key_values
+
+        temperature = options.get("temperature", 0.8)
+        if options.get("seed") is not None:
+            torch.manual_seed(options["seed"])
+        if temperature > 0:
+            kwargs.update(do_sample=True, temperature=temperature, top_p=options.get("top_p", 0.9))
+        else:
+            kwargs.update(do_sample=False)
+
+        with torch.no_grad():
+            outputs = self.model.generate(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                max_new_tokens=options["num_predict"],
+                eos_token_id=self.tokenizer.eos_token_id,
+                pad_token_id=pad_token_id,
+                **kwargs,
+            )
+        elapsed = time.perf_counter() - start
+
+        results = []
+        for input_ids, sequence in zip(batch_ids, outputs[:, prompt_length:]):
+            tokens = [token for token in sequence.tolist() if token != pad_token_id]
+            results.append({
+                "response": self.tokenizer.decode(tokens, skip_special_tokens=True),
+                "done_reason": "length" if len(tokens) >= options["num_predict"] else "stop",
+                "prompt_eval_count": len(input_ids) - len(prefix_ids),
+                "eval_count": len(tokens),
+                "total_duration": int(elapsed * 1e9),
+                "batch_size": len(batch_ids),
+            })
+        return results
+
+def make_handler(generator, model_name, model_dir, max_new_tokens, compact=False):
+    class OllamaHandler(BaseHTTPRequestHandler):
+        """Implements the subset of the Ollama API the player mod calls: /api/generate and /api/tags."""
+
+        def _send_json(self, status, body, content_type="application/json"):
+            data = (body if isinstance(body, str) else json.dumps(body)).encode("UTF-8")
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == "/":
+                self._send_json(200, "Ollama is running", "text/plain")
+            elif self.path == "/api/tags":
+                self._send_json(200, {"models": [{
+                    "name": model_name,
+                    "model": model_name,
+                    "modified_at": datetime.fromtimestamp(os.path.getmtime(model_dir), timezone.utc).isoformat(),
+                    "size": sum(os.path.getsize(path) for path in glob.glob(os.path.join(model_dir, "*")) if os.path.isfile(path)),
+                    "details": {"format": "safetensors", "family": "llama"},
+                }]})
+            else:
+                self._send_json(404, {"error": "not found"})
+
+        def do_POST(self):
+            if self.path != "/api/generate":
+                self._send_json(404, {"error": "not found"})
+                return
+
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            except json.JSONDecodeError as e:
+                self._send_json(400, {"error": f"invalid JSON: {e}"})
+                return
+            if request.get("model", model_name) != model_name:
+                self._send_json(404, {"error": f"model '{request['model']}' not found"})
+                return
+
+            prompt = request.get("prompt", "")
+            if compact:
+                # Models trained with `create_dataset.py --compact` expect the compact state encoding
+                prompt = compact_prompt(prompt)
+            prompt_text = prompt if request.get("raw") else format_prompt(prompt, request.get("system"))
+            request_options = request.get("options") or {}
+            num_predict = request_options.get("num_predict", -1)
+            options = {
+                "num_predict": max_new_tokens if num_predict is None or num_predict < 0 else min(num_predict, max_new_tokens),
+                "temperature": float(request_options.get("temperature", 0.8)),
+                "top_p": float(request_options.get("top_p", 0.9)),
+                "seed": request_options.get("seed"),
+            }
+
+            try:
+                result = generator.submit(prompt_text, options).result()
+            except Exception as e:
+                self._send_json(500, {"error": str(e)})
+                return
+
+            if compact:
+                # ... and answer with an `act` line, which the player mod reads as an action block
+                result = dict(result, response=expand_action(result["response"]))
+
+            body = {"model": model_name, "created_at": datetime.now(timezone.utc).isoformat(), "done": True, **result}
+            if request.get("stream", True):
+                # Generation is batched, so a streaming client gets the whole response as one final chunk
+                self._send_json(200, json.dumps(body) + "\n", "application/x-ndjson")
+            else:
+                self._send_json(200, body)
+
+    return OllamaHandler
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the trained model over the Ollama /api/generate and /api/tags routes.')
+    parser.add_argument('--model-dir', type=str, default=None, help='Merged model directory. Defaults to the newest model in --output-dir.')
+    parser.add_argument('--output-dir', type=str, default="./output", help='Directory containing the models written by train.py.')
+    parser.add_argument('--model-name', type=str, default=DEFAULT_MODEL_NAME, help='Model name reported to and expected from clients.')
+    parser.add_argument('--host', type=str, default="127.0.0.1", help='Address to listen on.')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='Port to listen on.')
+    parser.add_argument('--device', type=str, default="cuda" if torch.cuda.is_available() else "cpu", help='Device to run the model on.')
+    parser.add_argument('--max-batch-size', type=int, default=8, help='Maximum requests generated together.')
+    parser.add_argument('--max-wait-ms', type=int, default=20, help='How long to wait for more requests before generating a batch.')
+    parser.add_argument('--max-new-tokens', type=int, default=512, help='Upper bound on tokens generated per request.')
+    parser.add_argument('--prefix-cache-size', type=int, default=4, help='Number of learned prompt prefixes to keep KV state for.')
+    parser.add_argument('--constrained', action='store_true', help='Constrain generated action blocks to the action schema.')
+    parser.add_argument('--compact', action='store_true', help='Rewrite YAML game state in prompts with the compact encoding.')
+    args = parser.parse_args()
+
+    model_dir = args.model_dir or find_latest_model(args.output_dir)
+    if not model_dir or not os.path.exists(model_dir):
+        print(f"Error: No model found (model dir: {model_dir}, output dir: {args.output_dir}).")
+        return
+
+    print(f"Loading model from {model_dir} on {args.device}...")
+    tokenizer = AutoTokenizer.from_pretrained(model_dir)
+    model = AutoModelForCausalLM.from_pretrained(
+        model_dir,
+        torch_dtype=torch.float16 if args.device.startswith("cuda") else torch.float32,
+    ).to(args.device).eval()
+
+    prefix_cache = PrefixCache(model, args.prefix_cache_size)
+    prefix_ids = tokenizer(f"{USER_TOKEN}\n{DEFAULT_PRE}", add_special_tokens=False)["input_ids"]
+    prefix_cache.add(prefix_ids[:-1], pinned=True)
+
+    generator = BatchGenerator(model, tokenizer, prefix_cache, args.max_batch_size, args.max_wait_ms, args.constrained)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(generator, args.model_name, model_dir, args.max_new_tokens, args.compact))
+    print(f"Serving {args.model_name} on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,10 @@
 import os
 import argparse
-from util import extract_timestamp
+from collections import deque
+import metrics
+from capture_index import get_sorted_files
+from capture_store import is_capture_store, iter_store_captures
+from dedup import dedup_captures
 
 
 # Define a function to read the content of a file
@@ -8,31 +12,60 @@ def read_file_content(filepath):
     with open(filepath, 'r') as file:
         return file.read()
 
-def process_files(input_directory, sliding_window_size=3, return_intermediates=False):
+def iter_captures(input_directory, files=None):
+    """
+    Yields (filename, content) in timestamp order from a capture directory or
+    capture store. `files` restricts a capture directory to those filenames.
+    """
+    if is_capture_store(input_directory):
+        yield from iter_store_captures(input_directory)
+        return
+
+    # Get all the .yaml files in the input directory, sorted by their extracted timestamp
+    for file in get_sorted_files(input_directory) if files is None else files:
+        with metrics.timed("read"):
+            content = read_file_content(os.path.join(input_directory, file))
+        metrics.increment("captures_read")
+        yield file, content
+
+def iter_windows(captures, sliding_window_size=3):
+    """
+    Yields (window_files, window_contents) for each sliding window over the
+    (filename, content) pairs in captures. Every capture is read exactly once
+    and only the last sliding_window_size contents are kept.
+    """
+    window_files = deque(maxlen=sliding_window_size)
+    window_contents = deque(maxlen=sliding_window_size)
+
+    for file, content in captures:
+        window_files.append(file)
+        window_contents.append(content)
+
+        if len(window_contents) == sliding_window_size:
+            yield list(window_files), list(window_contents)
+
+def join_window(window_contents):
+    return "\n".join(window_contents) + "\n"
+
+def process_files(input_directory, sliding_window_size=3, return_intermediates=False, dedup=False, dedup_log=None):
     
     if sliding_window_size < 1:
         raise Exception(f"Invalind sliding_window_size={sliding_window_size}")
     
-    # Get all the .yaml files in the input directory
-    files = [f for f in os.listdir(input_directory) if f.endswith('.yaml')]
-    
-    # Sort the files based on their extracted timestamp
-    sorted_files = sorted(files, key=lambda f: extract_timestamp(f))
-    
-    # Apply a sliding window of size 3
-    for i in range(len(sorted_files) - (sliding_window_size-1)):
-        # Get the filenames in the current sliding window
-        window_files = sorted_files[i:i+sliding_window_size]
-        
-        # Read and concatenate the contents of the three files
-        combined_content = ""
-        for file in window_files:
-            intermediate = read_file_content(os.path.join(input_directory, file))
-            combined_content += intermediate + "\n"
-            if return_intermediates:
-                yield intermediate
+    captures = iter_captures(input_directory)
+    if dedup:
+        # Collapse runs of near-identical captures before they are windowed
+        captures = dedup_captures(captures, log_path=dedup_log)
+
+    yield from iter_window_texts(captures, sliding_window_size, return_intermediates)
+
+def iter_window_texts(captures, sliding_window_size=3, return_intermediates=False):
+    """The texts process_files yields, for (filename, content) pairs from any source."""
+    for _, window_contents in iter_windows(captures, sliding_window_size):
+        if return_intermediates:
+            yield from window_contents
         
-        yield combined_content
+        yield join_window(window_contents)
         
 
 # Define the main function to process the files
@@ -41,29 +74,14 @@ def process_and_save_files(input_directory, output_directory, sliding_window_siz
     if sliding_window_size < 1:
         raise Exception(f"Invalind sliding_window_size={sliding_window_size}")
     
-    # Get all the .yaml files in the input directory
-    files = [f for f in os.listdir(input_directory) if f.endswith('.yaml')]
-    
-    # Sort the files based on their extracted timestamp
-    sorted_files = sorted(files, key=lambda f: extract_timestamp(f))
-    
-    # Apply a sliding window of size 3
-    for i in range(len(sorted_files) - (sliding_window_size-1)):
-        # Get the filenames in the current sliding window
-        window_files = sorted_files[i:i+sliding_window_size]
-        
+    for window_files, window_contents in iter_windows(iter_captures(input_directory), sliding_window_size):
         # Create a new filename for the concatenated result
-        output_filename = f'combined_{window_files[0][5:-5]}_to_{window_files[2][5:-5]}.yaml'
+        output_filename = f'combined_{window_files[0][5:-5]}_to_{window_files[-1][5:-5]}.yaml'
         output_filepath = os.path.join(output_directory, output_filename)
         
-        # Read and concatenate the contents of the three files
-        combined_content = ""
-        for file in window_files:
-            combined_content += read_file_content(os.path.join(input_directory, file)) + "\n"
-        
         # Write the combined content to a new file in the output directory
         with open(output_filepath, 'w') as output_file:
-            output_file.write(combined_content)
+            output_file.write(join_window(window_contents))
         
         print(f'Created: {output_filename}')
 
@@ -0,0 +1,266 @@
+import os
+import re
+import math
+import random
+import argparse
+from datetime import datetime, timedelta
+from multiprocessing import Pool
+from capture_util import ACTION_PARAMETERS
+
+# Mix of functions in a typical capture directory: movement dominates since it is captured every tick
+DEFAULT_FUNCTION_MIX = {
+    "move": 0.85,
+    "interact_block": 0.05,
+    "use_item": 0.02,
+    "pickup_item": 0.02,
+    "attack_entity": 0.02,
+    "container_event": 0.01,
+    "destroy_item": 0.01,
+    "craft_item": 0.01,
+    "player_sleep": 0.005,
+    "player_wake": 0.005,
+}
+
+BLOCKS = ["grass_block", "dirt", "stone", "air", "oak_log", "oak_planks", "sand", "water", "cobblestone", "short_grass"]
+ITEMS = ["stone", "dirt", "oak_log", "oak_planks", "stick", "torch", "bread", "iron_ingot", "wooden_pickaxe", "stone_sword"]
+ENTITIES = ["cow", "sheep", "pig", "chicken", "zombie", "skeleton", "creeper", "spider"]
+BIOMES = ["plains", "forest", "desert", "river", "taiga"]
+CONTAINERS = ["ChestMenu", "CraftingMenu", "FurnaceMenu", "InventoryMenu"]
+DIRECTIONS = ["forward", "backward", "left", "right"]
+MAP_DIRECTIONS = ["north", "south", "east", "west", "northeast", "southeast", "southwest", "northwest"]
+
+# Iteration order of the Java HashMaps the mod dumps, keyed by their insertion order
+_hashmap_orders = {}
+
+def java_string_hash(text):
+    h = 0
+    for char in text:
+        h = (31 * h + ord(char)) & 0xFFFFFFFF
+    return h
+
+def java_hashmap_order(keys):
+    """
+    Returns keys in the order a java.util.HashMap with default capacity iterates
+    them, which is the order SnakeYAML writes the mod's maps in: by bucket
+    (spread hash & table size - 1), then by insertion within a bucket.
+    """
+    keys = tuple(keys)
+    if keys not in _hashmap_orders:
+        capacity = 16
+        while len(keys) > capacity * 0.75:
+            capacity *= 2
+
+        def bucket(key):
+            h = java_string_hash(key)
+            return (h ^ (h >> 16)) & (capacity - 1)
+
+        _hashmap_orders[keys] = sorted(keys, key=lambda key: (bucket(key), keys.index(key)))
+    return _hashmap_orders[keys]
+
+def java_timestamp(value):
+    """LocalDateTime.toString() with ':' replaced by '-', as used in capture filenames."""
+    # Java omits the fraction when it is zero, and the seconds too when both are zero
+    if value.second == 0 and value.microsecond == 0:
+        return value.strftime('%Y-%m-%dT%H-%M')
+    text = value.strftime('%Y-%m-%dT%H-%M-%S')
+    if value.microsecond == 0:
+        return text
+    if value.microsecond % 1000 == 0:
+        # Java prints the fraction in groups of three digits
+        return f"{text}.{value.microsecond // 1000:03d}"
+    return f"{text}.{value.microsecond:06d}"
+
+def _scalar(value):
+    # Quote strings the way SnakeYAML does when they would not read back as the same plain string
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if not isinstance(value, str):
+        return repr(value)
+    if not value or ': ' in value or ' #' in value or value[0] in "-?:,[]{}#&*!|>'\"%@`" \
+            or re.fullmatch(r'true|false|yes|no|on|off|null|~|[-+]?[\d.]+', value, re.IGNORECASE):
+        return "'" + value.replace("'", "''") + "'"
+    return value
+
+def _sequence(lines, indent, items):
+    if not items:
+        lines[-1] += " []"
+        return
+    for item in items:
+        lines.append(f"{indent}- {_scalar(item)}")
+
+def render_capture(capture):
+    """
+    Renders a capture dict as the mod's SnakeYAML dump (block style, indent 2,
+    sequences not indented under their key). Nested maps are written in the
+    iteration order of the Java HashMaps the mod builds them in.
+    """
+    lines = []
+    for key, value in capture.items():
+        lines.append(f"{key}:")
+        if key in ("environment", "player", "action"):
+            for field in java_hashmap_order(value):
+                field_value = value[field]
+                lines.append(f"  {field}:")
+                if isinstance(field_value, list):
+                    _sequence(lines, "  ", field_value)
+                elif isinstance(field_value, dict):
+                    if not field_value:
+                        lines[-1] += " {}"
+                    for parameter in java_hashmap_order(field_value):
+                        parameter_value = field_value[parameter]
+                        lines.append(f"    {parameter}:")
+                        if isinstance(parameter_value, list):
+                            _sequence(lines, "    ", parameter_value)
+                        else:
+                            lines[-1] += f" {_scalar(parameter_value)}"
+                else:
+                    lines[-1] += f" {_scalar(field_value)}"
+        elif key == "nearby_entities":
+            if not value:
+                lines[-1] += " []"
+            for entity in value:
+                fields = java_hashmap_order(entity)
+                lines.append(f"- {fields[0]}: {_scalar(entity[fields[0]])}")
+                lines.extend(f"  {field}: {_scalar(entity[field])}" for field in fields[1:])
+        else:
+            _sequence(lines, "", value)
+    return "\n".join(lines) + "\n"
+
+def random_parameters(rng, function_name, inventory_size):
+    if function_name == "move":
+        return {
+            "direction": rng.choice(DIRECTIONS),
+            "distance": rng.uniform(0.05, 0.4),
+            "jumping": "true" if rng.random() < 0.05 else "false",
+        }
+    if function_name == "interact_block":
+        return {
+            "block": f"block.minecraft.{rng.choice(BLOCKS)}",
+            "interaction": rng.choice(["LeftClickBlock", "RightClickBlock"]),
+        }
+    if function_name == "player_sleep":
+        return {"bed_position": f"BlockPos{{x={rng.randint(-500, 500)}, y={rng.randint(60, 80)}, z={rng.randint(-500, 500)}}}"}
+    if function_name == "player_wake":
+        return {"wake_immediately": rng.random() < 0.5}
+    if function_name == "attack_entity":
+        return {
+            "entity_type": f"translation{{key='entity.minecraft.{rng.choice(ENTITIES)}', args=[]}}",
+            "weapon": f"translation{{key='item.minecraft.{rng.choice(ITEMS)}', args=[]}}",
+        }
+    if function_name == "container_event":
+        return {"container": rng.choice(CONTAINERS)}
+    item = f"translation{{key='item.minecraft.{rng.choice(ITEMS)}', args=[]}}"
+    if function_name in ("use_item", "destroy_item"):
+        return {"item": item}
+    if function_name == "pickup_item":
+        return {"item": item, "count": rng.randint(1, 64)}
+    if function_name == "craft_item":
+        # The mod lists the crafted item once per occupied inventory slot
+        return {"item": item, "count": rng.randint(1, 4), "ingredients": [item] * inventory_size}
+    return {key: rng.randint(0, 9) for key in ACTION_PARAMETERS.get(function_name, ())}
+
+class CaptureGenerator:
+    """
+    Random walk of a player that yields captures with the same keys, types and
+    string formats as PlayerEventHandler.collectCommonData plus an action drawn
+    from function_mix.
+    """
+
+    def __init__(self, seed=0, function_mix=None, inventory_size=9, entities=2):
+        self.rng = random.Random(seed)
+        mix = function_mix or DEFAULT_FUNCTION_MIX
+        self.functions = list(mix)
+        self.weights = [mix[name] for name in self.functions]
+        self.inventory_size = inventory_size
+        self.entities = entities
+        self.position = [self.rng.uniform(-500, 500), 64.0, self.rng.uniform(-500, 500)]
+        self.biome = self.rng.choice(BIOMES)
+        self.inventory = [(slot, self.rng.choice(ITEMS), self.rng.randint(1, 64)) for slot in range(inventory_size)]
+
+    def next_capture(self):
+        rng = self.rng
+        function_name = rng.choices(self.functions, self.weights)[0]
+        parameters = random_parameters(rng, function_name, self.inventory_size)
+        if function_name == "move":
+            self.position[0] += rng.uniform(-0.3, 0.3)
+            self.position[2] += rng.uniform(-0.3, 0.3)
+        if rng.random() < 0.001:
+            self.biome = rng.choice(BIOMES)
+
+        yaw = rng.uniform(0, 6.283)
+        return {
+            "environment": {
+                "time_of_day": "day" if rng.random() < 0.7 else "night",
+                "weather": "clear" if rng.random() < 0.9 else "rain",
+                "biome": f"minecraft:{self.biome}",
+            },
+            "player": {
+                "position": "x=%.2f, y=%.2f, z=%.2f" % tuple(self.position),
+                "orientation": "x=%.2f, y=%.2f, z=%.2f" % (-math.sin(yaw), rng.uniform(-0.5, 0.5), math.cos(yaw)),
+                "health": rng.choice([20.0, 20.0, 20.0, 18.5, 15.0, 9.5]),
+                "hunger": rng.randint(14, 20),
+                "inventory": [f"Slot {slot}: item.minecraft.{item} x{count}" for slot, item, count in self.inventory],
+            },
+            "nearby_entities": [
+                {
+                    "type": f"translation{{key='entity.minecraft.{rng.choice(ENTITIES)}', args=[]}}",
+                    "position": f"dx={rng.randint(-10, 10)}, dy={rng.randint(-2, 2)}, dz={rng.randint(-10, 10)}",
+                }
+                for _ in range(self.entities)
+            ],
+            "map_blocks": [f"block.minecraft.{rng.choice(BLOCKS)} {direction} of player" for direction in MAP_DIRECTIONS],
+            "action": {"function": function_name, "parameters": parameters},
+        }
+
+def _write_range(args):
+    output_dir, start_index, count, seed, function_mix, inventory_size, entities, start = args
+    generator = CaptureGenerator(seed + start_index, function_mix, inventory_size, entities)
+    for i in range(start_index, start_index + count):
+        # Captures arrive every 50ms tick, plus some jitter so the fractions vary in length
+        timestamp = start + timedelta(milliseconds=50 * i, microseconds=generator.rng.randint(0, 999) if i % 4 else 0)
+        with open(os.path.join(output_dir, f"data_{java_timestamp(timestamp)}.yaml"), 'w') as f:
+            f.write(render_capture(generator.next_capture()))
+    return count
+
+def write_captures(output_dir, num_files, seed=0, function_mix=None, inventory_size=9, entities=2, workers=1, chunk_size=10000):
+    """
+    Writes num_files synthetic `data_<timestamp>.yaml` captures to output_dir.
+    With workers > 1 the files are written in chunks by a process pool; each
+    chunk is its own random walk seeded from seed and its first index.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    start = datetime(2024, 10, 1, 12)
+    chunks = [
+        (output_dir, i, min(chunk_size, num_files - i), seed, function_mix, inventory_size, entities, start)
+        for i in range(0, num_files, chunk_size)
+    ]
+    if workers <= 1:
+        return sum(map(_write_range, chunks))
+    with Pool(workers) as pool:
+        return sum(pool.imap_unordered(_write_range, chunks))
+
+def parse_function_mix(text):
+    """Parses `move=0.8,use_item=0.2` into a weight dict."""
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        mix[name.strip()] = float(weight)
+    return mix
+
+def main():
+    parser = argparse.ArgumentParser(description='Write synthetic captures in the data collection mod\'s YAML format.')
+    parser.add_argument('--output-dir', type=str, required=True, help='Directory to write the captures to.')
+    parser.add_argument('--num-files', type=int, default=10000, help='Number of captures to write.')
+    parser.add_argument('--function-mix', type=str, default=None, help='Function weights, e.g. move=0.8,use_item=0.2 (default: a typical capture mix).')
+    parser.add_argument('--inventory-size', type=int, default=9, help='Occupied inventory slots per capture.')
+    parser.add_argument('--entities', type=int, default=2, help='Nearby entities per capture.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed.')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Processes writing captures.')
+    args = parser.parse_args()
+
+    function_mix = parse_function_mix(args.function_mix) if args.function_mix else None
+    written = write_captures(args.output_dir, args.num_files, args.seed, function_mix, args.inventory_size, args.entities, args.workers)
+    print(f"Wrote {written} captures to {args.output_dir}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+import os
+import json
+import hashlib
+from collections import deque, Counter
+import metrics
+from util import apply_template
+from sliding_window import join_window
+
+DEFAULT_MAX_WINDOW_SIZE = 8
+HISTOGRAM_BIN_TOKENS = 128
+
+def get_token_counts_dir(dataset_dir):
+    # Shared by the datasets in one output directory, like train.py's packed_cache
+    return os.path.join(os.path.dirname(os.path.abspath(dataset_dir)), "token_counts")
+
+def get_cache_key(tokenizer, input_dir):
+    digest = hashlib.sha256(f"{tokenizer.name_or_path}\0{len(tokenizer)}\0{os.path.abspath(input_dir)}".encode("UTF-8"))
+    return digest.hexdigest()[:16]
+
+class TokenCountCache:
+    """
+    Token count of each capture in input_dir for one tokenizer. Counts are kept
+    in a TSV in cache_dir (never in the capture directory, which belongs to the
+    mod) and reused while a capture's length is unchanged, so a rebuild only
+    tokenizes captures it has not seen.
+    """
+
+    def __init__(self, tokenizer, input_dir, cache_dir):
+        self.tokenizer = tokenizer
+        self.path = os.path.join(cache_dir, f"{get_cache_key(tokenizer, input_dir)}.tsv")
+        self.counts = {}
+        self.hits = 0
+        self.misses = 0
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                for line in f:
+                    filename, size, count = line.rstrip('\n').split('\t')
+                    self.counts[filename] = (int(size), int(count))
+
+    def count(self, filename, content):
+        entry = self.counts.get(filename)
+        if entry is not None and entry[0] == len(content):
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        with metrics.timed("token_count"):
+            count = len(self.tokenizer(content, add_special_tokens=False)["input_ids"])
+        self.counts[filename] = (len(content), count)
+        return count
+
+    def save(self):
+        if not self.misses:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(f"{self.path}.tmp", 'w') as f:
+                for filename, (size, count) in self.counts.items():
+                    f.write(f"{filename}\t{size}\t{count}\n")
+            os.replace(f"{self.path}.tmp", self.path)
+        except OSError as e:
+            print(f"Unable to save token counts to {self.path}: {e}")
+
+class TokenBudget:
+    """
+    Sizes each sliding window to the most recent captures (up to
+    max_window_size) whose templated sample fits in token_budget tokens. Window
+    sizes are estimated from cached per-capture counts, then each sample's
+    length is checked by templating and tokenizing it the way the dataset and
+    training will. The checked lengths and window sizes are recorded as it goes.
+    make_conversation turns a window's text into the conversation the dataset
+    stores for it.
+    """
+
+    def __init__(self, tokenizer, input_dir, cache_dir, make_conversation, token_budget, max_window_size=DEFAULT_MAX_WINDOW_SIZE, pre=""):
+        self.tokenizer = tokenizer
+        self.cache = TokenCountCache(tokenizer, input_dir, cache_dir)
+        self.token_budget = token_budget
+        self.max_window_size = max_window_size
+        self.make_conversation = make_conversation
+        # Tokens the chat template and the instruction prefix add to every sample
+        templated = apply_template(tokenizer, [[[{"from": "human", "value": pre}, {"from": "gpt", "value": ""}]]])[0]['text']
+        self.overhead = len(tokenizer(templated, add_special_tokens=True)["input_ids"])
+        self.lengths = Counter()
+        self.window_sizes = Counter()
+        self.dropped = 0
+        self.overruns = 0
+
+    def capture_tokens(self, filename, content):
+        # Each capture is followed by the newline join_window adds
+        return self.cache.count(filename, content) + 1
+
+    def sample_tokens(self, text):
+        """Tokens in the templated sample for a window's text, counted as packed_dataset counts them."""
+        with metrics.timed("token_check"):
+            templated = apply_template(self.tokenizer, [[self.make_conversation(text)]])[0]['text']
+            return len(self.tokenizer(templated, add_special_tokens=True)["input_ids"])
+
+    def fit(self, window, min_size=1):
+        """
+        Returns the text of the (content, tokens) window with its oldest
+        captures dropped until the templated sample is within the budget, or
+        None when it would take fewer than min_size captures to fit.
+        """
+        overrun = False
+        while len(window) >= min_size:
+            text = join_window([content for content, _ in window])
+            tokens = self.sample_tokens(text)
+            if tokens <= self.token_budget:
+                self.record(tokens, len(window))
+                return text
+            if not overrun:
+                overrun = True
+                self.overruns += 1
+                metrics.increment("budget_overruns")
+            window = window[1:]
+        if min_size == 1:
+            self.dropped += 1
+            metrics.increment("budget_dropped")
+        return None
+
+    def record(self, tokens, window_size):
+        self.lengths[tokens] += 1
+        self.window_sizes[window_size] += 1
+
+    def report(self):
+        samples = sum(self.lengths.values())
+        ordered = sorted(self.lengths.elements())
+        histogram = Counter()
+        for length, count in self.lengths.items():
+            histogram[length // HISTOGRAM_BIN_TOKENS * HISTOGRAM_BIN_TOKENS] += count
+        return {
+            "token_budget": self.token_budget,
+            "max_window_size": self.max_window_size,
+            "template_overhead_tokens": self.overhead,
+            "samples": samples,
+            "dropped_captures": self.dropped,
+            "overrun_samples": self.overruns,
+            "p50_tokens": ordered[samples // 2] if samples else 0,
+            "p95_tokens": ordered[min(samples - 1, int(samples * 0.95))] if samples else 0,
+            "budget_fill": sum(length * count for length, count in self.lengths.items()) / max(1, samples * self.token_budget),
+            "length_histogram": {f"{start}-{start + HISTOGRAM_BIN_TOKENS - 1}": count for start, count in sorted(histogram.items())},
+            "window_sizes": dict(sorted(self.window_sizes.items())),
+            "token_cache": {"hits": self.cache.hits, "misses": self.cache.misses},
+        }
+
+    def print_report(self, report_path=None):
+        report = self.report()
+        print(f"Budgeted windows: {report['samples']} samples, p50 {report['p50_tokens']} / p95 {report['p95_tokens']} tokens "
+              f"of {self.token_budget}, {report['dropped_captures']} captures over budget on their own")
+        if report["overrun_samples"]:
+            print(f"{report['overrun_samples']} samples were estimated to fit but were over budget once templated, and were shrunk")
+        print("Window sizes: " + ", ".join(f"{size}: {count}" for size, count in report["window_sizes"].items()))
+        if report_path:
+            with open(report_path, 'w') as f:
+                json.dump(report, f, indent=2)
+            print(f"Length histogram saved to {report_path}")
+        return report
+
+def iter_budget_windows(captures, budget, warmup=0):
+    """
+    Yields the (content, tokens) pairs of the window ending at each capture:
+    the longest run of most recent captures, up to max_window_size, that fits
+    the budget. A capture that does not fit on its own is skipped and counted
+    rather than left to be truncated in training. The first `warmup` captures
+    only fill the windows of the captures after them.
+    """
+    recent = deque(maxlen=budget.max_window_size)
+    for idx, (filename, content) in enumerate(captures):
+        recent.append((content, budget.capture_tokens(filename, content)))
+        if idx < warmup:
+            continue
+
+        tokens = budget.overhead
+        size = 0
+        for _, capture_tokens in reversed(recent):
+            if tokens + capture_tokens > budget.token_budget:
+                break
+            tokens += capture_tokens
+            size += 1
+
+        if size == 0:
+            budget.dropped += 1
+            metrics.increment("budget_dropped")
+            continue
+        yield list(recent)[-size:]
+
+def iter_budget_window_texts(captures, budget, return_intermediates=False, warmup=0):
+    """
+    The budgeted counterpart of sliding_window.iter_window_texts. Intermediates
+    are only the newest capture of each window on its own, so every capture
+    becomes one single-capture sample rather than one per window it is in.
+    Every sample is checked with TokenBudget.fit before it is yielded.
+    """
+    for window in iter_budget_windows(captures, budget, warmup):
+        newest = None
+        if return_intermediates and len(window) > 1:
+            newest = budget.fit(window[-1:])
+            if newest is None:
+                # The window can only shrink to its newest capture, which is over budget on its own
+                continue
+            yield newest
+        # Once the newest capture is a sample of its own, a window shrunk down to it would repeat it
+        text = budget.fit(window, 1 if newest is None else 2)
+        if text is not None:
+            yield text
+    budget.cache.save()
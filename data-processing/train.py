@@ -1,64 +1,37 @@
 import argparse
 import os
 import uuid
-import torch
-import json
-from datasets import Dataset
+import metrics
 from trl import SFTTrainer
-from datasets import load_dataset
-from transformers import TrainingArguments, TextStreamer
-from unsloth.chat_templates import get_chat_template
-from unsloth import FastLanguageModel, is_bfloat16_supported
-from util import load_models, get_dataset_idx_by_function_name, get_unique_function
-from create_dataset import create_dataset
+from transformers import TrainingArguments
+from unsloth import is_bfloat16_supported
+from util import load_models, stratified_sample
 from datasets import concatenate_datasets
 from eval import run_eval
+from packed_dataset import get_packed_dataset
+from dataset_writer import has_dataset, load_dataset_with_deltas
+from merge_worker import MergeQueue, save_adapter
 
 max_seq_length = 2048
 
-def apply_function_filter(dataset, limit=0):
-    functions = list(get_unique_function(dataset).keys())
-    function_filters = []
-    
-    if limit == 0:
-        limit == 100
-
-    for function_name in functions:
-        if function_name == "move":
-            function_filters.append((function_name, limit*.2, "left"))
-            function_filters.append((function_name, limit*.2, "right"))
-            function_filters.append((function_name, limit, "forward"))
-            function_filters.append((function_name, limit*.2, "backward"))
-        else:
-            function_filters.append((function_name, limit, None))
-
-    filtered_dataset_idx = []
-    for function_filter in function_filters:
-        print(f"Filtering function {function_filter[0]} with filter=`{function_filter[0]} + {function_filter[2] or 'None'}` limit={function_filter[1]}")
-
-        function_dataset_idx = list(get_dataset_idx_by_function_name(dataset, function_filter[0], function_filter[1], function_filter[2]))
-        if len(function_dataset_idx) > 0:
-            print(f"{len(function_dataset_idx)} items selected for {function_filter[0]}")
-            filtered_dataset_idx.extend(function_dataset_idx)
-        else:
-            print(f"{len(function_dataset_idx)} items selected for {function_filter[0]}")
-
-    return dataset.select(filtered_dataset_idx)
+def apply_function_filter(dataset, limit=0, seed=0, epoch=0):
+    return dataset.select(stratified_sample(dataset, limit, seed, epoch))
 
-def get_dataset(dataset_dirs, function_filter_limit):
+def get_dataset(dataset_dirs, function_filter_limit, seed=0, epoch=0):
     datasets = []
 
     for dataset_dir in dataset_dirs:
 
-        if os.path.exists(dataset_dir):
+        if has_dataset(dataset_dir):
             print(f"Dataset exists at {dataset_dir}. Loading dataset...")
-            dataset = Dataset.load_from_disk(dataset_dir)
+            # Base dataset plus any delta shards ingest.py appended since it was built
+            dataset = load_dataset_with_deltas(dataset_dir)
             print(f"Dataset loaded successfully from {dataset_dir}.")
 
             #The len(dataset) > 1000 is a bit of a hack to ensure that the story datasets do not get filters applied.
             if len(dataset) > 5000 and function_filter_limit > 0:
                 print(f"Applying function filter to dataset ({function_filter_limit}).")
-                dataset = apply_function_filter(dataset, function_filter_limit)
+                dataset = apply_function_filter(dataset, function_filter_limit, seed, epoch)
 
             datasets.append(dataset)
         else:
@@ -74,7 +47,7 @@ def get_dataset(dataset_dirs, function_filter_limit):
     print("First few rows in dataset:")
     for idx in range(min(5, len(dataset))):
         example = dataset[idx]
-        print(f"Example {idx}: Type={type(example)}, Content={example}")
+        print(f"Example {idx}: Type={type(example)}, Content={metrics.preview(example)}")
         if 'text' not in example:
             print(f"Error: Example {idx} is missing 'text' key.")
         elif not isinstance(example['text'], str):
@@ -90,6 +63,15 @@ def main():
     parser.add_argument('--dataset-names', type=str, nargs='+', default=["dataset"], help='Dataset(s) used in training model.')
     parser.add_argument('--apply-function-filter', type=int, default=0, help='Filter functions to N occurences.')
     parser.add_argument('--epochs', type=int, default=1, help='Training Epochs.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for function filter sampling.')
+    parser.add_argument('--same-sample-each-epoch', action='store_true', help='Train every epoch on the first epoch\'s function filter sample instead of drawing a new one.')
+    parser.add_argument('--dataset-num-proc', type=int, default=os.cpu_count(), help='Processes used to tokenize and pack the dataset on a cache miss.')
+    parser.add_argument('--async-merge', action='store_true', help='Save only the LoRA adapter each epoch and merge it to 16-bit in a background process.')
+    parser.add_argument('--merge-device', type=str, default="cpu", help='Device the background merge runs on.')
+    parser.add_argument('--merge-exports', type=str, nargs='*', default=[], help='GGUF outtypes the background merge also exports (e.g. f16 q8_0).')
+    parser.add_argument('--save-adapters', action='store_true', help='Save the LoRA adapter after every epoch (for eval_worker.py); implied by --async-merge.')
+    parser.add_argument('--eval-every', type=int, default=0, help='Run the inline sample eval every N epochs (0 disables; prefer eval_worker.py).')
+    metrics.add_arguments(parser)
 
     args = parser.parse_args()
 
@@ -101,6 +83,7 @@ def main():
     checkpoint_path = args.checkpoint_path
     function_filter_limit = args.apply_function_filter
     epochs = args.epochs
+    seed = args.seed
 
     model, tokenizer = load_models(checkpoint_path)
 
@@ -108,57 +91,109 @@ def main():
 
     print(f"Training (run id:{run_id})...")
 
-    final_train_loss = 0.0
-
-    for i in range(epochs):
-        print(f"Training epoch {i+1}")
-        checkpoint_dir = f"{output_dir}/checkpoints-{dataset_names_combined}-{run_id}-{i}"
-        os.makedirs(checkpoint_dir, exist_ok=True)
-        current_dataset = get_dataset(dataset_dirs, function_filter_limit)
-        trainer=SFTTrainer(
-            model=model,
-            tokenizer=tokenizer,
-            train_dataset=current_dataset,
-            dataset_text_field="text",
-            max_seq_length=max_seq_length,
-            dataset_num_proc=2,
-            packing=True,
-            args=TrainingArguments(
-                learning_rate=3e-4,
-                lr_scheduler_type="linear",
-                per_device_train_batch_size=8,
-                gradient_accumulation_steps=2,
-                num_train_epochs=1,
-                fp16=not is_bfloat16_supported(),
-                bf16=is_bfloat16_supported(),
-                logging_steps=1,
-                optim="adamw_8bit",
-                weight_decay=0.01,
-                warmup_steps=10,
-                output_dir=checkpoint_dir,
-                seed=0,
-            ),
-        )
-
-        if i == 0 and checkpoint_path:
-            training_output = trainer.train(resume_from_checkpoint=checkpoint_path)
+    metrics_report = args.metrics_report or os.path.join(output_dir, f"train-{run_id}_metrics.json")
+
+    # The report is written however the run ends, so failed and interrupted runs have metrics too
+    with metrics.run_metrics(metrics_report, args.progress_interval, {"run": "train", "run_id": run_id}):
+        final_train_loss = 0.0
+
+        def get_epoch_dataset(epoch):
+            # The filtered sample is seeded so the packed cache below can be reused across runs
+            dataset = get_dataset(dataset_dirs, function_filter_limit, seed, epoch)
+
+            # Tokenize and pack once per sample; every epoch (and later runs) memory-map the cached result
+            packed = get_packed_dataset(
+                dataset,
+                tokenizer,
+                max_seq_length,
+                os.path.join(output_dir, "packed_cache"),
+                {"function_filter_limit": function_filter_limit, "seed": seed, "epoch": epoch},
+                args.dataset_num_proc,
+                seed,
+            )
+            return dataset, packed
+
+        current_dataset, packed_dataset = get_epoch_dataset(0)
+
+        # Started before training so the worker process is up by the time the first adapter is saved
+        merge_queue = MergeQueue(output_dir, args.merge_device, args.merge_exports) if args.async_merge else None
+
+        for i in range(epochs):
+            print(f"Training epoch {i+1}")
+            if i > 0 and not args.same_sample_each_epoch and function_filter_limit > 0:
+                current_dataset, packed_dataset = get_epoch_dataset(i)
+            checkpoint_dir = f"{output_dir}/checkpoints-{dataset_names_combined}-{run_id}-{i}"
+            os.makedirs(checkpoint_dir, exist_ok=True)
+            trainer=SFTTrainer(
+                model=model,
+                tokenizer=tokenizer,
+                train_dataset=packed_dataset,
+                dataset_text_field="text",
+                max_seq_length=max_seq_length,
+                packing=False,
+                dataset_kwargs={"skip_prepare_dataset": True},
+                args=TrainingArguments(
+                    learning_rate=3e-4,
+                    lr_scheduler_type="linear",
+                    per_device_train_batch_size=8,
+                    gradient_accumulation_steps=2,
+                    num_train_epochs=1,
+                    fp16=not is_bfloat16_supported(),
+                    bf16=is_bfloat16_supported(),
+                    logging_steps=1,
+                    optim="adamw_8bit",
+                    weight_decay=0.01,
+                    warmup_steps=10,
+                    output_dir=checkpoint_dir,
+                    # The adapter saved after each epoch replaces the full trainer checkpoints
+                    save_strategy="no" if args.async_merge else "steps",
+                    seed=0,
+                ),
+            )
+
+            with metrics.timed("train_epoch"):
+                if i == 0 and checkpoint_path:
+                    training_output = trainer.train(resume_from_checkpoint=checkpoint_path)
+                else:
+                    training_output = trainer.train()
+
+            metrics.increment("train_steps", training_output.global_step)
+            for name in ("train_steps_per_second", "train_samples_per_second", "train_loss"):
+                if name in training_output.metrics:
+                    metrics.set_gauge(name, training_output.metrics[name])
+
+            train_loss = training_output.metrics.get('train_loss')
+            if train_loss is not None:
+                final_train_loss = train_loss
+            else:
+                print(f"Warning: 'train_loss' not found in metrics for epoch {i+1}")
+
+            if merge_queue is not None or args.save_adapters:
+                adapter_dir = os.path.join(output_dir, f"adapter-{dataset_names_combined}-{run_id}-{i}")
+                with metrics.timed("save_adapter"):
+                    save_adapter(model, tokenizer, adapter_dir)
+                print(f"Saved adapter to {adapter_dir}")
+
+            if merge_queue is not None:
+                epoch_name = "" if i == epochs - 1 else f"-epoch-{i+1}"
+                model_dir = os.path.join(output_dir, f'model-for-{dataset_names_combined}-{run_id}{epoch_name}-loss-{final_train_loss:.4f}-max-seq-{max_seq_length}')
+                print(f"Queued merge to {model_dir}")
+                merge_queue.submit(adapter_dir, model_dir, run_id=run_id, epoch=i + 1, train_loss=final_train_loss)
+
+            if args.eval_every > 0 and (i + 1) % args.eval_every == 0:
+                print(f"Running eval after epoch {i+1}...")
+                with metrics.timed("eval"):
+                    run_eval(model, tokenizer, current_dataset)
+
+
+        if merge_queue is not None:
+            with metrics.timed("merge_wait"):
+                merge_queue.close()
         else:
-            training_output = trainer.train()
-
-        train_loss = training_output.metrics.get('train_loss')
-        if train_loss is not None:
-            final_train_loss = train_loss
-        else:
-            print(f"Warning: 'train_loss' not found in metrics for epoch {i+1}")
-
-        if i % 5:    
-            print(f"Running eval after epoch {i+1}...")
-            run_eval(model, tokenizer, current_dataset)
-
-
-    model_dir = os.path.join(output_dir, f'model-for-{dataset_names_combined}-{run_id}-loss-{final_train_loss:.4f}-max-seq-{max_seq_length}')
-    print(f"Saving model to {model_dir}...")
-    model.save_pretrained_merged(model_dir, tokenizer, save_method="merged_16bit")
+            model_dir = os.path.join(output_dir, f'model-for-{dataset_names_combined}-{run_id}-loss-{final_train_loss:.4f}-max-seq-{max_seq_length}')
+            print(f"Saving model to {model_dir}...")
+            with metrics.timed("save_merged"):
+                model.save_pretrained_merged(model_dir, tokenizer, save_method="merged_16bit")
 
     #print("Running Final Eval...")
     #run_eval(model, tokenizer, Dataset.load_from_disk(dataset_dir))
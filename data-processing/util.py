@@ -1,33 +1,37 @@
 import os
-from unsloth.chat_templates import get_chat_template
-from unsloth import FastLanguageModel
+import glob
+import math
 import random
-import re
-from datetime import datetime
+import numpy as np
+from capture_util import get_action_labels
 
 max_seq_length = 2048
 
-# Define a function to extract the timestamp from the filename
-def extract_timestamp(filename):
-    # Regex to match the timestamp in the filename
-    match = re.search(r'data_(\d{4}-\d{2}-\d{2}T\d{2}-\d{2}-\d{2}\.\d+)\.yaml', filename)
-    if match:
-        timestamp_str = match.group(1)
-        # Split the timestamp into the datetime part and microseconds
-        dt_part, microseconds = timestamp_str.split('.')
-        # Truncate microseconds to 6 digits if it's longer
-        microseconds = microseconds[:6]
-        # Reconstruct the timestamp string with the truncated microseconds
-        truncated_timestamp_str = f"{dt_part}.{microseconds}"
-        # Convert the string to a datetime object
-        return datetime.strptime(truncated_timestamp_str, '%Y-%m-%dT%H-%M-%S.%f')
-    return None
+ASSISTANT_TOKEN = '<|im_start|>assistant'
+FUNCTION_INDEX_FILENAME = "function_index.npz"
+
+# Groupings already computed in this process, keyed by dataset fingerprint
+_function_indexes = {}
+
+# Share of the per-function limit drawn from each stratum; `move` is split by direction
+# and every other function is one stratum with weight 1.0
+FUNCTION_FILTER_WEIGHTS = {
+    "move|left": 0.2,
+    "move|right": 0.2,
+    "move|forward": 1.0,
+    "move|backward": 0.2,
+}
 
 def apply_template(tokenizer, messages):
-    texts = [tokenizer.apply_chat_template(message, tokenize=False, add_generation_prompt=False) for message in messages]
-    return [{'text': t[0]} for t in texts]
+    # Each message wraps a single conversation, so the whole list is templated as one batch
+    texts = tokenizer.apply_chat_template([message[0] for message in messages], tokenize=False, add_generation_prompt=False)
+    return [{'text': t} for t in texts]
 
 def load_models(checkpoint_path=None):
+    # Deferred so the data-prep entry points can import util without unsloth/torch
+    from unsloth.chat_templates import get_chat_template
+    from unsloth import FastLanguageModel
+
     if checkpoint_path and os.path.exists(checkpoint_path):
         print(f"Loading model from checkpoint at {checkpoint_path}...")
 
@@ -70,60 +74,166 @@ def load_models(checkpoint_path=None):
 
     return model, tokenizer
 
+def split_assistant_text(input_text):
+    # Split the input_text to separate the prompt and the assistant's response
+    if ASSISTANT_TOKEN not in input_text:
+        return None, None
+    prompt_text, rest = input_text.split(ASSISTANT_TOKEN)
+    prompt_text += ASSISTANT_TOKEN  # Include the assistant token at the end
+    assistant_text = rest.strip()
+    # Remove any trailing <|im_end|> token if present
+    if '<|im_end|>' in assistant_text:
+        assistant_text = assistant_text.split('<|im_end|>')[0].strip()
+    return prompt_text, assistant_text
+
+def get_dataset_labels(dataset):
+    """Returns the function and direction label of every row, using the stored columns when present."""
+    if 'function' in dataset.column_names and 'direction' in dataset.column_names:
+        return dataset['function'], dataset['direction']
+
+    # Datasets built before the label columns existed are labeled from their text
+    functions, directions = [], []
+    for text in dataset['text']:
+        _, assistant_text = split_assistant_text(text)
+        function_name, direction = get_action_labels(assistant_text) if assistant_text is not None else ("", "")
+        functions.append(function_name)
+        directions.append(direction)
+    return functions, directions
+
+def _function_index_path(dataset):
+    # Only datasets loaded straight from one directory have a stable place to keep the index
+    if dataset._indices is not None or not dataset.cache_files:
+        return None
+    directories = {os.path.dirname(cache_file['filename']) for cache_file in dataset.cache_files}
+    if len(directories) > 1:
+        return None
+    return os.path.join(directories.pop(), FUNCTION_INDEX_FILENAME)
+
+def _group_indices(labels):
+    uniques, inverse = np.unique(labels, return_inverse=True)
+    order = np.argsort(inverse, kind='stable')
+    bounds = np.cumsum(np.bincount(inverse, minlength=len(uniques)))[:-1]
+    return dict(zip(uniques.tolist(), np.split(order, bounds)))
+
+def get_function_index(dataset):
+    """
+    Returns {function: row indices} and {(function, direction): row indices},
+    with indices in ascending order. The grouping is computed once and cached
+    beside the dataset's Arrow files.
+    """
+    if dataset._fingerprint in _function_indexes:
+        return _function_indexes[dataset._fingerprint]
+
+    functions = None
+    index_path = _function_index_path(dataset)
+    if index_path and os.path.exists(index_path):
+        cached = np.load(index_path, allow_pickle=False)
+        if str(cached['fingerprint']) == dataset._fingerprint:
+            functions, directions = cached['functions'], cached['directions']
+
+    if functions is None:
+        functions, directions = get_dataset_labels(dataset)
+        functions = np.asarray(functions, dtype=str)
+        directions = np.asarray(directions, dtype=str)
+
+        if index_path:
+            try:
+                np.savez(index_path, fingerprint=np.array(dataset._fingerprint), functions=functions, directions=directions)
+            except OSError as e:
+                print(f"Unable to cache function index at {index_path}: {e}")
+
+    function_index = (_group_indices(functions), _group_indices(np.char.add(np.char.add(functions, '|'), directions)))
+    _function_indexes[dataset._fingerprint] = function_index
+    return function_index
+
 def get_unique_function(dataset):
     unique_functions = {}
-    for idx in range(len(dataset)):
-        example = dataset[idx]
-        input_text = example['text']
-
-        # Split the input_text to separate the prompt and the assistant's response
-        assistant_token = '<|im_start|>assistant'
-        if assistant_token in input_text:
-            prompt_text, rest = input_text.split(assistant_token)
-            prompt_text += assistant_token  # Include the assistant token at the end
-            assistant_text = rest.strip()
-            # Remove any trailing <|im_end|> token if present
-            if '<|im_end|>' in assistant_text:
-                assistant_text = assistant_text.split('<|im_end|>')[0].strip()
-        else:
-            # If the assistant token is not found, skip this example
+    by_function, _ = get_function_index(dataset)
+
+    for function_name, indices in by_function.items():
+        if not function_name or len(indices) == 0:
             continue
 
-        # Check if 'function: ' is in the assistant's text
-        if 'function: ' in assistant_text:
-            # Extract the function name
-            # Assuming the function name follows 'function: ' and is up to the next newline or period
-            _, _, rest = assistant_text.rpartition("function: ")
-            function_name = rest.split('\n')[0].split('.')[0].strip()
-
-            # If we haven't already collected an example for this function, add it
-            if function_name not in unique_functions:
-                unique_functions[function_name] = {
-                    'index': idx,
-                    'prompt_text': prompt_text,
-                    'assistant_text': assistant_text,
-                    'example': example
-                }
-    
-    return unique_functions
-
-def get_dataset_idx_by_function_name(dataset, function_name, limit=0, filter=None):
-    matches=0
-    indices = list(range(len(dataset)))
-    random.shuffle(indices)
-
-    for idx in indices:
+        idx = int(indices[0])
         example = dataset[idx]
-        input_text = example['text']
-        assistant_token = '<|im_start|>assistant'
-        if assistant_token in input_text:
-            _, rest = input_text.split(assistant_token)
-            if "function: " in rest:
-                _, _, rest = rest.rpartition("function: ")
-                if function_name in rest:
-                    if filter == None or filter in rest:
-                        matches += 1
-                        yield idx
-            
-            if limit > 0 and matches >= limit:
-                return
\ No newline at end of file
+        prompt_text, assistant_text = split_assistant_text(example['text'])
+        if prompt_text is None:
+            continue
+
+        unique_functions[function_name] = {
+            'index': idx,
+            'prompt_text': prompt_text,
+            'assistant_text': assistant_text,
+            'example': example
+        }
+
+    # Keep the order in which functions first appear in the dataset
+    return dict(sorted(unique_functions.items(), key=lambda item: item[1]['index']))
+
+def get_strata(dataset, weights=FUNCTION_FILTER_WEIGHTS):
+    """
+    Returns {stratum: row indices}. A function with weighted directions is split
+    into one stratum per weighted direction (its other rows are left out); any
+    other function is a single stratum.
+    """
+    by_function, by_direction = get_function_index(dataset)
+    split_functions = {stratum.split('|')[0] for stratum in weights if '|' in stratum}
+
+    strata = {}
+    for function_name, indices in by_function.items():
+        if not function_name:
+            continue
+        if function_name in split_functions:
+            for stratum in weights:
+                if stratum.split('|')[0] == function_name and stratum in by_direction:
+                    strata[stratum] = by_direction[stratum]
+        else:
+            strata[function_name] = indices
+    return strata
+
+def stratified_sample(dataset, limit=0, seed=0, epoch=0, weights=FUNCTION_FILTER_WEIGHTS):
+    """
+    Draws up to ceil(limit * weight) rows from every stratum (all rows when limit
+    is 0). One random key is drawn per row from a generator seeded with
+    (seed, epoch) and each stratum keeps its lowest keys, so a new epoch
+    reshuffles without rescanning the dataset. Logs the achieved distribution.
+    """
+    strata = get_strata(dataset, weights)
+    keys = np.random.default_rng([seed, epoch]).random(len(dataset))
+
+    selected = []
+    print(f"Stratified sample (limit={limit}, seed={seed}, epoch={epoch}):")
+    for stratum, indices in strata.items():
+        quota = len(indices) if limit <= 0 else min(len(indices), math.ceil(limit * weights.get(stratum, 1.0)))
+        selected.append(indices[np.argsort(keys[indices], kind='stable')[:quota]])
+
+    total = sum(len(indices) for indices in selected)
+    for (stratum, indices), chosen in zip(strata.items(), selected):
+        print(f"  {stratum}: {len(chosen)}/{len(indices)} rows ({len(chosen) / max(1, total):.1%} of sample)")
+
+    return np.concatenate(selected) if selected else np.array([], dtype=np.int64)
+
+def sample_eval_indices(dataset, num_samples, seed=0):
+    """Samples up to num_samples rows with an action, spread evenly across functions."""
+    rng = random.Random(seed)
+    by_function, _ = get_function_index(dataset)
+    groups = {function: [int(idx) for idx in indices] for function, indices in by_function.items() if function}
+    for indices in groups.values():
+        rng.shuffle(indices)
+
+    selected = []
+    while len(selected) < num_samples and any(groups.values()):
+        for function in sorted(groups):
+            if groups[function] and len(selected) < num_samples:
+                selected.append(groups[function].pop())
+    return sorted(selected)
+
+def parameters_match(expected, predicted):
+    def normalize(value):
+        return round(value, 1) if isinstance(value, float) else str(value)
+    return expected.keys() == predicted.keys() and all(normalize(expected[k]) == normalize(predicted[k]) for k in expected)
+
+def find_latest_model(output_dir):
+    """Returns the most recent merged model written by train.main."""
+    model_dirs = [path for path in glob.glob(os.path.join(output_dir, "model-*")) if os.path.isdir(path) and not path.endswith("gguf")]
+    return max(model_dirs, key=os.path.getmtime) if model_dirs else None